@@ -0,0 +1,524 @@
+# benchmarks/fakes.py
+# In-memory stand-ins for the Cosmos DB container and Blob Storage clients used by the
+# function app, with injectable latency and throttling, for offline benchmarks.
+
+import asyncio
+import copy
+import random
+import re
+import threading
+import time
+import uuid
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any, Callable, Optional
+
+from azure.core.exceptions import ResourceNotFoundError
+from azure.cosmos import exceptions
+
+# Simulated request charges, roughly those of a 1 KB document
+DEFAULT_REQUEST_CHARGES = {
+    "read": 1.0,
+    "not_modified": 1.0,
+    "write": 6.0,
+    "patch": 10.0,
+    "delete": 6.0,
+    "query": 2.5,
+    "query_item": 0.05,
+    "failed": 1.0,
+}
+# The Cosmos SDK retries a throttled request up to 9 times before raising the 429
+SDK_MAX_THROTTLE_RETRIES = 9
+
+
+@dataclass
+class FakeServiceSettings:
+    """ The simulated behaviour of a fake service.
+
+    Attributes:
+        latency_ms (float): the fixed latency of every request
+        jitter_ms (float): the maximum random latency added to each request
+        throttle_rate (float): the probability a request is throttled with a 429
+        retry_after_ms (float): the retry-after of a throttled request
+        max_throttle_retries (int): the retries made before a 429 is raised to the caller
+        seed (int): the random seed, for repeatable runs
+    """
+    latency_ms: float = 0.0
+    jitter_ms: float = 0.0
+    throttle_rate: float = 0.0
+    retry_after_ms: float = 10.0
+    max_throttle_retries: int = SDK_MAX_THROTTLE_RETRIES
+    seed: Optional[int] = None
+
+
+@dataclass
+class FakeServiceStats:
+    """ The counters of a fake service. """
+    requests: int = 0
+    throttled: int = 0
+    request_charge: float = 0.0
+    requests_by_operation: dict = field(default_factory=dict)
+
+
+class _FakeService:
+    """ The latency, throttling and accounting shared by the sync and async fakes. """
+
+    def __init__(self, settings: Optional[FakeServiceSettings] = None):
+        self.settings = settings or FakeServiceSettings()
+        self.stats = FakeServiceStats()
+        self._random = random.Random(self.settings.seed)
+        self._stats_lock = threading.Lock()
+
+    def _latency(self) -> float:
+        """ Returns the latency of the next request in seconds. """
+        jitter = self._random.uniform(0, self.settings.jitter_ms) if self.settings.jitter_ms else 0.0
+        return (self.settings.latency_ms + jitter) / 1000
+
+    def _admit(self, operation: str, attempt: int) -> bool:
+        """ Count a request attempt and decide whether it is throttled.
+
+        Raises:
+            CosmosHttpResponseError: a 429 once the retries are exhausted
+        """
+        with self._stats_lock:
+            self.stats.requests += 1
+            self.stats.requests_by_operation[operation] = self.stats.requests_by_operation.get(operation, 0) + 1
+            throttled = self.settings.throttle_rate and self._random.random() < self.settings.throttle_rate
+            if throttled:
+                self.stats.throttled += 1
+        if throttled and attempt >= self.settings.max_throttle_retries:
+            error = exceptions.CosmosHttpResponseError(status_code=429, message="Request rate is large")
+            error.headers = {"x-ms-retry-after-ms": str(self.settings.retry_after_ms), "x-ms-request-charge": "0"}
+            raise error
+        return bool(throttled)
+
+    def _charge(self, request_charge: float, attempt: int) -> dict:
+        """ Account for a completed request and build its response headers. """
+        with self._stats_lock:
+            self.stats.request_charge += request_charge
+        headers = {"x-ms-request-charge": str(request_charge)}
+        if attempt:
+            headers["x-ms-throttle-retry-count"] = str(attempt)
+            headers["x-ms-throttle-retry-wait-time-ms"] = str(attempt * self.settings.retry_after_ms)
+        return headers
+
+    def _complete(self, operation: Callable[[], tuple[Any, float]], attempt: int, response_hook) -> Any:
+        """ Run an operation, charging it and calling the response_hook. """
+        try:
+            result, request_charge = operation()
+        except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+            e.headers = self._charge(getattr(e, "request_charge", DEFAULT_REQUEST_CHARGES["failed"]), attempt)
+            raise
+        headers = self._charge(request_charge, attempt)
+        if response_hook:
+            response_hook(headers, result)
+        return result
+
+    def _call(self, name: str, operation: Callable[[], tuple[Any, float]], response_hook=None) -> Any:
+        """ Run an operation after the simulated latency, retrying throttled attempts. """
+        attempt = 0
+        while True:
+            time.sleep(self._latency())
+            if not self._admit(name, attempt):
+                return self._complete(operation, attempt, response_hook)
+            attempt += 1
+            time.sleep(self.settings.retry_after_ms / 1000)
+
+    async def _call_async(self, name: str, operation: Callable[[], tuple[Any, float]], response_hook=None) -> Any:
+        """ The asyncio variant of _call. """
+        attempt = 0
+        while True:
+            await asyncio.sleep(self._latency())
+            if not self._admit(name, attempt):
+                return self._complete(operation, attempt, response_hook)
+            attempt += 1
+            await asyncio.sleep(self.settings.retry_after_ms / 1000)
+
+
+class InMemoryCosmosStore:
+    """The documents of a fake Cosmos DB container, keyed by (partition key, id).
+
+    Operations return (result, request_charge) and raise the SDK's exceptions, so the
+    fakes behave like ContainerProxy for the subset of the API the DALs use.
+    """
+
+    def __init__(self, partition_key_field: str = "deployment_id", request_charges: Optional[dict] = None):
+        """ Initializes an empty store.
+
+        Args:
+            partition_key_field (str): the document field holding the partition key
+            request_charges (dict): overrides of DEFAULT_REQUEST_CHARGES
+        """
+        self.partition_key_field = partition_key_field
+        self.request_charges = {**DEFAULT_REQUEST_CHARGES, **(request_charges or {})}
+        self.items: dict[tuple[Any, str], dict] = {}
+        self._lock = threading.RLock()
+
+    def _error(self, error_class, status_code: int, message: str):
+        error = error_class(status_code=status_code, message=message)
+        error.request_charge = self.request_charges["failed"]
+        return error
+
+    def _stored(self, body: dict) -> dict:
+        stored = copy.deepcopy(body)
+        stored["_etag"] = f'"{uuid.uuid4()}"'
+        stored["_ts"] = int(time.time())
+        return stored
+
+    def read(self, item_id: str, partition_key, if_none_match: Optional[str] = None) -> tuple[dict, float]:
+        with self._lock:
+            stored = self.items.get((partition_key, item_id))
+            if stored is None:
+                raise self._error(exceptions.CosmosResourceNotFoundError, 404, f"Item {item_id} not found")
+            if if_none_match and stored["_etag"] == if_none_match:
+                return {}, self.request_charges["not_modified"]
+            return copy.deepcopy(stored), self.request_charges["read"]
+
+    def read_many(self, items: list[tuple[str, Any]]) -> tuple[list[dict], float]:
+        """ Read many items, leaving out the ones that do not exist, as read_items does. """
+        with self._lock:
+            found = [copy.deepcopy(self.items[(partition_key, item_id)]) for item_id, partition_key in items if (partition_key, item_id) in self.items]
+        return found, self.request_charges["read"] * max(len(items), 1)
+
+    def create(self, body: dict) -> tuple[dict, float]:
+        with self._lock:
+            key = (body[self.partition_key_field], body["id"])
+            if key in self.items:
+                raise self._error(exceptions.CosmosResourceExistsError, 409, f"Item {body['id']} already exists")
+            self.items[key] = self._stored(body)
+            return copy.deepcopy(self.items[key]), self.request_charges["write"]
+
+    def replace(self, item_id: str, body: dict, etag: Optional[str] = None) -> tuple[dict, float]:
+        with self._lock:
+            key = (body[self.partition_key_field], item_id)
+            stored = self.items.get(key)
+            if stored is None:
+                raise self._error(exceptions.CosmosResourceNotFoundError, 404, f"Item {item_id} not found")
+            if etag and stored["_etag"] != etag:
+                raise self._error(exceptions.CosmosAccessConditionFailedError, 412, "Precondition failed")
+            self.items[key] = self._stored(body)
+            return copy.deepcopy(self.items[key]), self.request_charges["write"]
+
+    def delete(self, item_id: str, partition_key) -> tuple[None, float]:
+        with self._lock:
+            if self.items.pop((partition_key, item_id), None) is None:
+                raise self._error(exceptions.CosmosResourceNotFoundError, 404, f"Item {item_id} not found")
+            return None, self.request_charges["delete"]
+
+    def delete_partition(self, partition_key) -> tuple[None, float]:
+        with self._lock:
+            keys = [key for key in self.items if key[0] == partition_key]
+            for key in keys:
+                del self.items[key]
+            return None, self.request_charges["delete"] * max(len(keys), 1)
+
+    def batch(self, batch_operations: list, partition_key) -> tuple[list[dict], float]:
+        """ Run a transactional batch: every operation applies, or none does. """
+        with self._lock:
+            snapshot = dict(self.items)
+            results = []
+            request_charge = 0.0
+            for index, operation in enumerate(batch_operations):
+                try:
+                    result, charge = self._batch_operation(operation, partition_key)
+                except (exceptions.CosmosHttpResponseError, KeyError) as e:
+                    self.items = snapshot
+                    status_code = getattr(e, "status_code", 400)
+                    responses = [{"statusCode": 424} for _ in batch_operations]
+                    responses[index] = {"statusCode": status_code}
+                    error = exceptions.CosmosBatchOperationError(
+                        error_index=index, headers={}, status_code=status_code,
+                        message=f"Batch operation {index} failed", operation_responses=responses,
+                    )
+                    error.request_charge = request_charge + self.request_charges["failed"]
+                    raise error
+                results.append(result)
+                request_charge += charge
+            return results, request_charge
+
+    def _batch_operation(self, operation: tuple, partition_key) -> tuple[dict, float]:
+        operation_type, args = operation[0], operation[1]
+        options = operation[2] if len(operation) > 2 else {}
+        if operation_type == "create":
+            body, charge = self.create(args[0])
+        elif operation_type == "upsert":
+            key = (partition_key, args[0]["id"])
+            self.items[key] = self._stored(args[0])
+            body, charge = copy.deepcopy(self.items[key]), self.request_charges["write"]
+        elif operation_type == "replace":
+            body, charge = self.replace(args[0], args[1], options.get("if_match_etag"))
+        elif operation_type == "patch":
+            body, charge = self.patch(args[0], partition_key, args[1], options.get("if_match_etag"))
+        elif operation_type == "delete":
+            body, charge = self.delete(args[0], partition_key)
+        elif operation_type == "read":
+            body, charge = self.read(args[0], partition_key)
+        else:
+            raise NotImplementedError(f"Unsupported batch operation: {operation_type}")
+        return {"statusCode": 200, "resourceBody": body}, charge
+
+    def patch(self, item_id: str, partition_key, patch_operations: list, etag: Optional[str] = None) -> tuple[dict, float]:
+        with self._lock:
+            stored = self.items.get((partition_key, item_id))
+            if stored is None:
+                raise self._error(exceptions.CosmosResourceNotFoundError, 404, f"Item {item_id} not found")
+            if etag and stored["_etag"] != etag:
+                raise self._error(exceptions.CosmosAccessConditionFailedError, 412, "Precondition failed")
+            body = copy.deepcopy(stored)
+            for patch in patch_operations:
+                path = patch["path"].strip("/")
+                if patch["op"] == "incr":
+                    body[path] = body.get(path, 0) + patch["value"]
+                elif patch["op"] in ("set", "add", "replace"):
+                    body[path] = patch["value"]
+                elif patch["op"] == "remove":
+                    body.pop(path, None)
+            self.items[(partition_key, item_id)] = self._stored(body)
+            return copy.deepcopy(self.items[(partition_key, item_id)]), self.request_charges["patch"]
+
+    def query(self, query: str, parameters: Optional[list[dict]], partition_key) -> list:
+        """ Evaluate one of the queries built by build_partition_query. """
+        select, where, offset = _parse_query(query)
+        values = {parameter["name"]: parameter["value"] for parameter in parameters or []}
+        with self._lock:
+            documents = [
+                document for (document_partition, _), document in self.items.items()
+                if (partition_key is None or document_partition == partition_key)
+                and all(condition(document, values) for condition in where)
+            ]
+        if select == "VALUE COUNT(1)":
+            return [len(documents)]
+        if offset:
+            skip, take = values[offset[0]], values[offset[1]]
+            documents = documents[skip:skip + take]
+        if select == "*":
+            return copy.deepcopy(documents)
+        if select.startswith("VALUE c."):
+            return [document.get(select[len("VALUE c."):]) for document in documents]
+        fields = [name.strip()[len("c."):] for name in select.split(",")]
+        return [{name: document.get(name) for name in fields if name in document} for document in documents]
+
+
+def _parse_query(query: str):
+    """ Parse SELECT <projection> FROM c [WHERE <a> AND <b>...] [OFFSET @skip LIMIT @take]. """
+    match = re.fullmatch(
+        r"SELECT (?P<select>.+?) FROM c(?: WHERE (?P<where>.+?))?(?: OFFSET (?P<skip>@\w+) LIMIT (?P<take>@\w+))?",
+        query.strip(),
+    )
+    if match is None:
+        raise NotImplementedError(f"Unsupported query: {query}")
+    where = [_parse_condition(condition) for condition in match.group("where").split(" AND ")] if match.group("where") else []
+    offset = (match.group("skip"), match.group("take")) if match.group("skip") else None
+    return match.group("select"), where, offset
+
+
+def _parse_condition(condition: str) -> Callable[[dict, dict], bool]:
+    condition = condition.strip()
+    match = re.fullmatch(r"c\.(\w+) (=|>=|<=|>|<|!=) (@\w+|'[^']*'|\d+)", condition)
+    if match:
+        name, operator, operand = match.groups()
+
+        def value_of(values: dict):
+            if operand.startswith("@"):
+                return values[operand]
+            return operand.strip("'") if operand.startswith("'") else int(operand)
+
+        compare = {
+            "=": lambda a, b: a == b, "!=": lambda a, b: a != b,
+            ">=": lambda a, b: a is not None and a >= b, "<=": lambda a, b: a is not None and a <= b,
+            ">": lambda a, b: a is not None and a > b, "<": lambda a, b: a is not None and a < b,
+        }[operator]
+        return lambda document, values: compare(document.get(name), value_of(values))
+    match = re.fullmatch(r"ARRAY_CONTAINS\((@\w+), c\.(\w+)\)", condition)
+    if match:
+        parameter, name = match.groups()
+        return lambda document, values: document.get(name) in values[parameter]
+    raise NotImplementedError(f"Unsupported query condition: {condition}")
+
+
+class FakeQueryIterable:
+    """ The result of FakeContainerProxy.query_items, fetched lazily page by page. """
+
+    def __init__(self, container: "FakeContainerProxy", query: str, parameters, partition_key, max_item_count, response_hook):
+        self._container = container
+        self._query = query
+        self._parameters = parameters
+        self._partition_key = partition_key
+        self._page_size = max_item_count or 100
+        self._response_hook = response_hook
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+    def by_page(self, continuation_token: Optional[str] = None) -> "FakeQueryPager":
+        return FakeQueryPager(self, continuation_token)
+
+    def _fetch_page(self, start: int) -> tuple[list, Optional[str]]:
+        store = self._container.store
+        end = start + self._page_size
+        total = 0
+
+        def run():
+            nonlocal total
+            documents = store.query(self._query, self._parameters, self._partition_key)
+            total = len(documents)
+            page = documents[start:end]
+            return page, store.request_charges["query"] + store.request_charges["query_item"] * len(page)
+
+        page = self._container._call("query_items", run, self._response_hook)
+        return page, str(end) if total > end else None
+
+
+class FakeQueryPager:
+    """ Iterates over the pages of a query, exposing the continuation token of the last one. """
+
+    def __init__(self, iterable: FakeQueryIterable, continuation_token: Optional[str]):
+        self._iterable = iterable
+        self.continuation_token = continuation_token
+
+    def __iter__(self):
+        start = int(self.continuation_token or 0)
+        while True:
+            page, self.continuation_token = self._iterable._fetch_page(start)
+            yield iter(page)
+            if self.continuation_token is None:
+                return
+            start = int(self.continuation_token)
+
+
+class FakeContainerProxy(_FakeService):
+    """An in-memory azure.cosmos ContainerProxy for the operations used by the DALs:
+    point reads (with If-None-Match), read_items, create, replace (with ETag conditions), patch,
+    delete, transactional batches with 409/404/412 semantics and partitioned queries.
+    """
+
+    def __init__(self, store: Optional[InMemoryCosmosStore] = None, settings: Optional[FakeServiceSettings] = None):
+        """ Initializes the fake container.
+
+        Args:
+            store (InMemoryCosmosStore): the documents, shared with other fakes if given
+            settings (FakeServiceSettings): the simulated latency and throttling
+        """
+        super().__init__(settings)
+        self.store = store or InMemoryCosmosStore()
+
+    def read_item(self, item, partition_key, initial_headers=None, response_hook=None, **kwargs):
+        if_none_match = (initial_headers or {}).get("If-None-Match")
+        return self._call("read_item", lambda: self.store.read(item, partition_key, if_none_match), response_hook)
+
+    def read_items(self, items, max_concurrency=None, response_hook=None, **kwargs):
+        return self._call("read_items", lambda: self.store.read_many(items), response_hook)
+
+    def create_item(self, body, response_hook=None, **kwargs):
+        return self._call("create_item", lambda: self.store.create(body), response_hook)
+
+    def replace_item(self, item, body, etag=None, match_condition=None, response_hook=None, **kwargs):
+        return self._call("replace_item", lambda: self.store.replace(item, body, etag), response_hook)
+
+    def patch_item(self, item, partition_key, patch_operations, response_hook=None, **kwargs):
+        return self._call("patch_item", lambda: self.store.patch(item, partition_key, patch_operations), response_hook)
+
+    def delete_item(self, item, partition_key, response_hook=None, **kwargs):
+        return self._call("delete_item", lambda: self.store.delete(item, partition_key), response_hook)
+
+    def delete_all_items_by_partition_key(self, partition_key, response_hook=None, **kwargs):
+        return self._call("delete_all_items_by_partition_key", lambda: self.store.delete_partition(partition_key), response_hook)
+
+    def execute_item_batch(self, batch_operations, partition_key, response_hook=None, **kwargs):
+        return self._call("execute_item_batch", lambda: self.store.batch(batch_operations, partition_key), response_hook)
+
+    def query_items(self, query, parameters=None, partition_key=None, max_item_count=None, response_hook=None, **kwargs):
+        return FakeQueryIterable(self, query, parameters, partition_key, max_item_count, response_hook)
+
+
+class AsyncFakeContainerProxy(_FakeService):
+    """ The azure.cosmos.aio counterpart of FakeContainerProxy. """
+
+    def __init__(self, store: Optional[InMemoryCosmosStore] = None, settings: Optional[FakeServiceSettings] = None):
+        super().__init__(settings)
+        self.store = store or InMemoryCosmosStore()
+
+    async def read_item(self, item, partition_key, initial_headers=None, response_hook=None, **kwargs):
+        if_none_match = (initial_headers or {}).get("If-None-Match")
+        return await self._call_async("read_item", lambda: self.store.read(item, partition_key, if_none_match), response_hook)
+
+    async def create_item(self, body, response_hook=None, **kwargs):
+        return await self._call_async("create_item", lambda: self.store.create(body), response_hook)
+
+    async def replace_item(self, item, body, etag=None, match_condition=None, response_hook=None, **kwargs):
+        return await self._call_async("replace_item", lambda: self.store.replace(item, body, etag), response_hook)
+
+    async def delete_item(self, item, partition_key, response_hook=None, **kwargs):
+        return await self._call_async("delete_item", lambda: self.store.delete(item, partition_key), response_hook)
+
+    async def execute_item_batch(self, batch_operations, partition_key, response_hook=None, **kwargs):
+        return await self._call_async("execute_item_batch", lambda: self.store.batch(batch_operations, partition_key), response_hook)
+
+    def query_items(self, query, parameters=None, partition_key=None, max_item_count=None, response_hook=None, **kwargs):
+        async def items():
+            page_size = max_item_count or 100
+            start = 0
+            while True:
+                def run(start=start):
+                    page = self.store.query(query, parameters, partition_key)[start:start + page_size]
+                    charges = self.store.request_charges
+                    return page, charges["query"] + charges["query_item"] * len(page)
+                page = await self._call_async("query_items", run, response_hook)
+                for item in page:
+                    yield item
+                if len(page) < page_size:
+                    return
+                start += page_size
+        return items()
+
+
+class FakeBlobService(_FakeService):
+    """An in-memory BlobServiceClient answering get_blob_properties for the blobs put into it.
+
+    get_container_client(name).get_blob_client(name) mirrors the azure.storage.blob API,
+    and the async flag makes get_blob_properties a coroutine like the aio client's.
+    """
+
+    def __init__(self, settings: Optional[FakeServiceSettings] = None, is_async: bool = False):
+        """ Initializes an empty blob service.
+
+        Args:
+            settings (FakeServiceSettings): the simulated latency, throttling is not simulated
+            is_async (bool): make get_blob_properties a coroutine
+        """
+        super().__init__(settings)
+        self.is_async = is_async
+        self.blobs: dict[tuple[str, str], SimpleNamespace] = {}
+
+    def put_blob(self, container_name: str, blob_name: str, size: int, content_type: str, metadata: dict):
+        """ Add a blob, described by the properties get_blob_properties returns. """
+        self.blobs[(container_name, blob_name)] = SimpleNamespace(
+            name=blob_name,
+            container=container_name,
+            size=size,
+            content_settings=SimpleNamespace(content_type=content_type, content_md5=None),
+            metadata=dict(metadata),
+            etag=f'"{uuid.uuid4()}"',
+        )
+
+    def get_container_client(self, container_name: str) -> SimpleNamespace:
+        return SimpleNamespace(
+            get_blob_client=lambda blob_name: SimpleNamespace(
+                get_blob_properties=self._properties_reader(container_name, blob_name)
+            )
+        )
+
+    def _properties_reader(self, container_name: str, blob_name: str):
+        def read():
+            properties = self.blobs.get((container_name, blob_name))
+            if properties is None:
+                raise ResourceNotFoundError(f"Blob {container_name}/{blob_name} not found")
+            return properties, 0.0
+
+        if self.is_async:
+            return lambda: self._call_async("get_blob_properties", read)
+        return lambda: self._call("get_blob_properties", read)
+
+    def close(self):
+        pass
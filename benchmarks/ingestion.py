@@ -0,0 +1,369 @@
+# benchmarks/ingestion.py
+# Offline benchmark of the file hash ingestion path against in-memory Cosmos DB and
+# Blob Storage stand-ins.
+#
+# Run from the repository root, e.g.:
+#   python -m benchmarks.ingestion --strategy all --events 5000 --deployments 50 --cosmos-latency-ms 3
+#   python -m benchmarks.ingestion --strategy batch --throttle-rate 0.05 --json
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+# The function app reads its settings on import: no prewarm thread trying to reach
+# Cosmos DB, and nothing spilled outside a scratch directory
+os.environ.setdefault("COLD_START_PREWARM", "false")
+os.environ.setdefault("POISON_EVENT_DIR", os.path.join(tempfile.gettempdir(), "ingestion-benchmark-poison-events"))
+
+import function_app
+from shared.async_deployment_cosmos_db_dal import AsyncDeploymentCosmosDBDAL
+from shared.blob_metadata_resolvers import BlobMetadataResolverChain, PathConventionResolver
+from shared.deployment_cosmos_db_dal import DeploymentCosmosDBDAL
+from shared.document_cache import DocumentCache
+from shared.instrumentation import Instrumentation
+from shared.micro_batching import LocalEventQueue
+from shared.rate_governor import RateGovernor, RateLimitExceeded
+from shared.seen_hash_filter import SeenHashFilter
+
+from benchmarks.fakes import (
+    AsyncFakeContainerProxy,
+    FakeBlobService,
+    FakeContainerProxy,
+    FakeServiceSettings,
+    InMemoryCosmosStore,
+)
+
+STRATEGIES = ("single", "batch", "async", "micro_batch")
+STORAGE_ACCOUNT = "benchaccount"
+BLOB_CONTAINER = "uploads"
+BLOB_PATH_CONVENTION = "{container}/{dep_id}/{hash}.{ext}"
+
+
+@dataclass
+class BenchmarkSettings:
+    """ The workload and the simulated environment of a benchmark run. """
+    events: int = 2000
+    deployments: int = 20
+    skew: float = 1.1  # Zipf exponent of the events per deployment, 0 for uniform
+    duplicate_rate: float = 0.1  # share of events re-delivering an already stored hash
+    batch_size: int = 100  # events per invocation for the batch, async and micro_batch strategies
+    coalesce_events: int = 500  # events coalesced before a micro_batch flush
+    coalesce_wait_ms: float = 1000.0  # time window of a micro_batch flush
+    concurrency: int = 8  # async strategy operations in flight
+    counter_shards: int = 1
+    path_convention: bool = False  # resolve from the blob path instead of reading blob properties
+    seen_cache: bool = True
+    metadata_cache: bool = True
+    cosmos_latency_ms: float = 2.0
+    blob_latency_ms: float = 4.0
+    jitter_ms: float = 1.0
+    throttle_rate: float = 0.0
+    retry_after_ms: float = 10.0
+    ru_budget: float = 0.0  # RU per second per deployment partition of the rate governor, 0 for none
+    max_throttle_wait_ms: float = 5000.0
+    seed: int = 1
+
+
+def generate_burst(settings: BenchmarkSettings, blob_services: List[FakeBlobService]) -> List[Dict[str, Any]]:
+    """ Generate a burst of BlobCreated events and put their blobs into the blob services.
+
+    Deployments receive events following a Zipf distribution, and a share of the events
+    re-deliver a hash the deployment already has.
+
+    Args:
+        settings (BenchmarkSettings): the workload settings
+        blob_services (list[FakeBlobService]): the fakes the blobs are put into
+
+    Returns:
+        list[dict]: the events in the Event Grid schema
+    """
+    rng = random.Random(settings.seed)
+    deployment_ids = list(range(1, settings.deployments + 1))
+    weights = [1 / rank ** settings.skew for rank in deployment_ids]
+    uploaded: Dict[int, List[str]] = {deployment_id: [] for deployment_id in deployment_ids}
+    events = []
+    for index in range(settings.events):
+        deployment_id = rng.choices(deployment_ids, weights)[0]
+        if uploaded[deployment_id] and rng.random() < settings.duplicate_rate:
+            file_hash = rng.choice(uploaded[deployment_id])
+        else:
+            file_hash = f"{rng.getrandbits(256):064x}"
+            uploaded[deployment_id].append(file_hash)
+        size = rng.randint(200_000, 8_000_000)
+        blob_name = f"{file_hash}.jpg"
+        container_name = f"{BLOB_CONTAINER}/{deployment_id}"
+        for blob_service in blob_services:
+            blob_service.put_blob(container_name, blob_name, size, "image/jpeg", {"dep_id": str(deployment_id), "hash": file_hash})
+        events.append({
+            "id": str(index),
+            "eventType": "Microsoft.Storage.BlobCreated",
+            "subject": f"/blobServices/default/containers/{BLOB_CONTAINER}/blobs/{deployment_id}/{blob_name}",
+            "data": {
+                "url": f"https://{STORAGE_ACCOUNT}.blob.core.windows.net/{container_name}/{blob_name}",
+                "contentLength": size,
+                "contentType": "image/jpeg",
+            },
+        })
+    return events
+
+
+def build_resolver(settings: BenchmarkSettings, blob_service: FakeBlobService, async_blob_service: FakeBlobService):
+    """ Build the metadata resolver chain the function app would use, its fallback reading
+    the blob properties from the fake blob services instead of the storage accounts.
+    """
+    def read_properties(blob_url: str, storage_account_name: str):
+        container_name = function_app.extract_container_name(blob_url)
+        blob_name = blob_url.split("/")[-1]
+        properties = blob_service.get_container_client(container_name).get_blob_client(blob_name).get_blob_properties()
+        return function_app.blob_properties_to_metadata(blob_url, storage_account_name, container_name, blob_name, properties)
+
+    async def read_properties_async(blob_url: str, storage_account_name: str):
+        container_name = function_app.extract_container_name(blob_url)
+        blob_name = blob_url.split("/")[-1]
+        properties = await async_blob_service.get_container_client(container_name).get_blob_client(blob_name).get_blob_properties()
+        return function_app.blob_properties_to_metadata(blob_url, storage_account_name, container_name, blob_name, properties)
+
+    return BlobMetadataResolverChain(
+        resolvers=[PathConventionResolver(BLOB_PATH_CONVENTION)] if settings.path_convention else [],
+        fallback=read_properties,
+        async_fallback=read_properties_async,
+    )
+
+
+@contextmanager
+def function_app_globals(**values):
+    """ Swap module globals of the function app, e.g. its DALs and resolver, for the
+    duration of a run and restore them afterwards.
+    """
+    saved = {name: getattr(function_app, name) for name in values}
+    for name, value in values.items():
+        setattr(function_app, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(function_app, name, value)
+
+
+def count_statuses(totals: Dict[str, int], results: List[Dict[str, Any]]):
+    """ Add the statuses of an invocation's event results to the totals. """
+    for result in results:
+        totals[result["status"]] = totals.get(result["status"], 0) + 1
+
+
+def run_single(events, instrumentation) -> Dict[str, int]:
+    """ One invocation per event, resolved and written as test_function does. """
+    statuses: Dict[str, int] = {}
+    for event in events:
+        start = time.perf_counter()
+        with instrumentation.invocation(events=1):
+            try:
+                deployment_id, file_hash = function_app.resolve_file_hash(event["eventType"], event["data"])
+                added = function_app.get_deployment_dal().add_file_hash(deployment_id, file_hash)
+                status = "succeeded" if added else "duplicate"
+            except RateLimitExceeded:
+                status = "deferred"
+            except Exception:
+                status = "failed"
+        instrumentation.observe("benchmark.invocation.ms", (time.perf_counter() - start) * 1000)
+        statuses[status] = statuses.get(status, 0) + 1
+    return statuses
+
+
+def run_batch(events, instrumentation, batch_size: int) -> Dict[str, int]:
+    """ Invocations of batch_size events through process_blob_created_events, as batch_function handles them. """
+    statuses: Dict[str, int] = {}
+    for offset in range(0, len(events), batch_size):
+        chunk = events[offset:offset + batch_size]
+        start = time.perf_counter()
+        with instrumentation.invocation(events=len(chunk)):
+            results = function_app.process_blob_created_events(chunk)
+        instrumentation.observe("benchmark.invocation.ms", (time.perf_counter() - start) * 1000)
+        count_statuses(statuses, results)
+    return statuses
+
+
+async def run_async(events, instrumentation, batch_size: int) -> Dict[str, int]:
+    """ Invocations of batch_size events through process_blob_created_events_async, as
+    batch_function_async handles them.
+    """
+    statuses: Dict[str, int] = {}
+    for offset in range(0, len(events), batch_size):
+        chunk = events[offset:offset + batch_size]
+        start = time.perf_counter()
+        with instrumentation.invocation(events=len(chunk)):
+            results = await function_app.process_blob_created_events_async(chunk)
+        instrumentation.observe("benchmark.invocation.ms", (time.perf_counter() - start) * 1000)
+        count_statuses(statuses, results)
+    return statuses
+
+
+async def run_micro_batch(events, instrumentation, batch_size: int) -> Dict[str, int]:
+    """ Invocations of batch_size queued messages through process_event_hub_messages, as
+    micro_batch_function handles Event Hub batches, the events being coalesced per
+    deployment by process_blob_created_events_coalesced before they are written.
+    """
+    queue = LocalEventQueue()
+    queue.put_many(json.dumps(event) for event in events)
+    statuses: Dict[str, int] = {}
+    while queue.depth:
+        messages = queue.receive_batch(batch_size)
+        start = time.perf_counter()
+        _, results = await function_app.process_event_hub_messages(messages)
+        instrumentation.observe("benchmark.invocation.ms", (time.perf_counter() - start) * 1000)
+        count_statuses(statuses, results)
+    return statuses
+
+
+def run_strategy(strategy: str, settings: BenchmarkSettings) -> Dict[str, Any]:
+    """ Run one ingestion strategy over a freshly generated workload and report on it.
+
+    The function app's own processing functions are run, with its DALs, metadata
+    resolver and instrumentation swapped for ones built over the fakes.
+
+    Args:
+        strategy (str): one of STRATEGIES
+        settings (BenchmarkSettings): the workload and environment settings
+
+    Returns:
+        dict: the throughput, invocation latency percentiles, simulated request charge
+            and outcome counts of the run
+    """
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy: {strategy}")
+    cosmos_settings = FakeServiceSettings(
+        latency_ms=settings.cosmos_latency_ms,
+        jitter_ms=settings.jitter_ms,
+        throttle_rate=settings.throttle_rate,
+        retry_after_ms=settings.retry_after_ms,
+        seed=settings.seed,
+    )
+    blob_settings = FakeServiceSettings(latency_ms=settings.blob_latency_ms, jitter_ms=settings.jitter_ms, seed=settings.seed)
+    blob_service = FakeBlobService(blob_settings)
+    async_blob_service = FakeBlobService(blob_settings, is_async=True)
+    events = generate_burst(settings, [blob_service, async_blob_service])
+
+    store = InMemoryCosmosStore()
+    setup_dal = DeploymentCosmosDBDAL(FakeContainerProxy(store))
+    for deployment_id in range(1, settings.deployments + 1):
+        setup_dal.add_deployment_metadata(deployment_id, project_id=1, counter_shards=settings.counter_shards)
+
+    instrumentation = Instrumentation(max_samples=max(settings.events, 1024))
+    rate_governor = RateGovernor(
+        settings.ru_budget, max_wait_ms=settings.max_throttle_wait_ms, rng=random.Random(settings.seed)
+    ) if settings.ru_budget > 0 else None
+    dal_options = dict(
+        seen_hashes=SeenHashFilter() if settings.seen_cache else None,
+        metadata_cache=DocumentCache() if settings.metadata_cache else None,
+        conditional_reads=True,
+        instrumentation=instrumentation,
+        rate_governor=rate_governor,
+    )
+    if strategy in ("single", "batch"):
+        container = FakeContainerProxy(store, cosmos_settings)
+        dals = dict(deployment_dal=DeploymentCosmosDBDAL(container, **dal_options))
+    else:
+        container = AsyncFakeContainerProxy(store, cosmos_settings)
+        dals = dict(async_deployment_dal=AsyncDeploymentCosmosDBDAL(container, **dal_options))
+
+    with function_app_globals(
+        **dals,
+        metadata_resolver=build_resolver(settings, blob_service, async_blob_service),
+        instrumentation=instrumentation,
+        content_hash_verifier=None,
+        ASYNC_MAX_CONCURRENCY=settings.concurrency,
+        MICRO_BATCH_MAX_EVENTS=settings.coalesce_events,
+        MICRO_BATCH_MAX_WAIT_MS=settings.coalesce_wait_ms,
+    ):
+        start = time.perf_counter()
+        if strategy == "single":
+            statuses = run_single(events, instrumentation)
+        elif strategy == "batch":
+            statuses = run_batch(events, instrumentation, settings.batch_size)
+        elif strategy == "async":
+            statuses = asyncio.run(run_async(events, instrumentation, settings.batch_size))
+        else:
+            statuses = asyncio.run(run_micro_batch(events, instrumentation, settings.batch_size))
+        elapsed = time.perf_counter() - start
+
+    metrics = instrumentation.snapshot()
+    request_charge = metrics["counters"].get("cosmos.request_charge", 0.0)
+    return {
+        "strategy": strategy,
+        "events": len(events),
+        "invocations": metrics["histograms"]["benchmark.invocation.ms"]["count"],
+        "elapsed_s": round(elapsed, 3),
+        "events_per_s": round(len(events) / elapsed, 1) if elapsed else 0.0,
+        "invocation_ms": metrics["histograms"]["benchmark.invocation.ms"],
+        "request_charge": round(request_charge, 1),
+        "ru_per_event": round(request_charge / len(events), 3) if events else 0.0,
+        "cosmos_requests": container.stats.requests,
+        "cosmos_requests_by_operation": container.stats.requests_by_operation,
+        "throttled": container.stats.throttled,
+        "blob_reads": blob_service.stats.requests + async_blob_service.stats.requests,
+        "statuses": statuses,
+        "rate_governor": rate_governor.get_stats() if rate_governor else None,
+        "cosmos_ms": {name: summary for name, summary in metrics["histograms"].items() if name.startswith("cosmos.") and name.endswith(".ms")},
+    }
+
+
+def format_reports(reports: List[Dict[str, Any]]) -> str:
+    """ Format the reports as a plain-text comparison table. """
+    columns = [
+        ("strategy", lambda r: r["strategy"]),
+        ("events/s", lambda r: r["events_per_s"]),
+        ("p50 ms", lambda r: r["invocation_ms"]["p50"]),
+        ("p95 ms", lambda r: r["invocation_ms"]["p95"]),
+        ("p99 ms", lambda r: r["invocation_ms"]["p99"]),
+        ("RU/event", lambda r: r["ru_per_event"]),
+        ("RU", lambda r: r["request_charge"]),
+        ("cosmos req", lambda r: r["cosmos_requests"]),
+        ("throttled", lambda r: r["throttled"]),
+        ("blob reads", lambda r: r["blob_reads"]),
+        ("added", lambda r: r["statuses"].get("succeeded", 0)),
+        ("duplicate", lambda r: r["statuses"].get("duplicate", 0)),
+        ("failed", lambda r: r["statuses"].get("failed", 0)),
+        ("deferred", lambda r: r["statuses"].get("deferred", 0)),
+    ]
+    rows = [[name for name, _ in columns]] + [[str(value(report)) for _, value in columns] for report in reports]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join("  ".join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> Tuple[List[str], BenchmarkSettings, bool]:
+    defaults = BenchmarkSettings()
+    parser = argparse.ArgumentParser(description="Benchmark file hash ingestion against in-memory Cosmos DB and Blob Storage.")
+    parser.add_argument("--strategy", choices=STRATEGIES + ("all",), default="all")
+    parser.add_argument("--json", action="store_true", help="print the full reports as JSON")
+    for name, value in asdict(defaults).items():
+        option = f"--{name.replace('_', '-')}"
+        if isinstance(value, bool):
+            parser.add_argument(option, action=argparse.BooleanOptionalAction, default=value)
+        else:
+            parser.add_argument(option, type=type(value), default=value)
+    args = vars(parser.parse_args(argv))
+    strategy = args.pop("strategy")
+    as_json = args.pop("json")
+    return list(STRATEGIES) if strategy == "all" else [strategy], BenchmarkSettings(**args), as_json
+
+
+def main(argv: Optional[List[str]] = None):
+    strategies, settings, as_json = parse_args(argv)
+    reports = [run_strategy(strategy, settings) for strategy in strategies]
+    if as_json:
+        json.dump({"settings": asdict(settings), "reports": reports}, sys.stdout, indent=2)
+        print()
+    else:
+        print(format_reports(reports))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,96 +1,941 @@
+import time
+# Taken before the other imports so the cold start report includes them
+_import_started = time.perf_counter()
+
+import asyncio
 import datetime
 import json
 import logging
-from typing import Any, Dict, Optional
+import math
+import threading
+from typing import Any, Dict, List, Optional, Tuple
 from urllib.parse import urlparse
 import azure.functions as func
 from azure.cosmos import CosmosClient, ContainerProxy
+from azure.cosmos.documents import ConnectionPolicy, RetryOptions
+from azure.cosmos.aio import CosmosClient as AsyncCosmosClient
 import os
-from azure.storage.blob import BlobServiceClient
 
-from shared.deployment_cosmos_db_dal import DeploymentCosmosDBDAL
+from shared.async_deployment_cosmos_db_dal import AsyncDeploymentCosmosDBDAL
+from shared.blob_client_registry import async_blob_client_registry, blob_client_registry
+from shared.blob_metadata_resolvers import BlobMetadataResolverChain, PathConventionResolver
+from shared.cold_start import ColdStartTimer
+from shared.content_hash import ContentHashVerifier
+from shared.document_cache import DocumentCache
+from shared.deployment_cosmos_db_dal import DeploymentCosmosDBDAL, FileHashStatus
+from shared.instrumentation import Instrumentation
+from shared.micro_batching import HashCoalescer, queue_depth, queue_lag_ms
+from shared.poison_events import ConfigurationError, FailedEvent, FailureKind, RedriveBuffer, classify_failure
+from shared.rate_governor import RateGovernor, RateLimitExceeded
+from shared.seen_hash_filter import SeenHashFilter
+
+cold_start = ColdStartTimer(started=_import_started)
 
-COSMOS_DB_ENDPOINT = os.environ["COSMOS_DB_ENDPOINT"]
-COSMOS_DB_KEY = os.environ["COSMOS_DB_KEY"]
+# Read here but only required when the Cosmos client is first built, so a misconfigured
+# slot still indexes its functions and fails on invocation with a clear error
+COSMOS_DB_ENDPOINT = os.environ.get("COSMOS_DB_ENDPOINT")
+COSMOS_DB_KEY = os.environ.get("COSMOS_DB_KEY")
 COSMOS_DATABASE_NAME = os.environ.get("COSMOS_DATABASE_NAME")
 COSMOS_DEPLOYMENTS_CONTAINER = os.environ.get("COSMOS_DEPLOYMENTS_DB_CONTAINER")
 COSMOS_CONFIG_CONTAINER = os.environ.get("COSMOS_CONFIG_DB_CONTAINER")
+# Optional blob path template, e.g. "{container}/{dep_id}/{hash}.{ext}", used to skip get_blob_properties
+BLOB_PATH_CONVENTION = os.environ.get("BLOB_PATH_CONVENTION")
+SEEN_HASHES_PER_DEPLOYMENT = int(os.environ.get("SEEN_HASHES_PER_DEPLOYMENT", "10000"))
+SEEN_HASH_DEPLOYMENTS = int(os.environ.get("SEEN_HASH_DEPLOYMENTS", "100"))
+# Approximate memory all the remembered hashes may use, about 200 bytes each
+SEEN_HASH_MAX_BYTES = int(os.environ.get("SEEN_HASH_MAX_BYTES", str(32 * 1024 * 1024)))
+METADATA_CACHE_SIZE = int(os.environ.get("METADATA_CACHE_SIZE", "1000"))
+METADATA_CACHE_TTL_SECONDS = float(os.environ.get("METADATA_CACHE_TTL_SECONDS", "30"))
+METADATA_CONDITIONAL_READS = os.environ.get("METADATA_CONDITIONAL_READS", "true").lower() == "true"
+# Maximum number of blob reads and deployment partitions handled at once by the async batch endpoint
+ASYNC_MAX_CONCURRENCY = int(os.environ.get("ASYNC_MAX_CONCURRENCY", "8"))
+# Number of recent observations kept per timing and request charge histogram
+INSTRUMENTATION_SAMPLES = int(os.environ.get("INSTRUMENTATION_SAMPLES", "1024"))
+# RU per second each deployment partition may use before calls wait, 0 leaves throttling to the SDK.
+# When set, the SDK's own throttle retries are turned off and 429s are retried by the governor.
+COSMOS_PARTITION_RU_BUDGET = float(os.environ.get("COSMOS_PARTITION_RU_BUDGET", "0"))
+COSMOS_RU_BURST_SECONDS = float(os.environ.get("COSMOS_RU_BURST_SECONDS", "1"))
+# Longest a call waits for budget or a throttle backoff before its events are deferred
+COSMOS_MAX_THROTTLE_WAIT_MS = float(os.environ.get("COSMOS_MAX_THROTTLE_WAIT_MS", "5000"))
+COSMOS_THROTTLE_RETRIES = int(os.environ.get("COSMOS_THROTTLE_RETRIES", "3"))
+# Event Hub receiving the Event Grid events for the micro-batching trigger, which is only
+# registered when this is set, and the app setting holding its connection string
+INGESTION_EVENT_HUB_NAME = os.environ.get("INGESTION_EVENT_HUB_NAME")
+INGESTION_EVENT_HUB_CONNECTION = os.environ.get("INGESTION_EVENT_HUB_CONNECTION", "EventHubConnection")
+# Size and time window after which the micro-batching trigger flushes the events it coalesced
+MICRO_BATCH_MAX_EVENTS = int(os.environ.get("MICRO_BATCH_MAX_EVENTS", "500"))
+MICRO_BATCH_MAX_WAIT_MS = float(os.environ.get("MICRO_BATCH_MAX_WAIT_MS", "1000"))
+# Directory of the redrive buffer and dead-letter files, a local stand-in for a blob container.
+# Defaults to $HOME/data, which on Premium and Dedicated plans is the app's file share: it
+# outlives the instance and is shared by every instance, unlike the temp directory
+POISON_EVENT_DIR = os.environ.get("POISON_EVENT_DIR", os.path.join(os.path.expanduser("~"), "data", "poison-events"))
+# Failures after which a transiently failing event is dead-lettered, and the backoff between its redrives
+REDRIVE_MAX_ATTEMPTS = int(os.environ.get("REDRIVE_MAX_ATTEMPTS", "5"))
+REDRIVE_BASE_BACKOFF_SECONDS = float(os.environ.get("REDRIVE_BASE_BACKOFF_SECONDS", "30"))
+REDRIVE_MAX_BACKOFF_SECONDS = float(os.environ.get("REDRIVE_MAX_BACKOFF_SECONDS", "3600"))
+# Events redriven per run of the redrive trigger, and its NCRONTAB schedule
+REDRIVE_BATCH_SIZE = int(os.environ.get("REDRIVE_BATCH_SIZE", "500"))
+REDRIVE_SCHEDULE = os.environ.get("REDRIVE_SCHEDULE", "0 */5 * * * *")
+# Recompute the digest of each blob and only register its hash metadata if it matches,
+# with the hashlib algorithm the uploader uses
+CONTENT_HASH_VERIFICATION = os.environ.get("CONTENT_HASH_VERIFICATION", "false").lower() == "true"
+CONTENT_HASH_ALGORITHM = os.environ.get("CONTENT_HASH_ALGORITHM", "sha256")
+# Larger blobs, e.g. videos, and blobs left out by the sampling rate are registered unverified
+CONTENT_HASH_MAX_BYTES = int(os.environ.get("CONTENT_HASH_MAX_BYTES", str(64 * 1024 * 1024)))
+CONTENT_HASH_SAMPLE_RATE = float(os.environ.get("CONTENT_HASH_SAMPLE_RATE", "1"))
+# Size of each ranged read, and the memory all the reads in flight may use, which sets how many run at once
+CONTENT_HASH_CHUNK_BYTES = int(os.environ.get("CONTENT_HASH_CHUNK_BYTES", str(4 * 1024 * 1024)))
+CONTENT_HASH_MAX_BUFFER_BYTES = int(os.environ.get("CONTENT_HASH_MAX_BUFFER_BYTES", str(16 * 1024 * 1024)))
+# Build the Cosmos client on a background thread as soon as the worker has imported the app
+COLD_START_PREWARM = os.environ.get("COLD_START_PREWARM", "true").lower() == "true"
+
+# Shared across invocations so per-deployment state (e.g. hash_count shard counts) stays warm
+seen_hashes = SeenHashFilter(
+    max_hashes_per_deployment=SEEN_HASHES_PER_DEPLOYMENT,
+    max_deployments=SEEN_HASH_DEPLOYMENTS,
+    max_bytes=SEEN_HASH_MAX_BYTES,
+)
+metadata_cache = DocumentCache(
+    max_size=METADATA_CACHE_SIZE,
+    ttl_seconds=METADATA_CACHE_TTL_SECONDS,
+)
+instrumentation = Instrumentation(max_samples=INSTRUMENTATION_SAMPLES)
+# Shared by the sync and async DALs, so both draw on the same partition budgets
+rate_governor = RateGovernor(
+    ru_per_second=COSMOS_PARTITION_RU_BUDGET,
+    burst_seconds=COSMOS_RU_BURST_SECONDS,
+    max_wait_ms=COSMOS_MAX_THROTTLE_WAIT_MS,
+    max_retries=COSMOS_THROTTLE_RETRIES,
+) if COSMOS_PARTITION_RU_BUDGET > 0 else None
+
+content_hash_verifier = ContentHashVerifier(
+    algorithm=CONTENT_HASH_ALGORITHM,
+    chunk_size=CONTENT_HASH_CHUNK_BYTES,
+    max_buffered_bytes=CONTENT_HASH_MAX_BUFFER_BYTES,
+    max_size_bytes=CONTENT_HASH_MAX_BYTES,
+    sample_rate=CONTENT_HASH_SAMPLE_RATE,
+) if CONTENT_HASH_VERIFICATION else None
+redrive_buffer = RedriveBuffer(
+    POISON_EVENT_DIR,
+    max_attempts=REDRIVE_MAX_ATTEMPTS,
+    base_backoff_s=REDRIVE_BASE_BACKOFF_SECONDS,
+    max_backoff_s=REDRIVE_MAX_BACKOFF_SECONDS,
+    instrumentation=instrumentation,
+)
+
+metadata_resolver = BlobMetadataResolverChain(
+    resolvers=[PathConventionResolver(BLOB_PATH_CONVENTION)] if BLOB_PATH_CONVENTION else [],
+    fallback=lambda blob_url, storage_account_name: extract_blob_metadata(blob_url, storage_account_name),
+    async_fallback=lambda blob_url, storage_account_name: extract_blob_metadata_async(blob_url, storage_account_name),
+)
+
+# The Cosmos clients are created on first use, or by the prewarm thread, and then reused.
+# The sync client reads the database account when it is constructed, a network round trip
+# that would otherwise hold up the import.
+_cosmos_lock = threading.Lock()
+deployment_dal: Optional[DeploymentCosmosDBDAL] = None
+# The aio client is bound to the worker's event loop, so it is created on first use from the async trigger.
+# It has a lock of its own, held only while the client object is built, so the event loop
+# never waits on the sync client's network round trip in the prewarm thread.
+_async_cosmos_lock = threading.Lock()
+async_deployment_dal: Optional[AsyncDeploymentCosmosDBDAL] = None
+
+def check_cosmos_settings():
+    """ Check the settings needed to connect to Cosmos DB are present.
+
+    Raises:
+        ConfigurationError: if COSMOS_DB_ENDPOINT or COSMOS_DB_KEY is not set
+    """
+    missing = [name for name, value in (("COSMOS_DB_ENDPOINT", COSMOS_DB_ENDPOINT), ("COSMOS_DB_KEY", COSMOS_DB_KEY)) if not value]
+    if missing:
+        raise ConfigurationError(f"Missing app settings: {', '.join(missing)}")
+
+def cosmos_client_options() -> Dict[str, Any]:
+    """ Keyword arguments for the Cosmos clients.
 
-client = CosmosClient(COSMOS_DB_ENDPOINT, COSMOS_DB_KEY)
-database = client.get_database_client(COSMOS_DATABASE_NAME)
-deployment_container: ContainerProxy = database.get_container_client(COSMOS_DEPLOYMENTS_CONTAINER)
-# config_container: ContainerProxy = database.get_container_client(COSMOS_CONFIG_CONTAINER)
+    With a rate governor the SDK does not retry throttled requests itself, the 429s
+    reaching the governor, which backs off the partition and bounds the wait. Otherwise
+    each governed call could wait out the SDK's retries (9 attempts, up to 30 s) first.
+    """
+    if rate_governor is None:
+        return {}
+    # retry_total=0 would be read as unset by the SDK, so the count goes in a policy
+    connection_policy = ConnectionPolicy()
+    connection_policy.RetryOptions = RetryOptions(max_retry_attempt_count=0, max_wait_time_in_seconds=0)
+    return {'connection_policy': connection_policy}
+
+def get_deployment_dal() -> DeploymentCosmosDBDAL:
+    """ Get the DAL of the deployments container, creating its Cosmos client on first use.
+
+    Safe to call from several threads at once, only one client is ever created.
+
+    Raises:
+        ConfigurationError: if the Cosmos DB settings are missing
+    """
+    global deployment_dal
+    dal = deployment_dal
+    if dal is None:
+        with _cosmos_lock:
+            if deployment_dal is None:
+                check_cosmos_settings()
+                with cold_start.measure('cosmos_client'):
+                    client = CosmosClient(COSMOS_DB_ENDPOINT, COSMOS_DB_KEY, **cosmos_client_options())
+                    container: ContainerProxy = client.get_database_client(COSMOS_DATABASE_NAME).get_container_client(COSMOS_DEPLOYMENTS_CONTAINER)
+                    # config_container: ContainerProxy = client.get_database_client(COSMOS_DATABASE_NAME).get_container_client(COSMOS_CONFIG_CONTAINER)
+                deployment_dal = DeploymentCosmosDBDAL(
+                    container=container,
+                    seen_hashes=seen_hashes,
+                    metadata_cache=metadata_cache,
+                    conditional_reads=METADATA_CONDITIONAL_READS,
+                    instrumentation=instrumentation,
+                    rate_governor=rate_governor,
+                )
+            dal = deployment_dal
+    return dal
+
+def get_async_deployment_dal() -> AsyncDeploymentCosmosDBDAL:
+    """ Get the async DAL, creating its aio Cosmos client on first use.
+
+    It shares the seen-hash filter and metadata cache with the synchronous DAL.
+
+    Raises:
+        ConfigurationError: if the Cosmos DB settings are missing
+    """
+    global async_deployment_dal
+    dal = async_deployment_dal
+    if dal is None:
+        with _async_cosmos_lock:
+            if async_deployment_dal is None:
+                check_cosmos_settings()
+                async_client = AsyncCosmosClient(COSMOS_DB_ENDPOINT, COSMOS_DB_KEY, **cosmos_client_options())
+                async_container = async_client.get_database_client(COSMOS_DATABASE_NAME).get_container_client(COSMOS_DEPLOYMENTS_CONTAINER)
+                async_deployment_dal = AsyncDeploymentCosmosDBDAL(
+                    container=async_container,
+                    seen_hashes=seen_hashes,
+                    metadata_cache=metadata_cache,
+                    conditional_reads=METADATA_CONDITIONAL_READS,
+                    instrumentation=instrumentation,
+                    rate_governor=rate_governor,
+                )
+            dal = async_deployment_dal
+    return dal
+
+def prewarm():
+    """ Build the Cosmos client and read the container properties, so the first
+    invocation finds the connection open. Failures are logged and left to the first
+    invocation to raise.
+    """
+    try:
+        with cold_start.measure('prewarm'):
+            get_deployment_dal().container.read()
+    except Exception as e:
+        logging.warning("Cold start prewarm failed: %s", e)
 
 app = func.FunctionApp()
 
+BLOB_CREATED_EVENT_TYPE = 'Microsoft.Storage.BlobCreated'
+SUBSCRIPTION_VALIDATION_EVENT_TYPE = 'Microsoft.EventGrid.SubscriptionValidationEvent'
+EVENT_STATUS_BY_FILE_HASH_STATUS = {
+    FileHashStatus.ADDED: 'succeeded',
+    FileHashStatus.DUPLICATE: 'duplicate',
+    FileHashStatus.FAILED: 'failed',
+}
+
 @app.function_name(name="eventgridtrigger1")
 @app.event_grid_trigger(arg_name="event")
 def test_function(event: func.EventGridEvent):
 
-    result = json.dumps({
+    logging.info(
+        'Python EventGrid trigger processed event %s: %s %s', event.id, event.event_type, event.subject,
+        extra={'event_id': event.id, 'event_type': event.event_type},
+    )
+
+    with cold_start.invocation(), instrumentation.invocation(events=1):
+        try:
+            with instrumentation.stage('resolve'):
+                resolved = resolve_file_hash(event.event_type, event.get_json())
+            if resolved is None:
+                return
+            deployment_id, filehash = resolved
+            dal = get_deployment_dal()
+            logging.debug("Adding metadata for deployment_id: %s, filehash: %s", deployment_id, filehash)
+            with instrumentation.stage('write'):
+                added = dal.add_file_hash(
+                    deployment_id=deployment_id,
+                    file_hash=filehash,
+                )
+            if added:
+                logging.info(
+                    "Added file hash %s for deployment_id: %s", filehash, deployment_id,
+                    extra={'event_id': event.id, 'deployment_id': deployment_id},
+                )
+            else:
+                logging.info(
+                    "File hash %s already registered for deployment_id: %s", filehash, deployment_id,
+                    extra={'event_id': event.id, 'deployment_id': deployment_id},
+                )
+
+        except Exception as e:
+            # Recorded for redrive or dead-lettered rather than raised, so the platform
+            # does not retry the invocation from scratch
+            result = {'id': event.id, 'status': 'failed', **failure_details(e)}
+            logging.log(
+                logging.WARNING if result['failure'] == FailureKind.TRANSIENT.value else logging.ERROR,
+                "Error processing blob event, %s failure: %s", result['failure'], e,
+                extra={'event_id': event.id, 'failure': result['failure']},
+            )
+            spill_failed_events("eventgridtrigger1", [event_grid_event_to_dict(event)], [result])
+
+@app.function_name(name="eventgridbatchtrigger")
+@app.route(route="eventgrid/batch", methods=["POST"], auth_level=func.AuthLevel.FUNCTION)
+def batch_function(req: func.HttpRequest) -> func.HttpResponse:
+    """ Event Grid webhook endpoint that receives events with batch delivery enabled.
+
+    The Python Event Grid trigger only binds a single event, so batches are delivered
+    to this HTTP endpoint instead. The response lists the outcome of every event.
+    """
+    with instrumentation.stage('parse'):
+        events, response = parse_event_grid_request(req)
+    if response is not None:
+        return response
+    with cold_start.invocation(), instrumentation.invocation(events=len(events)):
+        results = process_blob_created_events(events)
+    spill_failed_events("eventgridbatchtrigger", events, results)
+    return batch_response(events, results)
+
+@app.function_name(name="eventgridbatchtriggerasync")
+@app.route(route="eventgrid/batch/async", methods=["POST"], auth_level=func.AuthLevel.FUNCTION)
+async def batch_function_async(req: func.HttpRequest) -> func.HttpResponse:
+    """ The asyncio variant of batch_function, built on the azure.cosmos.aio and
+    azure.storage.blob.aio clients so blob reads and writes to different deployment
+    partitions overlap instead of blocking a worker thread.
+    """
+    with instrumentation.stage('parse'):
+        events, response = parse_event_grid_request(req)
+    if response is not None:
+        return response
+    with cold_start.invocation(), instrumentation.invocation(events=len(events)):
+        results = await process_blob_created_events_async(events)
+    spill_failed_events("eventgridbatchtriggerasync", events, results)
+    return batch_response(events, results)
+
+if INGESTION_EVENT_HUB_NAME:
+    @app.function_name(name="eventhubmicrobatchtrigger")
+    @app.retry(strategy="exponential_backoff", max_retry_count="5", minimum_interval="00:00:01", maximum_interval="00:00:30")
+    @app.event_hub_message_trigger(
+        arg_name="messages",
+        event_hub_name=INGESTION_EVENT_HUB_NAME,
+        connection=INGESTION_EVENT_HUB_CONNECTION,
+        cardinality=func.Cardinality.MANY,
+    )
+    async def micro_batch_function(messages: List[func.EventHubEvent], context: func.Context):
+        """ Event Hub trigger receiving Event Grid events in batches sized by host.json,
+        coalescing them per deployment before they are written.
+
+        Deferred events rerun the batch under the retry policy. Failed events are
+        spilled to the redrive buffer once no rerun follows, along with the deferred
+        ones if the retries are used up, so a rerun does not spill them again.
+        """
+        events, results = await process_event_hub_messages(messages)
+        retry_context = context.retry_context
+        last_attempt = retry_context is None or retry_context.retry_count >= retry_context.max_retry_count
+        failed = sum(1 for result in results if result['status'] == 'failed')
+        deferred = [result for result in results if result['status'] == 'deferred']
+        if not deferred or last_attempt:
+            spill_failed_events("eventhubmicrobatchtrigger", events, results, include_deferred=last_attempt)
+        logging.info(
+            "Processed %d Event Hub messages with %d events, %d failed, %d deferred",
+            len(messages), len(results), failed, len(deferred),
+            extra={'messages': len(messages), 'events': len(results), 'failed': failed, 'deferred': len(deferred)},
+        )
+        if deferred and not last_attempt:
+            # Rerun the batch under the retry policy, the hashes already written come back as duplicates
+            raise RateLimitExceeded(
+                f"{len(deferred)} events deferred by the Cosmos DB rate governor",
+                retry_after_ms=max(result['retry_after_ms'] for result in deferred),
+            )
+
+@app.function_name(name="redrivetrigger")
+@app.timer_trigger(arg_name="timer", schedule=REDRIVE_SCHEDULE)
+def redrive_function(timer: func.TimerRequest):
+    """ Redrive the events buffered after a transient failure, REDRIVE_BATCH_SIZE at a time. """
+    with cold_start.invocation():
+        summary = redrive_failed_events(REDRIVE_BATCH_SIZE)
+    logging.info(
+        "Redrove %d buffered events, %d failed again", summary['redriven'], summary['failed'],
+        extra=summary,
+    )
+
+@app.function_name(name="redrive")
+@app.route(route="redrive", methods=["POST"], auth_level=func.AuthLevel.FUNCTION)
+def redrive_http_function(req: func.HttpRequest) -> func.HttpResponse:
+    """ Redrive the due buffered events now. With replay_dead_letters=true the dead
+    letters are first moved back into the buffer, e.g. once the cause of their failure is fixed.
+    """
+    try:
+        max_events = int(req.params.get('max_events', REDRIVE_BATCH_SIZE))
+    except ValueError:
+        max_events = 0
+    if max_events < 1:
+        return func.HttpResponse("max_events must be a positive integer", status_code=400)
+    replayed = 0
+    if req.params.get('replay_dead_letters', '').lower() == 'true':
+        replayed = redrive_buffer.replay_dead_letters()
+    with cold_start.invocation():
+        summary = redrive_failed_events(max_events)
+    return func.HttpResponse(json.dumps({'replayed': replayed, **summary}), mimetype="application/json")
+
+@app.function_name(name="metrics")
+@app.route(route="metrics", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def metrics_function(req: func.HttpRequest) -> func.HttpResponse:
+    """ Dump the in-process stage timings, request charges and cache statistics of this worker. """
+    return func.HttpResponse(json.dumps(get_metrics()), mimetype="application/json")
+
+def get_metrics() -> Dict[str, Any]:
+    """ Get the instrumentation snapshot along with the resolver and cache statistics,
+    and the cold start timings of this worker. """
+    metrics = instrumentation.snapshot()
+    metrics.update(
+        cold_start=cold_start.report(),
+        metadata_resolver=metadata_resolver.get_stats(),
+        seen_hashes=seen_hashes.get_stats(),
+        metadata_cache=metadata_cache.get_stats(),
+        rate_governor=rate_governor.get_stats() if rate_governor else None,
+        poison_events=redrive_buffer.get_stats(),
+        content_hash=content_hash_verifier.get_stats() if content_hash_verifier else None,
+    )
+    return metrics
+
+def failure_details(error: Exception) -> Dict[str, Any]:
+    """ Get the error fields of a failed event result, with the failure classified as
+    'transient' or 'permanent' by classify_failure. """
+    return {'error': str(error), 'error_type': type(error).__name__, 'failure': classify_failure(error).value}
+
+def event_grid_event_to_dict(event: func.EventGridEvent) -> Dict[str, Any]:
+    """ Get an event bound by the Event Grid trigger back in the Event Grid schema. """
+    return {
         'id': event.id,
-        'data': event.get_json(),
         'topic': event.topic,
         'subject': event.subject,
-        'event_type': event.event_type,
-    })
+        'eventType': event.event_type,
+        'eventTime': event.event_time.isoformat() if event.event_time else None,
+        'dataVersion': event.data_version,
+        'data': event.get_json(),
+    }
 
-    logging.info('Python EventGrid trigger processed an event: %s', result)
+def spill_failed_events(
+    source: str, events: List[Dict[str, Any]], results: List[Dict[str, Any]], include_deferred: bool = False
+) -> int:
+    """ Record the failed events of a batch in the redrive buffer, which dead-letters the
+    permanent failures, so none is lost or retried with the whole batch.
 
-    try:
-        # Parse event data
-        event_data = event.get_json()
-        
-        # Extract information from event
-        blob_url = event_data.get('url', '')
-        event_type = event.event_type
-        
-        # Only process blob creation events
-        if event_type != 'Microsoft.Storage.BlobCreated':
-            logging.info(f"Ignoring event type: {event_type}")
-            return
-        
-        # Extract storage account name from URL
-        storage_account_name = blob_url.split('//')[1].split('.')[0]
-        container_name = extract_container_name(blob_url)
-        logging.info(f"Processing blob from storage account: {storage_account_name}, container: {container_name}, event: {event_data}")
-        
-        # Extract blob metadata
-        metadata = extract_blob_metadata(
-            blob_url=blob_url,
-            storage_account_name=storage_account_name
+    Args:
+        source (str): the name of the function that processed the events
+        events (list[dict]): the events in the Event Grid schema
+        results (list[dict]): the result of every event, see process_blob_created_events
+        include_deferred (bool): spill the events deferred by the rate governor as well
+
+    Returns:
+        int: the number of events spilled
+    """
+    now_ms = int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000)
+    failed_events = [
+        FailedEvent(
+            event=event,
+            source=source,
+            kind=FailureKind(result.get('failure', FailureKind.TRANSIENT.value)),
+            error=result.get('error', ''),
+            error_type=result.get('error_type', ''),
+            first_failed_ms=now_ms,
+            failed_ms=now_ms,
+            deployment_id=result.get('deployment_id'),
+            file_hash=result.get('file_hash'),
         )
-        # If metadata extraction failed, log and return
-        if metadata is None:
-            logging.error(f"Failed to extract metadata for blob: {blob_url}")
-            return
-        logging.info(f"Extracted metadata: {json.dumps(metadata, indent=2)}")
-        # Initialize DAL
-        dal = DeploymentCosmosDBDAL(
-            container=deployment_container
+        for event, result in zip(events, results)
+        if result['status'] == 'failed' or (include_deferred and result['status'] == 'deferred')
+    ]
+    redrive_buffer.record(failed_events)
+    return len(failed_events)
+
+def redrive_failed_events(max_events: int) -> Dict[str, Any]:
+    """ Reprocess a batch of the events buffered after a transient failure.
+
+    The events are written with process_blob_created_events, grouped by deployment.
+    Those failing again are buffered with a longer backoff, or dead-lettered once
+    permanent or out of attempts.
+
+    Args:
+        max_events (int): the largest number of events to redrive
+
+    Returns:
+        dict: the number of events redriven, failing again, and per status
+    """
+    with redrive_buffer.due(max_events) as failed_events:
+        if not failed_events:
+            return {'redriven': 0, 'failed': 0, 'statuses': {}}
+        events = [failed_event.event for failed_event in failed_events]
+        with instrumentation.invocation(events=len(events)):
+            results = process_blob_created_events(events)
+        now_ms = int(datetime.datetime.now(datetime.timezone.utc).timestamp() * 1000)
+        failed_again = []
+        for failed_event, result in zip(failed_events, results):
+            if result['status'] not in ('failed', 'deferred'):
+                continue
+            failed_event.attempts += 1
+            failed_event.failed_ms = now_ms
+            failed_event.error = result.get('error', '')
+            failed_event.error_type = result.get('error_type', '')
+            failed_event.kind = FailureKind(result.get('failure', FailureKind.TRANSIENT.value))
+            failed_again.append(failed_event)
+        redrive_buffer.record(failed_again)
+    statuses: Dict[str, int] = {}
+    for result in results:
+        statuses[result['status']] = statuses.get(result['status'], 0) + 1
+    return {'redriven': len(events), 'failed': len(failed_again), 'statuses': statuses}
+
+def parse_event_grid_request(req: func.HttpRequest) -> Tuple[List[Dict[str, Any]], Optional[func.HttpResponse]]:
+    """ Read the events of an Event Grid webhook request.
+
+    Args:
+        req (func.HttpRequest): the webhook request
+
+    Returns:
+        tuple[list[dict], func.HttpResponse]: the events, and the response to send
+            straight away for invalid requests and subscription validation, if any
+    """
+    try:
+        events = req.get_json()
+    except ValueError:
+        return [], func.HttpResponse("Request body must be a JSON array of events", status_code=400)
+    if isinstance(events, dict):
+        events = [events]
+
+    # Answer the Event Grid subscription validation handshake
+    for event in events:
+        if event.get('eventType') == SUBSCRIPTION_VALIDATION_EVENT_TYPE:
+            validation_code = event.get('data', {}).get('validationCode')
+            return events, func.HttpResponse(
+                json.dumps({'validationResponse': validation_code}),
+                mimetype="application/json",
+            )
+    return events, None
+
+def batch_response(events: List[Dict[str, Any]], results: List[Dict[str, Any]]) -> func.HttpResponse:
+    """ Log a summary of a processed batch and build the webhook response.
+
+    If the rate governor deferred any event the response is a 429 with a Retry-After,
+    so Event Grid redelivers the batch, the hashes already written coming back as duplicates.
+    """
+    failed = sum(1 for result in results if result['status'] == 'failed')
+    deferred = [result for result in results if result['status'] == 'deferred']
+    logging.info(
+        "Processed batch of %d events, %d failed, %d deferred", len(events), failed, len(deferred),
+        extra={'events': len(events), 'failed': failed, 'deferred': len(deferred)},
+    )
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("Batch metrics: %s", json.dumps(get_metrics()))
+    if deferred:
+        retry_after_s = math.ceil(max(result['retry_after_ms'] for result in deferred) / 1000)
+        return func.HttpResponse(
+            json.dumps(results), status_code=429, mimetype="application/json",
+            headers={'Retry-After': str(max(retry_after_s, 1))},
         )
-        # Add metadata to Cosmos DB
-        deployment_id = metadata.get('metadata', {}).get('dep_id')
-        filehash = metadata.get('metadata', {}).get('hash')
+    return func.HttpResponse(json.dumps(results), mimetype="application/json")
+
+def process_blob_created_events(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """ Register the file hashes of a batch of Event Grid events, grouped by deployment.
+
+    Args:
+        events (list[dict]): the events in the Event Grid schema
+
+    Returns:
+        list[dict]: one result per event with the event id and a status of
+            'succeeded', 'duplicate', 'failed', 'deferred' or 'ignored'. Failed results
+            carry the error and whether the failure is 'transient' or 'permanent'.
+    """
+    resolved = []
+    for event in events:
         try:
-            deployment_id = int(deployment_id) if deployment_id else None
-        except ValueError:
-            logging.error(f"Invalid deployment_id: {deployment_id}. Must be an integer.")
-            return
-        if not deployment_id or not filehash:
-            logging.error(f"Missing deployment_id or filehash in metadata: {metadata.get('metadata', {})}")
+            with instrumentation.stage('resolve'):
+                resolved.append(resolve_file_hash(event.get('eventType'), event.get('data') or {}))
+        except Exception as e:
+            resolved.append(e)
+    results, by_deployment = group_resolved_events(events, resolved)
+
+    for deployment_id, deployment_results in by_deployment.items():
+        try:
+            # Inside the try, so missing settings fail the events for redrive instead of the batch
+            dal = get_deployment_dal()
+            with instrumentation.stage('write'):
+                added = dal.add_file_hashes(
+                    deployment_id=deployment_id,
+                    file_hashes=[result['file_hash'] for result in deployment_results],
+                )
+        except Exception as e:
+            added = e
+        record_file_hash_results(deployment_id, deployment_results, added)
+    return results
+
+async def process_event_hub_messages(messages: List[Any]) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """ Register the file hashes of a batch of Event Hub messages holding Event Grid events.
+
+    The queue depth behind the batch and the time each message waited in the queue are
+    recorded as 'micro_batch.queue_depth' and 'micro_batch.queue_lag.ms'.
+
+    Args:
+        messages (list[func.EventHubEvent]): the messages, or the QueuedEvents of a
+            LocalEventQueue, each holding one event or a JSON array of events
+
+    Returns:
+        tuple[list[dict], list[dict]]: the events, and one result per event as returned
+            by process_blob_created_events. Messages that are not JSON come last, as
+            events holding the raw body with a permanently failed result.
+    """
+    depth = queue_depth(messages)
+    if depth is not None:
+        instrumentation.observe('micro_batch.queue_depth', depth)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    events = []
+    invalid_events, invalid_results = [], []
+    with instrumentation.stage('parse'):
+        for message in messages:
+            lag_ms = queue_lag_ms(message, now)
+            if lag_ms is not None:
+                instrumentation.observe('micro_batch.queue_lag.ms', lag_ms)
+            try:
+                body = json.loads(message.get_body())
+            except ValueError as e:
+                instrumentation.increment('micro_batch.invalid_messages')
+                logging.error(
+                    "Invalid Event Hub message %s: %s", message.sequence_number, e,
+                    extra={'sequence_number': message.sequence_number},
+                )
+                # Failed like an event, so it is dead-lettered when the batch is spilled
+                invalid_events.append({'sequence_number': message.sequence_number, 'body': message.get_body().decode('utf-8', 'replace')})
+                invalid_results.append({'id': None, 'status': 'failed', **failure_details(e), 'failure': FailureKind.PERMANENT.value})
+                continue
+            events.extend(body if isinstance(body, list) else [body])
+    with cold_start.invocation(), instrumentation.invocation(events=len(events)):
+        results = await process_blob_created_events_coalesced(events)
+    return events + invalid_events, results + invalid_results
+
+async def process_blob_created_events_coalesced(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """ The micro-batching variant of process_blob_created_events_async.
+
+    Events are coalesced per deployment as soon as they are resolved, and the coalesced
+    hashes are written whenever MICRO_BATCH_MAX_EVENTS events or MICRO_BATCH_MAX_WAIT_MS
+    have accumulated, with one add_file_hashes call per deployment. Whatever is left is
+    written before returning. A hash repeated within a flush is written once, its first
+    event reporting the outcome and the later ones reported as duplicates.
+
+    Args:
+        events (list[dict]): the events in the Event Grid schema
+
+    Returns:
+        list[dict]: one result per event, as returned by process_blob_created_events
+    """
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+    coalescer = HashCoalescer(MICRO_BATCH_MAX_EVENTS, MICRO_BATCH_MAX_WAIT_MS, instrumentation=instrumentation)
+    results = [{'id': event.get('id'), 'status': 'ignored'} for event in events]
+    # Events are coalesced as they resolve, their results are put back in event order when recorded
+    positions = {id(result): index for index, result in enumerate(results)}
+
+    async def resolve(index: int, event: Dict[str, Any]):
+        async with semaphore:
+            try:
+                with instrumentation.stage('resolve'):
+                    return index, await resolve_file_hash_async(event.get('eventType'), event.get('data') or {})
+            except Exception as e:
+                return index, e
+
+    async def flush():
+        batch = coalescer.drain()
+        if not batch.file_hashes:
             return
-        logging.info(f"Adding metadata for deployment_id: {deployment_id}, filehash: {filehash}")
-        dal.add_file_hash(
-            deployment_id=deployment_id,
-            file_hash=filehash,
-        )
-        logging.info(f"Successfully added metadata")
+        with instrumentation.stage('flush'):
+            outcomes = await add_file_hashes_by_deployment_async(batch.file_hashes)
+        for deployment_id, deployment_results in batch.items.items():
+            deployment_results = sorted(deployment_results, key=lambda result: positions[id(result)])
+            record_file_hash_results(deployment_id, deployment_results, outcomes[deployment_id])
+
+    for resolution in asyncio.as_completed([resolve(index, event) for index, event in enumerate(events)]):
+        index, resolved = await resolution
+        result = results[index]
+        if isinstance(resolved, Exception):
+            result.update(status='failed', **failure_details(resolved))
+            continue
+        if resolved is None:
+            continue
+        deployment_id, filehash = resolved
+        result.update(deployment_id=deployment_id, file_hash=filehash)
+        coalescer.add(deployment_id, filehash, result)
+        if coalescer.is_due():
+            await flush()
+    await flush()
+    return results
+
+async def process_blob_created_events_async(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """ The asyncio variant of process_blob_created_events.
+
+    Blob metadata is resolved concurrently, then different deployment partitions are
+    written concurrently while the batches of each deployment stay in order. Both
+    stages are limited to ASYNC_MAX_CONCURRENCY operations in flight.
+
+    Args:
+        events (list[dict]): the events in the Event Grid schema
+
+    Returns:
+        list[dict]: one result per event, as returned by process_blob_created_events
+    """
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+
+    async def resolve(event: Dict[str, Any]):
+        async with semaphore:
+            with instrumentation.stage('resolve'):
+                return await resolve_file_hash_async(event.get('eventType'), event.get('data') or {})
+
+    resolved = await asyncio.gather(*(resolve(event) for event in events), return_exceptions=True)
+    results, by_deployment = group_resolved_events(events, resolved)
+
+    with instrumentation.stage('write'):
+        outcomes = await add_file_hashes_by_deployment_async({
+            deployment_id: [result['file_hash'] for result in deployment_results]
+            for deployment_id, deployment_results in by_deployment.items()
+        })
+    for deployment_id, deployment_results in by_deployment.items():
+        record_file_hash_results(deployment_id, deployment_results, outcomes[deployment_id])
+    return results
+
+async def add_file_hashes_by_deployment_async(file_hashes_by_deployment: Dict[int, List[str]]) -> Dict[int, Any]:
+    """ Add the file hashes of many deployments with the async DAL.
+
+    If the DAL cannot be built, e.g. because the Cosmos DB settings are missing, the
+    error is the outcome of every deployment, so their events fail for redrive
+    instead of the whole batch failing.
+
+    Args:
+        file_hashes_by_deployment (dict[int, list[str]]): the file hashes to add per deployment
 
-            
+    Returns:
+        dict[int, FileHashResults | Exception]: per deployment, the outcome of each file
+            hash or the exception that stopped it
+    """
+    try:
+        dal = get_async_deployment_dal()
     except Exception as e:
-        logging.error(f"Error processing blob event: {str(e)}")
-        raise
+        return {deployment_id: e for deployment_id in file_hashes_by_deployment}
+    return await dal.add_file_hashes_by_deployment(file_hashes_by_deployment, max_concurrency=ASYNC_MAX_CONCURRENCY)
+
+def group_resolved_events(
+    events: List[Dict[str, Any]], resolved: List[Any]
+) -> Tuple[List[Dict[str, Any]], Dict[int, List[Dict[str, Any]]]]:
+    """ Build the per-event results and group the resolvable ones by deployment.
+
+    Args:
+        events (list[dict]): the events in the Event Grid schema
+        resolved (list): for each event, its (deployment_id, file_hash), None if it is
+            ignored, or the exception raised while resolving it
+
+    Returns:
+        tuple[list[dict], dict[int, list[dict]]]: the result of every event, and the
+            results still to be written grouped by deployment id
+    """
+    results = []
+    by_deployment: Dict[int, List[Dict[str, Any]]] = {}
+    for event, resolution in zip(events, resolved):
+        result = {'id': event.get('id'), 'status': 'ignored'}
+        results.append(result)
+        if isinstance(resolution, Exception):
+            result.update(status='failed', **failure_details(resolution))
+            continue
+        if resolution is None:
+            continue
+        deployment_id, filehash = resolution
+        result.update(deployment_id=deployment_id, file_hash=filehash)
+        by_deployment.setdefault(deployment_id, []).append(result)
+    return results, by_deployment
+
+def record_file_hash_results(deployment_id: int, deployment_results: List[Dict[str, Any]], added: Any):
+    """ Copy the outcome of adding a deployment's file hashes onto its event results.
+
+    Args:
+        deployment_id (int): the id of the deployment
+        deployment_results (list[dict]): the results of the deployment's events, in event order
+        added (FileHashResults | Exception): the outcome of each file hash, or the
+            exception that stopped the deployment
+    """
+    if isinstance(added, RateLimitExceeded):
+        logging.warning(
+            "Deferring file hashes for deployment_id: %s: %s", deployment_id, added,
+            extra={'deployment_id': deployment_id, 'events': len(deployment_results)},
+        )
+        for result in deployment_results:
+            result.update(status='deferred', error=str(added), retry_after_ms=added.retry_after_ms)
+        return
+    if isinstance(added, Exception):
+        logging.error(
+            "Error adding file hashes for deployment_id: %s: %s", deployment_id, added,
+            extra={'deployment_id': deployment_id, 'events': len(deployment_results)},
+        )
+        for result in deployment_results:
+            result.update(status='failed', **failure_details(added))
+        return
+    # Only the first event of a hash repeated in the batch added it, the later ones are duplicates
+    recorded = set()
+    for result in deployment_results:
+        status = added[result['file_hash']]
+        if status is FileHashStatus.ADDED and result['file_hash'] in recorded:
+            status = FileHashStatus.DUPLICATE
+        recorded.add(result['file_hash'])
+        result['status'] = EVENT_STATUS_BY_FILE_HASH_STATUS[status]
+        if result['file_hash'] in added.errors:
+            result.update(failure_details(added.errors[result['file_hash']]))
+
+def resolve_file_hash(event_type: str, event_data: Dict[str, Any]) -> Optional[Tuple[int, str]]:
+    """ Resolve the deployment id and file hash of the blob an event refers to.
+
+    Args:
+        event_type (str): the Event Grid event type
+        event_data (dict): the event data payload
+
+    Returns:
+        tuple[int, str]: the deployment id and file hash, or None if the event is not a blob creation
+
+    Raises:
+        ValueError: if the blob metadata is missing or invalid
+        ContentHashMismatch: if content hash verification is on and the blob content
+            does not match its hash, only checked for hashes not known to be stored
+    """
+    blob = parse_blob_created_event(event_type, event_data)
+    if blob is None:
+        return None
+    blob_url, storage_account_name = blob
+
+    # Resolve blob metadata, only reading the blob properties when the event is not enough
+    metadata = metadata_resolver.resolve(
+        blob_url=blob_url,
+        storage_account_name=storage_account_name,
+        event_data=event_data,
+    )
+    deployment_id, filehash = file_hash_from_metadata(blob_url, metadata)
+    if needs_content_verification(deployment_id, filehash):
+        with instrumentation.stage('verify'):
+            verify_content_hash(blob_url, storage_account_name, filehash, metadata.get('size'))
+    return deployment_id, filehash
+
+async def resolve_file_hash_async(event_type: str, event_data: Dict[str, Any]) -> Optional[Tuple[int, str]]:
+    """ The asyncio variant of resolve_file_hash. """
+    blob = parse_blob_created_event(event_type, event_data)
+    if blob is None:
+        return None
+    blob_url, storage_account_name = blob
+    metadata = await metadata_resolver.resolve_async(
+        blob_url=blob_url,
+        storage_account_name=storage_account_name,
+        event_data=event_data,
+    )
+    deployment_id, filehash = file_hash_from_metadata(blob_url, metadata)
+    if needs_content_verification(deployment_id, filehash):
+        with instrumentation.stage('verify'):
+            await verify_content_hash_async(blob_url, storage_account_name, filehash, metadata.get('size'))
+    return deployment_id, filehash
+
+def needs_content_verification(deployment_id: int, file_hash: str) -> bool:
+    """ Whether the content of a blob should be checked against its hash.
+
+    A hash the seen-hash filter knows is already stored is a duplicate, whose event adds
+    nothing, so its blob is not read.
+    """
+    return content_hash_verifier is not None and not seen_hashes.contains(deployment_id, file_hash, record=False)
+
+def verify_content_hash(blob_url: str, storage_account_name: str, file_hash: str, size: Optional[int]):
+    """ Check the content of a blob against its hash metadata with content_hash_verifier,
+    streaming it in ranged reads through the cached container client.
+
+    Args:
+        blob_url (str): the url of the blob
+        storage_account_name (str): the name of the storage account
+        file_hash (str): the hash from the blob metadata
+        size (int): the size of the blob, None to read it from the blob properties if needed
+
+    Raises:
+        ContentHashMismatch: if the blob content does not match the hash
+    """
+    container_client = blob_client_registry.get_container_client(storage_account_name, extract_container_name(blob_url))
+    blob_client = container_client.get_blob_client(blob_url.split('/')[-1])
+    outcome = content_hash_verifier.verify(
+        file_hash,
+        lambda offset, length: blob_client.download_blob(offset=offset, length=length).readall(),
+        size=size,
+        read_size=lambda: blob_client.get_blob_properties().size,
+    )
+    logging.debug("Content hash of %s: %s", blob_url, outcome.value)
+
+async def verify_content_hash_async(blob_url: str, storage_account_name: str, file_hash: str, size: Optional[int]):
+    """ The asyncio variant of verify_content_hash, using the cached aio container client. """
+    container_client = async_blob_client_registry.get_container_client(storage_account_name, extract_container_name(blob_url))
+    blob_client = container_client.get_blob_client(blob_url.split('/')[-1])
+
+    async def read_range(offset: int, length: int) -> bytes:
+        downloader = await blob_client.download_blob(offset=offset, length=length)
+        return await downloader.readall()
+
+    async def read_size() -> int:
+        return (await blob_client.get_blob_properties()).size
+
+    outcome = await content_hash_verifier.verify_async(file_hash, read_range, size=size, read_size=read_size)
+    logging.debug("Content hash of %s: %s", blob_url, outcome.value)
+
+def parse_blob_created_event(event_type: str, event_data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    """ Get the blob url and storage account of a blob creation event.
+
+    Args:
+        event_type (str): the Event Grid event type
+        event_data (dict): the event data payload
+
+    Returns:
+        tuple[str, str]: the blob url and storage account name, or None for other event types
+    """
+    # Extract information from event
+    blob_url = event_data.get('url', '')
+
+    # Only process blob creation events
+    if event_type != BLOB_CREATED_EVENT_TYPE:
+        logging.debug("Ignoring event type: %s", event_type)
+        return None
+
+    # Extract storage account name from URL
+    storage_account_name = blob_url.split('//')[1].split('.')[0]
+    container_name = extract_container_name(blob_url)
+    logging.debug("Processing blob from storage account: %s, container: %s, event: %s", storage_account_name, container_name, event_data)
+    return blob_url, storage_account_name
+
+def file_hash_from_metadata(blob_url: str, metadata: Optional[Dict[str, Any]]) -> Tuple[int, str]:
+    """ Get the deployment id and file hash out of resolved blob metadata.
+
+    Args:
+        blob_url (str): the url of the blob
+        metadata (dict): the resolved blob metadata, None if it could not be resolved
+
+    Returns:
+        tuple[int, str]: the deployment id and file hash
+
+    Raises:
+        ValueError: if the blob metadata is missing or invalid
+    """
+    # If metadata extraction failed, log and return
+    if metadata is None:
+        raise ValueError(f"Failed to extract metadata for blob: {blob_url}")
+    logging.debug("Extracted metadata: %s", metadata)
+    deployment_id = metadata.get('metadata', {}).get('dep_id')
+    filehash = metadata.get('metadata', {}).get('hash')
+    try:
+        deployment_id = int(deployment_id) if deployment_id else None
+    except ValueError:
+        raise ValueError(f"Invalid deployment_id: {deployment_id}. Must be an integer.")
+    if not deployment_id or not filehash:
+        raise ValueError(f"Missing deployment_id or filehash in metadata: {metadata.get('metadata', {})}")
+    return deployment_id, filehash
     
 def extract_container_name(blob_url: str) -> str:
     path_parts = urlparse(blob_url).path.strip('/').split('/')
@@ -98,43 +943,68 @@ def extract_container_name(blob_url: str) -> str:
     return '/'.join(path_parts[:2])
 
 def extract_blob_metadata(blob_url: str, storage_account_name: str) -> Optional[Dict[str, Any]]:
-    """Extract metadata from blob using the configured connection string."""
-    try:        
-        connection_string = os.environ.get(f"CONNECTION_STRING")
-        
+    """Extract metadata from blob using the storage account's cached container client."""
+    try:
         # Parse blob URL to get container and blob name
         url_parts = blob_url.split('/')
         container_name = extract_container_name(blob_url)
-        logging.info(f"Margaux - Extracted container name: {container_name} from blob URL: {blob_url}")
+        logging.debug("Extracted container name: %s from blob URL: %s", container_name, blob_url)
         blob_name = url_parts[-1]
         
-        # Get blob client
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        blob_client = blob_service_client.get_blob_client(container=container_name, blob=blob_name)
+        # Get blob client, reusing the pooled client for this account and container
+        container_client = blob_client_registry.get_container_client(storage_account_name, container_name)
+        blob_client = container_client.get_blob_client(blob_name)
         
         # Get blob properties
         properties = blob_client.get_blob_properties()
         
-        logging.info(f"margaux - Retrieved properties for blob: {blob_name} in container: {container_name}, metadata: {dict(properties.metadata) if properties.metadata else {}}")
-        
-        metadata = {
-            'storage_account_name': storage_account_name,
-            'container_name': container_name,
-            'blob_name': blob_name,
-            'blob_url': blob_url,
-            'size': properties.size,
-            'content_type': properties.content_settings.content_type,
-            # 'etag': properties.etag,
-            # 'last_modified': properties.last_modified.isoformat() if properties.last_modified else None,
-            # 'creation_time': properties.creation_time.isoformat() if properties.creation_time else None,
-            # 'content_md5': properties.content_settings.content_md5.decode('utf-8') if properties.content_settings.content_md5 else None,
-            'metadata': dict(properties.metadata) if properties.metadata else {},
-        }
-        logging.info(f"Extracted metadata: {json.dumps(metadata, indent=2)}")
-        
-        return metadata
+        return blob_properties_to_metadata(blob_url, storage_account_name, container_name, blob_name, properties)
         
     except Exception as e:
-        logging.error(f"Error extracting blob metadata: {str(e)}")
+        logging.error("Error extracting blob metadata for %s: %s", blob_url, e, extra={'blob_url': blob_url})
+        # A storage outage fails the event for redrive instead of as missing metadata
+        if classify_failure(e) is FailureKind.TRANSIENT:
+            raise
+        return None
+
+async def extract_blob_metadata_async(blob_url: str, storage_account_name: str) -> Optional[Dict[str, Any]]:
+    """The asyncio variant of extract_blob_metadata, using the cached aio container client."""
+    try:
+        container_name = extract_container_name(blob_url)
+        blob_name = blob_url.split('/')[-1]
+        container_client = async_blob_client_registry.get_container_client(storage_account_name, container_name)
+        properties = await container_client.get_blob_client(blob_name).get_blob_properties()
+        return blob_properties_to_metadata(blob_url, storage_account_name, container_name, blob_name, properties)
+    except Exception as e:
+        logging.error("Error extracting blob metadata for %s: %s", blob_url, e, extra={'blob_url': blob_url})
+        if classify_failure(e) is FailureKind.TRANSIENT:
+            raise
         return None
-    
\ No newline at end of file
+
+def blob_properties_to_metadata(
+    blob_url: str, storage_account_name: str, container_name: str, blob_name: str, properties: Any
+) -> Dict[str, Any]:
+    """ Build the blob metadata dictionary from the blob's properties. """
+    logging.debug("Retrieved properties for blob: %s in container: %s, metadata: %s", blob_name, container_name, properties.metadata)
+
+    metadata = {
+        'storage_account_name': storage_account_name,
+        'container_name': container_name,
+        'blob_name': blob_name,
+        'blob_url': blob_url,
+        'size': properties.size,
+        'content_type': properties.content_settings.content_type,
+        # 'etag': properties.etag,
+        # 'last_modified': properties.last_modified.isoformat() if properties.last_modified else None,
+        # 'creation_time': properties.creation_time.isoformat() if properties.creation_time else None,
+        # 'content_md5': properties.content_settings.content_md5.decode('utf-8') if properties.content_settings.content_md5 else None,
+        'metadata': dict(properties.metadata) if properties.metadata else {},
+    }
+    logging.debug("Extracted metadata: %s", metadata)
+
+    return metadata
+    
+
+cold_start.imported()
+if COLD_START_PREWARM:
+    threading.Thread(target=prewarm, name="cosmos-prewarm", daemon=True).start()
@@ -0,0 +1,259 @@
+# shared/async_cosmos_db_dal.py
+# A base class for interacting with Cosmos DB through the asyncio SDK.
+
+import asyncio
+import logging
+from contextlib import nullcontext
+from typing import Awaitable, Callable, Optional
+from azure.core import MatchConditions
+from azure.cosmos import exceptions
+from azure.cosmos.aio import ContainerProxy
+
+from shared.cosmos_db_dal import build_partition_query, chain_response_hooks, query_scope
+from shared.instrumentation import Instrumentation
+from shared.rate_governor import RateGovernor
+
+logger = logging.getLogger(__name__)
+
+class AsyncBaseCosmosDBDAL:
+    # The document field holding the partition key, used to attribute request charges
+    partition_key_field: Optional[str] = None
+
+    def __init__(
+        self,
+        container: ContainerProxy,
+        instrumentation: Optional[Instrumentation] = None,
+        rate_governor: Optional[RateGovernor] = None,
+    ):
+        """ Initializes the Cosmos DB DAL with an azure.cosmos.aio container client.
+
+        Args:
+            container (ContainerProxy): the azure.cosmos.aio container client
+            instrumentation (Instrumentation): optional collector of latencies and request charges
+            rate_governor (RateGovernor): optional per-partition RU budget, retrying throttled calls
+        """
+        self.container = container
+        self.instrumentation = instrumentation
+        self.rate_governor = rate_governor
+
+    def _item_partition_key(self, item: dict):
+        """ Returns the partition key of a document, None if partition_key_field is not set. """
+        return item.get(self.partition_key_field) if self.partition_key_field else None
+
+    def _track(self, operation: str, partition_key=None):
+        """ Time a container call and provide its response_hook, see BaseCosmosDBDAL._track. """
+        if self.instrumentation is None:
+            return nullcontext()
+        return self.instrumentation.cosmos_operation(operation, partition_key)
+
+    async def _execute(self, operation: str, partition_key, call: Callable[..., Awaitable]):
+        """ Make a container call under the rate governor, see BaseCosmosDBDAL._execute. """
+        governor = self.rate_governor
+        attempt = 0
+        while True:
+            reservation = governor.reserve(partition_key, operation) if governor else None
+            if reservation and reservation.wait_s:
+                await asyncio.sleep(reservation.wait_s)
+            try:
+                with self._track(operation, partition_key) as response_hook:
+                    return await call(chain_response_hooks(response_hook, governor.response_hook(reservation) if governor else None))
+            except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+                if governor is None:
+                    raise
+                if e.status_code != 429:
+                    governor.settle(reservation, e.headers)
+                    raise
+                delay_s = governor.throttled(reservation, e.headers, attempt)
+            logger.debug("Retrying throttled %s on partition %s in %.0f ms", operation, partition_key, delay_s * 1000)
+            await asyncio.sleep(delay_s)
+            attempt += 1
+
+    async def add_item(self, item: dict):
+        """
+        Adds a new item to the Cosmos DB container.
+
+        Args:
+            item (dict): the item to add
+
+        Returns:
+            CosmosDict: the created item or None if the operation fails
+        """
+        try:
+            created_item = await self._execute(
+                "create_item", self._item_partition_key(item),
+                lambda response_hook: self.container.create_item(body=item, response_hook=response_hook),
+            )
+            logger.debug("Item added: %s", created_item["id"])
+            return created_item
+        except exceptions.CosmosHttpResponseError as e:
+            logger.warning(
+                "Error adding item %s: %s", item.get("id"), e.message,
+                extra={"item_id": item.get("id"), "status_code": e.status_code},
+            )
+            return None
+
+    async def get_item(self, item_id: str, partition_key: str | int):
+        """ Get an item from the Cosmos DB container.
+
+        Args:
+            item_id (str): the id of the item to get
+            partition_key (str | int): the partition key of the item
+
+        Returns:
+            CosmosDict: the item if found, None otherwise
+        """
+        try:
+            return await self._execute(
+                "read_item", partition_key,
+                lambda response_hook: self.container.read_item(item_id, partition_key=partition_key, response_hook=response_hook),
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            logger.debug("Item not found: %s", item_id)
+            return None
+
+    async def get_item_if_modified(self, item_id: str, partition_key: str | int, etag: str) -> tuple[bool, Optional[dict]]:
+        """ Get an item only if it changed since it was read with the given ETag.
+
+        Args:
+            item_id (str): the id of the item to get
+            partition_key (str | int): the partition key of the item
+            etag (str): the ETag of the copy the caller already holds
+
+        Returns:
+            tuple[bool, CosmosDict]: (False, None) if the item is unchanged, otherwise
+                (True, item) where item is None if the item no longer exists
+        """
+        try:
+            item = await self._execute(
+                "read_item", partition_key,
+                lambda response_hook: self.container.read_item(
+                    item_id, partition_key=partition_key, initial_headers={"If-None-Match": etag},
+                    response_hook=response_hook,
+                ),
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            logger.debug("Item not found: %s", item_id)
+            return True, None
+        # A 304 Not Modified response has no body
+        if not item:
+            return False, None
+        return True, item
+
+    async def update_item(self, item_id: str, item: dict, etag: Optional[str] = None):
+        """ Update an item in the Cosmos DB container.
+
+        Args:
+            item_id (str): the id of the item to update
+            item (dict): the updated item
+            etag (str): if given, only replace the item if it still has this ETag
+
+        Returns:
+            CosmosDict:  the updated item if successful, None otherwise
+
+        Raises:
+            CosmosAccessConditionFailedError: if the item no longer has the given ETag
+        """
+        try:
+            conditions = {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag else {}
+            updated_item = await self._execute(
+                "replace_item", self._item_partition_key(item),
+                lambda response_hook: self.container.replace_item(
+                    item_id, body=item, response_hook=response_hook, **conditions
+                ),
+            )
+            logger.debug("Item updated: %s", item_id)
+            return updated_item
+        except exceptions.CosmosAccessConditionFailedError:
+            raise
+        except exceptions.CosmosHttpResponseError as e:
+            logger.warning(
+                "Error updating item %s: %s", item_id, e.message,
+                extra={"item_id": item_id, "status_code": e.status_code},
+            )
+            return None
+
+    async def delete_item(self, item_id: str, partition_key: str | int):
+        """ Delete an item from the Cosmos DB container.
+
+        Args:
+            item_id (str): the id of the item to delete
+            partition_key (str | int): the partition key of the item
+        """
+        try:
+            await self._execute(
+                "delete_item", partition_key,
+                lambda response_hook: self.container.delete_item(item_id, partition_key=partition_key, response_hook=response_hook),
+            )
+            logger.debug("Item deleted: %s", item_id)
+        except exceptions.CosmosHttpResponseError as e:
+            logger.warning(
+                "Error deleting item %s: %s", item_id, e.message,
+                extra={"item_id": item_id, "status_code": e.status_code},
+            )
+
+    async def execute_batch_items(self, batch_operations: list, partition_key: str | int, raise_on_error: bool = False):
+        """ Execute multiple operations to the Cosmos DB container.
+
+        Args:
+            batch_operations (list): the list of operations to execute, see BaseCosmosDBDAL.execute_batch_items
+            partition_key (str | int): the partition key for the operations
+            raise_on_error (bool): re-raise the CosmosBatchOperationError instead of returning None
+
+        Returns:
+            list: the results of the batch operations or None if one of the operations fails
+        """
+        try:
+            return await self._execute(
+                "execute_item_batch", partition_key,
+                lambda response_hook: self.container.execute_item_batch(
+                    batch_operations=batch_operations, partition_key=partition_key, response_hook=response_hook
+                ),
+            )
+        except exceptions.CosmosBatchOperationError as e:
+            if raise_on_error:
+                raise
+            error_operation_index = e.error_index
+            error_operation_response = e.operation_responses[error_operation_index]
+            error_operation = batch_operations[error_operation_index]
+            logger.warning(
+                "Error operation: %s, error operation response: %s", error_operation, error_operation_response,
+                extra={"partition_key": partition_key, "status_code": e.status_code},
+            )
+            return None
+
+    async def query_item_by_partition(
+        self,
+        partition_key_value: str | int,
+        field_name="*",
+        skip: int=0,
+        take: int=None,
+        additional_where: Optional[str]=None,
+        parameters: Optional[list[dict]]=None,
+    ):
+        """
+        Query for specific fields from documents in a partition with pagination.
+
+        Args:
+            partition_key_value: Value of the partition key to query, None to query across
+                every partition
+            field_name: Field to retrieve (use "*" for all fields, "field1, field2" for multiple fields)
+            skip: Number of items to skip (for pagination)
+            take: Maximum number of items to return (None for all)
+            additional_where: Additional WHERE clause conditions (without the "WHERE" keyword)
+            parameters: the query parameters
+
+        Returns:
+            List of query results
+        """
+        query, parameters = build_partition_query(field_name, additional_where, parameters, skip, take)
+
+        async def run_query(response_hook):
+            return [
+                item async for item in self.container.query_items(
+                    query=query,
+                    parameters=parameters,
+                    response_hook=response_hook,
+                    **query_scope(partition_key_value),
+                )
+            ]
+        return await self._execute("query_items", partition_key_value, run_query)
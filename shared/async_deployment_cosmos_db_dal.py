@@ -0,0 +1,281 @@
+# shared/async_deployment_cosmos_db_dal.py
+
+import asyncio
+from typing import Optional
+
+from azure.cosmos import exceptions
+
+from shared.async_cosmos_db_dal import AsyncBaseCosmosDBDAL
+from shared.cosmos_documents import (
+    CosmosDocumentType,
+    DeploymentCounterShardDocument,
+    DeploymentMetadataDocument,
+)
+from shared.deployment_cosmos_db_dal import (
+    EXISTENCE_QUERY_CHUNK_SIZE,
+    MAX_BATCH_OPERATIONS,
+    DeploymentDALMixin,
+    FileHashResults,
+)
+from shared.document_cache import DocumentCache
+from shared.instrumentation import Instrumentation
+from shared.rate_governor import RateGovernor
+from shared.seen_hash_filter import SeenHashFilter
+
+
+class AsyncDeploymentCosmosDBDAL(DeploymentDALMixin, AsyncBaseCosmosDBDAL):
+    """The asyncio counterpart of DeploymentCosmosDBDAL for the ingestion path.
+
+    It writes the same documents and shares the same caches as the synchronous DAL;
+    deployment management (creation, upload status, deletion) stays on DeploymentCosmosDBDAL.
+    """
+
+    def __init__(
+        self,
+        container,
+        seen_hashes: Optional[SeenHashFilter] = None,
+        metadata_cache: Optional[DocumentCache] = None,
+        conditional_reads: bool = False,
+        instrumentation: Optional[Instrumentation] = None,
+        rate_governor: Optional[RateGovernor] = None,
+    ):
+        """ Initializes the AsyncDeploymentCosmosDBDAL with an azure.cosmos.aio container client.
+
+        Args:
+            container (ContainerProxy): the azure.cosmos.aio container client
+            seen_hashes (SeenHashFilter): optional filter of hashes known to be stored
+            metadata_cache (DocumentCache): optional cache of metadata documents keyed by deployment id
+            conditional_reads (bool): revalidate expired cache entries with an If-None-Match read
+            instrumentation (Instrumentation): optional collector of latencies and request charges
+            rate_governor (RateGovernor): optional RU budget per deployment partition
+        """
+        super().__init__(container, instrumentation, rate_governor)
+        self._init_deployment_state(seen_hashes, metadata_cache, conditional_reads)
+
+    async def get_deployment_metadata(
+        self, deployment_id: int
+    ) -> Optional[DeploymentMetadataDocument]:
+        """Get a deployment metadata item from the Cosmos DB container.
+
+        Args:
+            deployment_id (int): the id of the item to get
+
+        Returns:
+            DeploymentMetadata: the metadata if found, None otherwise
+        """
+        data = await self._read_metadata_item(deployment_id)
+        if not data:
+            return None
+        metadata = DeploymentMetadataDocument.from_dict(data)
+        self._counter_shards[deployment_id] = metadata.counter_shards
+        if metadata.counter_shards > 1:
+            metadata.hash_count += sum(shard.hash_count for shard in await self.get_counter_shards(deployment_id))
+        return metadata
+
+    async def _read_metadata_item(self, deployment_id: int) -> Optional[dict]:
+        """Read the raw metadata document, going through the metadata cache if there is one.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+
+        Returns:
+            dict: the metadata document if found, None otherwise
+        """
+        if not self.metadata_cache:
+            return await self.get_item(item_id=str(deployment_id), partition_key=deployment_id)
+        entry = self.metadata_cache.get_entry(deployment_id)
+        if entry is not None and not entry.expired:
+            return dict(entry.value)
+        if entry is not None and entry.etag and self.conditional_reads:
+            modified, data = await self.get_item_if_modified(str(deployment_id), deployment_id, entry.etag)
+            if not modified:
+                self.metadata_cache.revalidate(deployment_id)
+                return dict(entry.value)
+        else:
+            data = await self.get_item(item_id=str(deployment_id), partition_key=deployment_id)
+        self._cache_metadata_item(deployment_id, data)
+        return data
+
+    async def get_counter_shards(self, deployment_id: int) -> list[DeploymentCounterShardDocument]:
+        """Get the hash_count shard documents of a deployment.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+
+        Returns:
+            list[DeploymentCounterShardDocument]: the shards, empty if the deployment is not sharded
+        """
+        items = await self.query_item_by_partition(
+            partition_key_value=deployment_id,
+            additional_where="c.type = @type",
+            parameters=[{"name": "@type", "value": CosmosDocumentType.HASH_COUNT_SHARD.value}],
+        )
+        return DeploymentCounterShardDocument.from_dicts(items)
+
+    async def _get_counter_shard_count(self, deployment_id: int) -> int:
+        """Get the number of hash_count shards of a deployment, reading the metadata once.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+
+        Returns:
+            int: the number of shards
+
+        Raises:
+            ValueError: if the deployment metadata does not exist
+        """
+        counter_shards = self._counter_shards.get(deployment_id)
+        if counter_shards is None:
+            data = await self._read_metadata_item(deployment_id)
+            if not data:
+                raise ValueError(f"Deployment metadata does not exist for {deployment_id}.")
+            counter_shards = data.get("counter_shards", 1)
+            self._counter_shards[deployment_id] = counter_shards
+        return counter_shards
+
+    async def add_file_hash(
+        self, deployment_id: int, file_hash: str
+    ) -> Optional[bool]:
+        """Add file hash to Cosmos DB, see DeploymentCosmosDBDAL.add_file_hash.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            file_hash (str): the file hash to add
+
+        Returns:
+            bool: True if the hash was added, False if it was already stored
+
+        Raises:
+            ValueError: if the deployment metadata does not exist
+            CosmosBatchOperationError: if the batch failed for another reason, e.g. throttling
+        """
+        if self.seen_hashes and self.seen_hashes.contains(deployment_id, file_hash):
+            return False
+        counter_shards = await self._get_counter_shard_count(deployment_id)
+        batch_operations = self._file_hash_batch_operations(deployment_id, [file_hash], counter_shards)
+        try:
+            batch_results = await self.execute_batch_items(batch_operations, partition_key=deployment_id, raise_on_error=True)
+        except exceptions.CosmosBatchOperationError as e:
+            if e.error_index == 0 and e.status_code == 409:
+                self._remember_file_hash(deployment_id, file_hash)
+                return False
+            if e.error_index == 1 and e.status_code == 404:
+                raise ValueError(f"Deployment metadata does not exist for {deployment_id}.")
+            # Raised as is, its status code telling a throttled or failed-over write from a bad one
+            raise
+        self._remember_file_hash(deployment_id, file_hash)
+        self._cache_metadata_from_batch(deployment_id, batch_operations, batch_results)
+        return True
+
+    async def add_file_hashes(
+        self, deployment_id: int, file_hashes: list[str]
+    ) -> FileHashResults:
+        """Add many file hashes in as few transactional batches as possible, see
+        DeploymentCosmosDBDAL.add_file_hashes. Batches for one deployment run in order.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            file_hashes (list[str]): the file hashes to add
+
+        Returns:
+            FileHashResults: the outcome for each file hash, with the error behind each failed one
+
+        Raises:
+            ValueError: if the deployment metadata does not exist
+        """
+        results, pending = self._filter_seen_hashes(deployment_id, file_hashes)
+        if not pending:
+            return results
+        counter_shards = await self._get_counter_shard_count(deployment_id)
+        while pending:
+            chunk = pending[:MAX_BATCH_OPERATIONS - counter_shards]
+            batch_operations = self._file_hash_batch_operations(deployment_id, chunk, counter_shards)
+            try:
+                batch_results = await self.execute_batch_items(batch_operations, partition_key=deployment_id, raise_on_error=True)
+            except exceptions.CosmosBatchOperationError as e:
+                if not self._record_hash_batch_error(deployment_id, chunk, pending, results, e):
+                    break
+                unchecked = self._unchecked_conflict_hashes(chunk, e)
+                if unchecked:
+                    self._drop_stored_hashes(
+                        deployment_id, pending, results, await self.get_existing_file_hashes(deployment_id, unchecked)
+                    )
+                continue
+            self._record_hash_batch_success(deployment_id, chunk, results, batch_operations, batch_results)
+            pending = pending[len(chunk):]
+        return results
+
+    async def get_existing_file_hashes(
+        self,
+        deployment_id: int,
+        file_hashes: list[str],
+        chunk_size: int = EXISTENCE_QUERY_CHUNK_SIZE,
+        max_concurrency: int = 4,
+    ) -> set[str]:
+        """Find which of the candidate file hashes a deployment already has, see
+        DeploymentCosmosDBDAL.get_existing_file_hashes.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            file_hashes (list[str]): the candidate file hashes
+            chunk_size (int): the number of hashes per query
+            max_concurrency (int): the maximum number of queries in flight
+
+        Returns:
+            set[str]: the candidate hashes that are already stored
+        """
+        existing = set()
+        unknown = []
+        for file_hash in dict.fromkeys(file_hashes):
+            if self.seen_hashes and self.seen_hashes.contains(deployment_id, file_hash):
+                existing.add(file_hash)
+            else:
+                unknown.append(file_hash)
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def query_chunk(chunk: list[str]) -> list[dict]:
+            async with semaphore:
+                return await self.query_item_by_partition(
+                    partition_key_value=deployment_id,
+                    field_name="id",
+                    additional_where="c.type = @type AND ARRAY_CONTAINS(@ids, c.id)",
+                    parameters=[
+                        {"name": "@type", "value": CosmosDocumentType.FILE_HASH.value},
+                        {"name": "@ids", "value": chunk},
+                    ],
+                )
+
+        chunks = [unknown[i:i + chunk_size] for i in range(0, len(unknown), chunk_size)]
+        for items in await asyncio.gather(*(query_chunk(chunk) for chunk in chunks)):
+            for item in items:
+                existing.add(item["id"])
+                self._remember_file_hash(deployment_id, item["id"])
+        return existing
+
+    async def add_file_hashes_by_deployment(
+        self, file_hashes_by_deployment: dict[int, list[str]], max_concurrency: int = 8
+    ) -> dict[int, FileHashResults | Exception]:
+        """Add file hashes for many deployments, running different deployment partitions
+        concurrently while keeping the batches of each deployment in order.
+
+        Args:
+            file_hashes_by_deployment (dict[int, list[str]]): the file hashes to add per deployment
+            max_concurrency (int): the maximum number of deployments written at the same time
+
+        Returns:
+            dict[int, FileHashResults | Exception]: per deployment, the outcome of
+                each file hash or the exception that stopped it
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def add_deployment_file_hashes(deployment_id: int, file_hashes: list[str]):
+            async with semaphore:
+                return await self.add_file_hashes(deployment_id, file_hashes)
+
+        deployment_ids = list(file_hashes_by_deployment)
+        outcomes = await asyncio.gather(
+            *(add_deployment_file_hashes(deployment_id, file_hashes_by_deployment[deployment_id])
+              for deployment_id in deployment_ids),
+            return_exceptions=True,
+        )
+        return dict(zip(deployment_ids, outcomes))
@@ -0,0 +1,127 @@
+# shared/blob_client_registry.py
+# A process-wide registry of storage clients, so warm invocations reuse connections.
+
+import os
+import threading
+from typing import Optional
+
+from azure.storage.blob import BlobServiceClient, ContainerClient
+from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+
+from shared.poison_events import ConfigurationError
+
+# The connection string used when an account has no setting of its own
+DEFAULT_CONNECTION_STRING_SETTING = "CONNECTION_STRING"
+
+
+class BlobClientRegistry:
+    """Caches one BlobServiceClient per storage account and one ContainerClient per
+    (account, container) for the lifetime of the worker process.
+
+    Container clients are created from the cached service client, so they share its
+    HTTP pipeline and connection pool.
+    """
+
+    service_client_class = BlobServiceClient
+
+    def __init__(self, default_setting: str = DEFAULT_CONNECTION_STRING_SETTING):
+        """ Initializes the registry.
+
+        Args:
+            default_setting (str): the app setting holding the connection string used for
+                accounts without a CONNECTION_STRING_<ACCOUNT> setting
+        """
+        self.default_setting = default_setting
+        self._service_clients: dict[str, BlobServiceClient] = {}
+        self._container_clients: dict[tuple[str, str], ContainerClient] = {}
+        self._lock = threading.Lock()
+
+    def get_connection_string(self, storage_account_name: str) -> Optional[str]:
+        """ Get the connection string for a storage account.
+
+        Args:
+            storage_account_name (str): the name of the storage account
+
+        Returns:
+            str: the CONNECTION_STRING_<ACCOUNT> setting if present, the default setting otherwise
+        """
+        account_setting = f"{self.default_setting}_{storage_account_name.upper()}"
+        return os.environ.get(account_setting) or os.environ.get(self.default_setting)
+
+    def get_service_client(self, storage_account_name: str) -> BlobServiceClient:
+        """ Get the cached service client for a storage account, creating it on first use.
+
+        Args:
+            storage_account_name (str): the name of the storage account
+
+        Returns:
+            BlobServiceClient: the service client
+
+        Raises:
+            ConfigurationError: if no connection string is configured for the account
+        """
+        client = self._service_clients.get(storage_account_name)
+        if client is not None:
+            return client
+        with self._lock:
+            client = self._service_clients.get(storage_account_name)
+            if client is None:
+                connection_string = self.get_connection_string(storage_account_name)
+                if not connection_string:
+                    raise ConfigurationError(f"No connection string configured for storage account: {storage_account_name}")
+                client = self.service_client_class.from_connection_string(connection_string)
+                self._service_clients[storage_account_name] = client
+        return client
+
+    def get_container_client(self, storage_account_name: str, container_name: str) -> ContainerClient:
+        """ Get the cached container client for a storage account and container.
+
+        Args:
+            storage_account_name (str): the name of the storage account
+            container_name (str): the name of the container
+
+        Returns:
+            ContainerClient: the container client
+        """
+        key = (storage_account_name, container_name)
+        client = self._container_clients.get(key)
+        if client is not None:
+            return client
+        service_client = self.get_service_client(storage_account_name)
+        with self._lock:
+            client = self._container_clients.get(key)
+            if client is None:
+                client = service_client.get_container_client(container_name)
+                self._container_clients[key] = client
+        return client
+
+    def clear(self):
+        """ Close and forget every cached client. """
+        with self._lock:
+            for client in self._service_clients.values():
+                client.close()
+            self._service_clients.clear()
+            self._container_clients.clear()
+
+
+class AsyncBlobClientRegistry(BlobClientRegistry):
+    """The same registry for azure.storage.blob.aio clients.
+
+    The clients are bound to the event loop they are first used on, so the registry
+    must only be used from that loop.
+    """
+
+    service_client_class = AsyncBlobServiceClient
+
+    async def clear(self):
+        """ Close and forget every cached client. """
+        with self._lock:
+            service_clients = list(self._service_clients.values())
+            self._service_clients.clear()
+            self._container_clients.clear()
+        for client in service_clients:
+            await client.close()
+
+
+blob_client_registry = BlobClientRegistry()
+async_blob_client_registry = AsyncBlobClientRegistry()
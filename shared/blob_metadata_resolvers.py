@@ -0,0 +1,185 @@
+# shared/blob_metadata_resolvers.py
+# Resolvers that work out the dep_id and hash of a blob, cheapest first.
+
+import re
+import threading
+from typing import Any, Awaitable, Callable, Dict, Optional
+from urllib.parse import unquote, urlparse
+
+# Regular expressions used for the placeholders of a blob path convention
+PATH_PLACEHOLDERS = {
+    "container": r"[^/]+",
+    "dep_id": r"\d+",
+    "hash": r"[^/.]+",
+    "ext": r"[^/]+",
+}
+
+
+class PathConventionResolver:
+    """Resolves blob metadata from the blob path and the Event Grid payload alone.
+
+    The convention is a path template such as ``{container}/{dep_id}/{hash}.{ext}``
+    matched against the path of the blob url.
+    """
+
+    def __init__(self, convention: str):
+        """ Initializes the resolver with a blob path convention.
+
+        Args:
+            convention (str): the path template, using the {container}, {dep_id}, {hash}
+                and {ext} placeholders
+
+        Raises:
+            ValueError: if the convention has an unknown placeholder or lacks {dep_id} or {hash}
+        """
+        self.convention = convention
+        pattern = ""
+        position = 0
+        for match in re.finditer(r"\{(\w+)\}", convention):
+            name = match.group(1)
+            if name not in PATH_PLACEHOLDERS:
+                raise ValueError(f"Unknown placeholder in blob path convention: {name}")
+            pattern += re.escape(convention[position:match.start()])
+            pattern += f"(?P<{name}>{PATH_PLACEHOLDERS[name]})"
+            position = match.end()
+        pattern += re.escape(convention[position:])
+        if "(?P<dep_id>" not in pattern or "(?P<hash>" not in pattern:
+            raise ValueError("Blob path convention must contain {dep_id} and {hash}")
+        self.pattern = re.compile(pattern)
+
+    def resolve(
+        self, blob_url: str, storage_account_name: str, event_data: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """ Resolve the blob metadata without calling the storage account.
+
+        Args:
+            blob_url (str): the url of the blob
+            storage_account_name (str): the name of the storage account
+            event_data (dict): the Event Grid event data
+
+        Returns:
+            dict: the metadata in the shape returned by extract_blob_metadata, or None
+                if the blob path does not follow the convention
+        """
+        path = unquote(urlparse(blob_url).path).strip('/')
+        match = self.pattern.fullmatch(path)
+        if match is None:
+            return None
+        dirname, _, blob_name = path.rpartition('/')
+        return {
+            'storage_account_name': storage_account_name,
+            'container_name': dirname,
+            'blob_name': blob_name,
+            'blob_url': blob_url,
+            'size': event_data.get('contentLength'),
+            'content_type': event_data.get('contentType'),
+            'etag': event_data.get('eTag'),
+            'metadata': {
+                'dep_id': match.group('dep_id'),
+                'hash': match.group('hash'),
+            },
+        }
+
+
+class BlobMetadataResolverChain:
+    """Tries each fast resolver in turn and only falls back to reading the blob
+    properties when none of them yields a valid dep_id and hash.
+    """
+
+    def __init__(
+        self,
+        resolvers: list,
+        fallback: Callable[[str, str], Optional[Dict[str, Any]]],
+        async_fallback: Optional[Callable[[str, str], Awaitable[Optional[Dict[str, Any]]]]] = None,
+    ):
+        """ Initializes the resolver chain.
+
+        Args:
+            resolvers (list): the fast resolvers, each with a resolve(blob_url, storage_account_name, event_data) method
+            fallback (Callable): called with (blob_url, storage_account_name) when the fast path fails
+            async_fallback (Callable): the coroutine counterpart of fallback, used by resolve_async
+        """
+        self.resolvers = resolvers
+        self.fallback = fallback
+        self.async_fallback = async_fallback
+        self.fast_path_hits = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+
+    def resolve(
+        self, blob_url: str, storage_account_name: str, event_data: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """ Resolve the blob metadata, cheapest resolver first.
+
+        Args:
+            blob_url (str): the url of the blob
+            storage_account_name (str): the name of the storage account
+            event_data (dict): the Event Grid event data
+
+        Returns:
+            dict: the blob metadata, or None if the fallback failed too
+        """
+        metadata = self._resolve_fast_path(blob_url, storage_account_name, event_data)
+        if metadata is not None:
+            return metadata
+        return self.fallback(blob_url, storage_account_name)
+
+    async def resolve_async(
+        self, blob_url: str, storage_account_name: str, event_data: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """ Resolve the blob metadata, awaiting async_fallback when the fast path fails.
+
+        Args:
+            blob_url (str): the url of the blob
+            storage_account_name (str): the name of the storage account
+            event_data (dict): the Event Grid event data
+
+        Returns:
+            dict: the blob metadata, or None if the fallback failed too
+        """
+        metadata = self._resolve_fast_path(blob_url, storage_account_name, event_data)
+        if metadata is not None:
+            return metadata
+        return await self.async_fallback(blob_url, storage_account_name)
+
+    def _resolve_fast_path(
+        self, blob_url: str, storage_account_name: str, event_data: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """ Try each fast resolver in turn, counting a hit or a fallback. """
+        for resolver in self.resolvers:
+            metadata = resolver.resolve(blob_url, storage_account_name, event_data)
+            if metadata is not None and is_valid_metadata(metadata):
+                with self._lock:
+                    self.fast_path_hits += 1
+                return metadata
+        with self._lock:
+            self.fallbacks += 1
+        return None
+
+    def get_stats(self) -> dict:
+        """ Get the fast-path hit and fallback counters.
+
+        Returns:
+            dict: the counters and the fast-path hit rate
+        """
+        with self._lock:
+            total = self.fast_path_hits + self.fallbacks
+            return {
+                'fast_path_hits': self.fast_path_hits,
+                'fallbacks': self.fallbacks,
+                'fast_path_hit_rate': self.fast_path_hits / total if total else 0.0,
+            }
+
+
+def is_valid_metadata(metadata: Dict[str, Any]) -> bool:
+    """ Check the metadata carries an integer dep_id and a non-empty hash.
+
+    Args:
+        metadata (dict): the blob metadata
+
+    Returns:
+        bool: True if the metadata can be registered
+    """
+    blob_metadata = metadata.get('metadata') or {}
+    deployment_id = blob_metadata.get('dep_id')
+    return bool(blob_metadata.get('hash')) and str(deployment_id or '').isdigit() and int(deployment_id) > 0
@@ -0,0 +1,93 @@
+# shared/cold_start.py
+# Timings of a worker's cold start, from the import of function_app to its first invocation.
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ColdStartTimer:
+    """Records how long a worker took to import, build its clients and serve its first
+    invocation, so cold starts can be told apart from warm latency.
+
+    Each named timing is kept from its first measurement only. Times are in milliseconds
+    since the timer started, which should be as early as possible in the import.
+    """
+
+    def __init__(self, started: Optional[float] = None):
+        """ Initializes the timer.
+
+        Args:
+            started (float): the time.perf_counter() value the import started at, now if None
+        """
+        self.started = time.perf_counter() if started is None else started
+        self._lock = threading.Lock()
+        self._timings: dict[str, float] = {}
+        self._first_invocation_claimed = False
+        self._reported = False
+
+    def elapsed_ms(self) -> float:
+        """ Returns the milliseconds since the import started. """
+        return (time.perf_counter() - self.started) * 1000
+
+    def record(self, name: str, value_ms: float):
+        """ Record a timing, unless one with the same name was recorded already. """
+        with self._lock:
+            self._timings.setdefault(name, round(value_ms, 3))
+
+    @contextmanager
+    def measure(self, name: str) -> Iterator[None]:
+        """ Time a block into '<name>.ms', the first time it completes without raising. """
+        start = time.perf_counter()
+        yield
+        self.record(f"{name}.ms", (time.perf_counter() - start) * 1000)
+
+    def imported(self):
+        """ Record the end of the import. """
+        self.record("import.ms", self.elapsed_ms())
+
+    @contextmanager
+    def invocation(self) -> Iterator[None]:
+        """ Time the first invocation of the worker, and log the cold start report once
+        it completes. Later invocations are not timed.
+        """
+        with self._lock:
+            first = not self._first_invocation_claimed
+            self._first_invocation_claimed = True
+        if not first:
+            yield
+            return
+        start = time.perf_counter()
+        self.record("first_invocation_start.ms", self.elapsed_ms())
+        try:
+            yield
+        finally:
+            self.record("first_invocation.ms", (time.perf_counter() - start) * 1000)
+            self.record("first_invocation_end.ms", self.elapsed_ms())
+            self.log_report()
+
+    def log_report(self):
+        """ Log the timings recorded so far, once. """
+        with self._lock:
+            if self._reported:
+                return
+            self._reported = True
+            timings = dict(self._timings)
+        logger.info(
+            "Cold start: %s",
+            ", ".join(f"{name} {value:.1f}" for name, value in timings.items()),
+            extra={'cold_start': timings},
+        )
+
+    def report(self) -> dict:
+        """ Get the timings recorded so far.
+
+        Returns:
+            dict: the timings in milliseconds by name, in the order they were recorded
+        """
+        with self._lock:
+            return dict(self._timings)
@@ -0,0 +1,247 @@
+# shared/content_hash.py
+# Verifies a blob's hash metadata against its content, streamed in parallel ranged reads.
+
+import asyncio
+import base64
+import binascii
+import hashlib
+import random
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from enum import Enum
+from typing import Awaitable, Callable, Optional
+
+
+class VerificationOutcome(Enum):
+    """ The outcome of a content hash verification that did not fail. """
+    VERIFIED = "verified"
+    TOO_LARGE = "too_large"  # skipped, the blob is above the size threshold
+    NOT_SAMPLED = "not_sampled"  # skipped, the blob was not picked by the sampling rate
+
+
+class ContentHashMismatch(ValueError):
+    """ Raised when the content of a blob does not match the hash in its metadata. """
+
+    def __init__(self, message: str, expected: str, actual: str):
+        super().__init__(message)
+        self.expected = expected
+        self.actual = actual
+
+
+def digest_matches(expected: str, digest: bytes) -> bool:
+    """ Check a hash from blob metadata against a digest, the hash being hex or base64 encoded.
+
+    Args:
+        expected (str): the hash from the blob metadata
+        digest (bytes): the digest of the blob content
+
+    Returns:
+        bool: True if the hash encodes the digest
+    """
+    expected = expected.strip()
+    if expected.lower() == digest.hex():
+        return True
+    try:
+        return base64.b64decode(expected, validate=True) == digest
+    except (binascii.Error, ValueError):
+        return False
+
+
+class ContentHashVerifier:
+    """Recomputes the digest of a blob from its content and compares it to its hash metadata.
+
+    The blob is read in chunk_size ranges, several at a time, and fed to the digest in
+    order as the ranges arrive. The ranges in flight are bounded for the verifier as a
+    whole, so concurrent verifications never buffer more than max_buffered_bytes
+    between them. Blobs above max_size_bytes, and those left out by sample_rate, are
+    not verified at all.
+    """
+
+    def __init__(
+        self,
+        algorithm: str = "sha256",
+        chunk_size: int = 4 * 1024 * 1024,
+        max_buffered_bytes: int = 16 * 1024 * 1024,
+        max_size_bytes: Optional[int] = None,
+        sample_rate: float = 1.0,
+        rng: Optional[random.Random] = None,
+    ):
+        """ Initializes the verifier.
+
+        Args:
+            algorithm (str): the hashlib name of the digest the uploader computed
+            chunk_size (int): the size of each ranged read
+            max_buffered_bytes (int): the memory ceiling of the reads in flight, which
+                also sets how many ranges are read at once
+            max_size_bytes (int): the largest blob verified, None for no limit
+            sample_rate (float): the share of the blobs verified, between 0 and 1
+            rng (random.Random): the source of the sampling
+
+        Raises:
+            ValueError: if the algorithm is not supported by hashlib
+        """
+        hashlib.new(algorithm)
+        self.algorithm = algorithm
+        self.chunk_size = chunk_size
+        self.max_in_flight = max(1, max_buffered_bytes // chunk_size)
+        self.max_size_bytes = max_size_bytes
+        self.sample_rate = sample_rate
+        self.rng = rng or random.Random()
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._async_slots: Optional[asyncio.Semaphore] = None
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._stats = {outcome.value: 0 for outcome in VerificationOutcome}
+        self._stats.update(mismatched=0, bytes_read=0)
+
+    def _count(self, name: str, value: int = 1):
+        with self._lock:
+            self._stats[name] += value
+
+    def _sampled(self) -> bool:
+        """ Draw whether a blob is picked by the sampling rate. """
+        return self.sample_rate >= 1.0 or self.rng.random() < self.sample_rate
+
+    def _too_large(self, size: int) -> bool:
+        return self.max_size_bytes is not None and size > self.max_size_bytes
+
+    def _skipped(self, outcome: VerificationOutcome) -> VerificationOutcome:
+        self._count(outcome.value)
+        return outcome
+
+    def _check(self, expected_hash: str, digest: bytes) -> VerificationOutcome:
+        if not digest_matches(expected_hash, digest):
+            self._count("mismatched")
+            raise ContentHashMismatch(
+                f"Blob content {self.algorithm} {digest.hex()} does not match its hash {expected_hash}",
+                expected_hash, digest.hex(),
+            )
+        self._count(VerificationOutcome.VERIFIED.value)
+        return VerificationOutcome.VERIFIED
+
+    def verify(
+        self,
+        expected_hash: str,
+        read_range: Callable[[int, int], bytes],
+        size: Optional[int] = None,
+        read_size: Optional[Callable[[], int]] = None,
+    ) -> VerificationOutcome:
+        """ Verify a blob, unless it is too large or not sampled.
+
+        Args:
+            expected_hash (str): the hash from the blob metadata, hex or base64 encoded
+            read_range (Callable[[int, int], bytes]): reads length bytes of the blob from an offset
+            size (int): the size of the blob, if known
+            read_size (Callable[[], int]): gets the size of the blob when it is not known,
+                only called for sampled blobs
+
+        Returns:
+            VerificationOutcome: VERIFIED, or why the blob was not verified
+
+        Raises:
+            ContentHashMismatch: if the content does not match the hash
+        """
+        if not self._sampled():
+            return self._skipped(VerificationOutcome.NOT_SAMPLED)
+        if size is None:
+            size = read_size()
+        if self._too_large(size):
+            return self._skipped(VerificationOutcome.TOO_LARGE)
+        return self._check(expected_hash, self.digest(read_range, size))
+
+    async def verify_async(
+        self,
+        expected_hash: str,
+        read_range: Callable[[int, int], Awaitable[bytes]],
+        size: Optional[int] = None,
+        read_size: Optional[Callable[[], Awaitable[int]]] = None,
+    ) -> VerificationOutcome:
+        """ The asyncio variant of verify, with coroutine readers. """
+        if not self._sampled():
+            return self._skipped(VerificationOutcome.NOT_SAMPLED)
+        if size is None:
+            size = await read_size()
+        if self._too_large(size):
+            return self._skipped(VerificationOutcome.TOO_LARGE)
+        return self._check(expected_hash, await self.digest_async(read_range, size))
+
+    def digest(self, read_range: Callable[[int, int], bytes], size: int) -> bytes:
+        """ Compute the digest of a blob from ranged reads running on the verifier's threads.
+
+        A verification with reads in flight does not wait for more slots, it hashes the
+        oldest range first, so verifications competing for slots cannot deadlock.
+
+        Args:
+            read_range (Callable[[int, int], bytes]): reads length bytes of the blob from an offset
+            size (int): the size of the blob
+
+        Returns:
+            bytes: the digest
+        """
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_in_flight, thread_name_prefix="content-hash")
+        hasher = hashlib.new(self.algorithm)
+        pending = deque()
+        next_offset = 0
+        try:
+            while True:
+                while next_offset < size and len(pending) < self.max_in_flight and self._slots.acquire(blocking=not pending):
+                    length = min(self.chunk_size, size - next_offset)
+                    pending.append(self._executor.submit(read_range, next_offset, length))
+                    next_offset += length
+                if not pending:
+                    break
+                future = pending.popleft()
+                try:
+                    chunk = future.result()
+                finally:
+                    self._slots.release()
+                hasher.update(chunk)
+                self._count("bytes_read", len(chunk))
+        finally:
+            for future in pending:
+                future.cancel()
+                self._slots.release()
+        return hasher.digest()
+
+    async def digest_async(self, read_range: Callable[[int, int], Awaitable[bytes]], size: int) -> bytes:
+        """ The asyncio variant of digest, the ranged reads running as tasks. """
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_in_flight)
+        slots = self._async_slots
+        hasher = hashlib.new(self.algorithm)
+        pending = deque()
+        next_offset = 0
+        try:
+            while True:
+                while next_offset < size and len(pending) < self.max_in_flight and not (pending and slots.locked()):
+                    await slots.acquire()
+                    length = min(self.chunk_size, size - next_offset)
+                    pending.append(asyncio.ensure_future(read_range(next_offset, length)))
+                    next_offset += length
+                if not pending:
+                    break
+                task = pending.popleft()
+                try:
+                    chunk = await task
+                finally:
+                    slots.release()
+                hasher.update(chunk)
+                self._count("bytes_read", len(chunk))
+        finally:
+            for task in pending:
+                task.cancel()
+                slots.release()
+        return hasher.digest()
+
+    def get_stats(self) -> dict:
+        """ Get the number of blobs verified, mismatched and skipped, and the bytes read.
+
+        Returns:
+            dict: the counters
+        """
+        with self._lock:
+            return dict(self._stats)
@@ -1,13 +1,100 @@
 # src/dal/cosmos_db_dal.py
 # A base class for interacting with Cosmos DB.
 
-from typing import Optional
+import base64
+import logging
+import time
+from contextlib import nullcontext
+from typing import Callable, Iterator, Optional
+from azure.core import MatchConditions
 from azure.cosmos import exceptions, ContainerProxy
 
+from shared.instrumentation import Instrumentation
+from shared.rate_governor import RateGovernor
+
+logger = logging.getLogger(__name__)
+
+# LIMIT used when only OFFSET is requested, Cosmos DB requires both
+MAX_QUERY_LIMIT = 2147483647
+
 class BaseCosmosDBDAL:
-    def __init__(self, container: ContainerProxy):
-        """ Initializes the Cosmos DB DAL with the Cosmos DB account settings. """
+    # The document field holding the partition key, used to attribute request charges
+    partition_key_field: Optional[str] = None
+
+    def __init__(
+        self,
+        container: ContainerProxy,
+        instrumentation: Optional[Instrumentation] = None,
+        rate_governor: Optional[RateGovernor] = None,
+    ):
+        """ Initializes the Cosmos DB DAL with the Cosmos DB account settings.
+
+        Args:
+            container (ContainerProxy): the Cosmos DB container client
+            instrumentation (Instrumentation): optional collector of latencies and request charges
+            rate_governor (RateGovernor): optional per-partition RU budget, retrying throttled calls
+        """
         self.container = container
+        self.instrumentation = instrumentation
+        self.rate_governor = rate_governor
+
+    def _item_partition_key(self, item: dict):
+        """ Returns the partition key of a document, None if partition_key_field is not set. """
+        return item.get(self.partition_key_field) if self.partition_key_field else None
+
+    def _track(self, operation: str, partition_key=None):
+        """ Time a container call and provide the response_hook that records its request charge.
+
+        Args:
+            operation (str): the container operation
+            partition_key (str | int): the partition the call targets, if any
+
+        Returns:
+            ContextManager: yields the response_hook, None when instrumentation is off
+        """
+        if self.instrumentation is None:
+            return nullcontext()
+        return self.instrumentation.cosmos_operation(operation, partition_key)
+
+    def _execute(self, operation: str, partition_key, call: Callable, rate_governor: Optional[RateGovernor] = None):
+        """ Make a container call, tracked by the instrumentation and governed by the rate governor.
+
+        With a rate governor the call first waits for its partition's RU budget, and a
+        throttled call is retried with a jittered backoff within the same invocation.
+
+        Args:
+            operation (str): the container operation
+            partition_key (str | int): the partition the call targets, if any
+            call (Callable): makes the call, given the response_hook to pass to the SDK
+            rate_governor (RateGovernor): a governor to use instead of the DAL's, e.g. a
+                smaller budget for maintenance work
+
+        Returns:
+            the result of the call
+
+        Raises:
+            RateLimitExceeded: if the partition has no budget left or is still throttled
+                after the governor's retries
+        """
+        governor = rate_governor or self.rate_governor
+        attempt = 0
+        while True:
+            reservation = governor.reserve(partition_key, operation) if governor else None
+            if reservation and reservation.wait_s:
+                time.sleep(reservation.wait_s)
+            try:
+                with self._track(operation, partition_key) as response_hook:
+                    return call(chain_response_hooks(response_hook, governor.response_hook(reservation) if governor else None))
+            except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+                if governor is None:
+                    raise
+                if e.status_code != 429:
+                    governor.settle(reservation, e.headers)
+                    raise
+                delay_s = governor.throttled(reservation, e.headers, attempt)
+            logger.debug("Retrying throttled %s on partition %s in %.0f ms", operation, partition_key, delay_s * 1000)
+            time.sleep(delay_s)
+            attempt += 1
 
     def add_item(self, item: dict):
         """
@@ -20,11 +107,17 @@ class BaseCosmosDBDAL:
             CosmosDict: the created item or None if the operation fails
         """
         try:
-            created_item = self.container.create_item(body=item)
-            print(f"Item added successfully: {created_item}")
+            created_item = self._execute(
+                "create_item", self._item_partition_key(item),
+                lambda response_hook: self.container.create_item(body=item, response_hook=response_hook),
+            )
+            logger.debug("Item added: %s", created_item["id"])
             return created_item
         except exceptions.CosmosHttpResponseError as e:
-            print(f"Error adding item: {e}")
+            logger.warning(
+                "Error adding item %s: %s", item.get("id"), e.message,
+                extra={"item_id": item.get("id"), "status_code": e.status_code},
+            )
             return None
 
     def get_item(self, item_id: str, partition_key: str | int):
@@ -38,30 +131,100 @@ class BaseCosmosDBDAL:
             CosmosDict: the item if found, None otherwise
         """
         try:
-            item = self.container.read_item(item_id, partition_key=partition_key)
-            return item
+            return self._execute(
+                "read_item", partition_key,
+                lambda response_hook: self.container.read_item(item_id, partition_key=partition_key, response_hook=response_hook),
+            )
         except exceptions.CosmosResourceNotFoundError:
-            print(f"Item not found: {item_id}")
+            logger.debug("Item not found: %s", item_id)
             return None
 
-    def update_item(self, item_id: str, item: dict):
+    def get_item_if_modified(self, item_id: str, partition_key: str | int, etag: str) -> tuple[bool, Optional[dict]]:
+        """ Get an item only if it changed since it was read with the given ETag.
+
+        The read is sent with If-None-Match, so an unchanged item costs a 304
+        instead of transferring the document again.
+
+        Args:
+            item_id (str): the id of the item to get
+            partition_key (str | int): the partition key of the item
+            etag (str): the ETag of the copy the caller already holds
+
+        Returns:
+            tuple[bool, CosmosDict]: (False, None) if the item is unchanged, otherwise
+                (True, item) where item is None if the item no longer exists
+        """
+        try:
+            item = self._execute(
+                "read_item", partition_key,
+                lambda response_hook: self.container.read_item(
+                    item_id, partition_key=partition_key, initial_headers={"If-None-Match": etag},
+                    response_hook=response_hook,
+                ),
+            )
+        except exceptions.CosmosResourceNotFoundError:
+            logger.debug("Item not found: %s", item_id)
+            return True, None
+        # A 304 Not Modified response has no body
+        if not item:
+            return False, None
+        return True, item
+
+    def update_item(self, item_id: str, item: dict, etag: Optional[str] = None):
         """ Update an item in the Cosmos DB container.
 
         Args:
             item_id (str): the id of the item to update
             item (dict): the updated item
+            etag (str): if given, only replace the item if it still has this ETag
 
         Returns:
             CosmosDict:  the updated item if successful, None otherwise
+
+        Raises:
+            CosmosAccessConditionFailedError: if the item no longer has the given ETag
         """
         try:
-            updated_item = self.container.replace_item(item_id, body=item)
-            print(f"Item updated successfully: {updated_item}")
+            conditions = {"etag": etag, "match_condition": MatchConditions.IfNotModified} if etag else {}
+            updated_item = self._execute(
+                "replace_item", self._item_partition_key(item),
+                lambda response_hook: self.container.replace_item(
+                    item_id, body=item, response_hook=response_hook, **conditions
+                ),
+            )
+            logger.debug("Item updated: %s", item_id)
             return updated_item
+        except exceptions.CosmosAccessConditionFailedError:
+            raise
         except exceptions.CosmosHttpResponseError as e:
-            print(f"Error updating item: {e}")
+            logger.warning(
+                "Error updating item %s: %s", item_id, e.message,
+                extra={"item_id": item_id, "status_code": e.status_code},
+            )
             return None
 
+    def read_many_items(self, items: list[tuple[str, str | int]], max_concurrency: Optional[int] = None) -> list:
+        """ Point-read many items in one call with read_items.
+
+        The SDK groups the items by partition range and reads each group with a single
+        query, running the groups concurrently. read_items needs azure-cosmos 4.14.0 or later.
+
+        Args:
+            items (list[tuple[str, str | int]]): the (id, partition key) of each item
+            max_concurrency (int): the maximum number of groups read at once, None for the SDK default
+
+        Returns:
+            list[CosmosDict]: the items found, in no particular order
+        """
+        if not items:
+            return []
+
+        def read(response_hook):
+            # read_items calls any response_hook it is given, even None
+            hook = {"response_hook": response_hook} if response_hook else {}
+            return list(self.container.read_items(items=items, max_concurrency=max_concurrency, **hook))
+        return self._execute("read_items", None, read)
+
     def delete_item(self, item_id: str, partition_key: str | int):
         """ Delete an item from the Cosmos DB container.
 
@@ -70,12 +233,38 @@ class BaseCosmosDBDAL:
             partition_key (str | int): the partition key of the item
         """
         try:
-            self.container.delete_item(item_id, partition_key=partition_key)
-            print(f"Item deleted successfully: {item_id}")
+            self._execute(
+                "delete_item", partition_key,
+                lambda response_hook: self.container.delete_item(item_id, partition_key=partition_key, response_hook=response_hook),
+            )
+            logger.debug("Item deleted: %s", item_id)
         except exceptions.CosmosHttpResponseError as e:
-            print(f"Error deleting item: {e}")
+            logger.warning(
+                "Error deleting item %s: %s", item_id, e.message,
+                extra={"item_id": item_id, "status_code": e.status_code},
+            )
             
-    def execute_batch_items(self, batch_operations: list, partition_key: str | int):
+    def delete_all_items_by_partition(self, partition_key: str | int):
+        """ Delete every item of a partition with a single delete by partition key.
+
+        Cosmos DB deletes the items in the background, using at most 10% of the
+        container's RU/s, so they may still be returned by queries for a while. The
+        feature must be enabled on the account.
+
+        Args:
+            partition_key (str | int): the partition to delete
+
+        Raises:
+            CosmosHttpResponseError: if the delete is rejected, e.g. because the feature
+                is not enabled
+        """
+        self._execute(
+            "delete_all_items_by_partition_key", partition_key,
+            lambda response_hook: self.container.delete_all_items_by_partition_key(partition_key, response_hook=response_hook),
+        )
+        logger.debug("Partition delete started: %s", partition_key)
+
+    def execute_batch_items(self, batch_operations: list, partition_key: str | int, raise_on_error: bool = False):
         """ Execute multiple operations to the Cosmos DB container.
 
         Args:
@@ -84,18 +273,29 @@ class BaseCosmosDBDAL:
                 where operation_type is one of 'create', 'replace', 'delete', etc.
                 item is the item to operate on and options are additional options.
             partition_key (str | int): the partition key for the operations
+            raise_on_error (bool): re-raise the CosmosBatchOperationError instead of returning None,
+                so callers can inspect which operation failed
             
         Returns:
             list: the results of the batch operations or None if  one of the operations fails
         """
         try:
-            batch_results = self.container.execute_item_batch(batch_operations=batch_operations, partition_key=partition_key)
-            return batch_results
+            return self._execute(
+                "execute_item_batch", partition_key,
+                lambda response_hook: self.container.execute_item_batch(
+                    batch_operations=batch_operations, partition_key=partition_key, response_hook=response_hook
+                ),
+            )
         except exceptions.CosmosBatchOperationError as e:
+            if raise_on_error:
+                raise
             error_operation_index = e.error_index
             error_operation_response = e.operation_responses[error_operation_index]
             error_operation = batch_operations[error_operation_index]
-            print("\nError operation: {}, error operation response: {}\n".format(error_operation, error_operation_response))
+            logger.warning(
+                "Error operation: %s, error operation response: %s", error_operation, error_operation_response,
+                extra={"partition_key": partition_key, "status_code": e.status_code},
+            )
             return None
         
     def query_item_by_partition(
@@ -104,42 +304,183 @@ class BaseCosmosDBDAL:
         field_name="*",
         skip: int=0,
         take: int=None,
-        additional_where: Optional[str]=None
+        additional_where: Optional[str]=None,
+        parameters: Optional[list[dict]]=None,
     ):
         """
         Query for specific fields from documents in a partition with pagination.
         
         Args:
-            partition_key_value: Value of the partition key to query
+            partition_key_value: Value of the partition key to query, None to query across
+                every partition
             field_name: Field to retrieve (use "*" for all fields, "field1, field2" for multiple fields)
             skip: Number of items to skip (for pagination)
             take: Maximum number of items to return (None for all)
-            additional_where: Additional WHERE clause conditions (without the "WHERE" keyword)
+            additional_where: Additional WHERE clause conditions (without the "WHERE" keyword),
+                referring to values through @parameters rather than inlining them
+            parameters: the query parameters, e.g. [{"name": "@type", "value": "file_hash"}]
         
         Returns:
             List of query results
         """
-        # Handle field projection
-        if field_name == "*":
-            select_clause = "*"
-        elif "," in field_name:
-            # Multiple fields requested
-            select_clause = f"c.{field_name.replace(',', ', c.')}"
-        else:
-            # Single field requested
-            select_clause = f"c.{field_name}"
-        
-        # Build the query
-        query = f"SELECT {select_clause} FROM c"  
-        # Add WHERE clause if provided
-        if additional_where:
-            query += f" WHERE {additional_where}"
-        # Support pagination
-        if skip > 0 or take is not None:
-            query += f" OFFSET {skip} LIMIT {take}"
-
-        items = list(self.container.query_items(
+        query, parameters = build_partition_query(field_name, additional_where, parameters, skip, take)
+        return self._execute(
+            "query_items", partition_key_value,
+            lambda response_hook: list(self.container.query_items(
+                query=query,
+                parameters=parameters,
+                response_hook=response_hook,
+                **query_scope(partition_key_value),
+            )),
+        )
+
+    def count_items_by_partition(
+        self,
+        partition_key_value: str | int,
+        additional_where: Optional[str]=None,
+        parameters: Optional[list[dict]]=None,
+    ) -> int:
+        """
+        Count the documents of a partition server-side with SELECT VALUE COUNT(1).
+
+        Args:
+            partition_key_value: Value of the partition key to count in
+            additional_where: Additional WHERE clause conditions (without the "WHERE" keyword)
+            parameters: the query parameters
+
+        Returns:
+            int: the number of matching documents
+        """
+        counts = self.query_item_by_partition(
+            partition_key_value,
+            field_name="VALUE COUNT(1)",
+            additional_where=additional_where,
+            parameters=parameters,
+        )
+        # The count comes back as a one-element list
+        return counts[0] if counts else 0
+
+    def iter_item_pages_by_partition(
+        self,
+        partition_key_value: str | int,
+        field_name="*",
+        additional_where: Optional[str]=None,
+        parameters: Optional[list[dict]]=None,
+        max_item_count: int=100,
+        continuation_token: Optional[str]=None,
+    ) -> Iterator[tuple[list, Optional[str]]]:
+        """
+        Stream the documents of a partition page by page using Cosmos continuation tokens.
+
+        Unlike OFFSET/LIMIT, resuming from a continuation token does not re-scan the
+        documents already returned.
+
+        Args:
+            partition_key_value: Value of the partition key to query, None to query across
+                every partition
+            field_name: Field to retrieve (use "*" for all fields, "field1, field2" for multiple fields)
+            additional_where: Additional WHERE clause conditions (without the "WHERE" keyword)
+            parameters: the query parameters
+            max_item_count: the maximum number of items per page
+            continuation_token: a resume token returned with an earlier page, None to start from the beginning
+
+        Yields:
+            tuple[list, str]: the items of a page and the resume token for the next page,
+                None after the last page
+        """
+        query, parameters = build_partition_query(field_name, additional_where, parameters)
+        # The pages are fetched lazily, so the budget is only waited for once and each page charged as it arrives
+        reservation = self.rate_governor.reserve(partition_key_value, "query_items") if self.rate_governor else None
+        if reservation and reservation.wait_s:
+            time.sleep(reservation.wait_s)
+        pager = self.container.query_items(
             query=query,
-            partition_key=partition_key_value
-        ))
-        return items
+            parameters=parameters,
+            max_item_count=max_item_count,
+            **query_scope(partition_key_value),
+            response_hook=chain_response_hooks(
+                self.instrumentation.response_hook("query_items", partition_key_value) if self.instrumentation else None,
+                self.rate_governor.response_hook(reservation) if reservation else None,
+            ),
+        ).by_page(decode_resume_token(continuation_token))
+        for page in pager:
+            items = list(page)
+            yield items, encode_resume_token(pager.continuation_token)
+
+
+def chain_response_hooks(*hooks: Optional[Callable]) -> Optional[Callable]:
+    """ Combine Cosmos DB response_hooks into one, None if there are none. """
+    hooks = [hook for hook in hooks if hook is not None]
+    if len(hooks) <= 1:
+        return hooks[0] if hooks else None
+
+    def hook(headers, result):
+        for response_hook in hooks:
+            response_hook(headers, result)
+    return hook
+
+
+def query_scope(partition_key_value) -> dict:
+    """ The query_items arguments scoping a query to a partition, or across all of them for None. """
+    if partition_key_value is None:
+        return {"enable_cross_partition_query": True}
+    return {"partition_key": partition_key_value}
+
+
+def build_partition_query(
+    field_name: str="*",
+    additional_where: Optional[str]=None,
+    parameters: Optional[list[dict]]=None,
+    skip: int=0,
+    take: Optional[int]=None,
+) -> tuple[str, list[dict]]:
+    """
+    Build a parameterised query so Cosmos DB can reuse its query plan.
+
+    Args:
+        field_name: Field to retrieve (use "*" for all fields, "field1, field2" for multiple fields,
+            or a VALUE expression such as "VALUE COUNT(1)", which is used as is)
+        additional_where: Additional WHERE clause conditions (without the "WHERE" keyword)
+        parameters: the parameters used by additional_where
+        skip: Number of items to skip
+        take: Maximum number of items to return (None for all)
+
+    Returns:
+        tuple[str, list[dict]]: the query and its parameters
+    """
+    parameters = list(parameters or [])
+    # Handle field projection
+    if field_name == "*" or field_name.startswith("VALUE "):
+        select_clause = field_name
+    elif "," in field_name:
+        # Multiple fields requested
+        select_clause = ", ".join(f"c.{field.strip()}" for field in field_name.split(","))
+    else:
+        # Single field requested
+        select_clause = f"c.{field_name}"
+    
+    # Build the query
+    query = f"SELECT {select_clause} FROM c"  
+    # Add WHERE clause if provided
+    if additional_where:
+        query += f" WHERE {additional_where}"
+    # Support pagination
+    if skip > 0 or take is not None:
+        query += " OFFSET @skip LIMIT @take"
+        parameters.append({"name": "@skip", "value": skip})
+        parameters.append({"name": "@take", "value": take if take is not None else MAX_QUERY_LIMIT})
+    return query, parameters
+
+
+def encode_resume_token(continuation_token: Optional[str]) -> Optional[str]:
+    """ Wrap a Cosmos continuation token into an opaque, URL-safe resume token. """
+    if continuation_token is None:
+        return None
+    return base64.urlsafe_b64encode(continuation_token.encode()).decode()
+
+
+def decode_resume_token(resume_token: Optional[str]) -> Optional[str]:
+    """ Unwrap a resume token produced by encode_resume_token. """
+    if resume_token is None:
+        return None
+    return base64.urlsafe_b64decode(resume_token.encode()).decode()
@@ -1,54 +1,47 @@
 from dataclasses import dataclass
 from enum import Enum
-from typing import Optional
+from typing import Iterable, Optional
 
 class CosmosDocumentType(Enum):
     """An enum for the cosmos document types."""
     FILE_HASH = "file_hash"
     DEPLOYMENT_METADATA = "deployment_metadata"
-    
-@dataclass
-class DeploymentFileHashDocument:
-    """ A class for deployment file hash documents in Cosmos DB."""
-    file_hash: str  # This is the id in the Cosmos DB document
-    deployment_id: int
-    created_ms: int
-    
-    @property
-    def type(self) -> str:
-        """ Returns the type of the Cosmos document. """
-        return CosmosDocumentType.FILE_HASH.value
-    
-    def from_dict(data: dict):
-        """ Creates a DeploymentFileHashDocument from a dictionary.
+    HASH_COUNT_SHARD = "hash_count_shard"
 
-        Args:
-            data (dict): the dictionary to convert
 
-        Returns:
-            DeploymentFileHashDocument: the created document
-        """
-        assert data["type"] == CosmosDocumentType.FILE_HASH.value, "Invalid document type"
-        return DeploymentFileHashDocument(
-            file_hash=data["id"],
-            deployment_id=int(data["deployment_id"]),
-            created_ms=data["created_ms"]
+def check_document_type(data: dict, document_type: CosmosDocumentType):
+    """ Checks a Cosmos document has the expected type.
+
+    Args:
+        data (dict): the Cosmos document
+        document_type (CosmosDocumentType): the expected type
+
+    Raises:
+        ValueError: if the document is not a dict of the expected type
+    """
+    if not isinstance(data, dict) or data.get("type") != document_type.value:
+        found = data.get("type") if isinstance(data, dict) else type(data).__name__
+        raise ValueError(f"Invalid document type: expected {document_type.value}, got {found}")
+
+
+def _required(data: dict, field: str, expected_type: type | tuple[type, ...]):
+    """ Returns a required field of a Cosmos document, raising ValueError if it is missing
+    or not of the expected type. bool is not accepted for int.
+    """
+    try:
+        value = data[field]
+    except KeyError:
+        raise ValueError(f"Invalid {data.get('type')} document {data.get('id')}: missing {field}") from None
+    expected = expected_type if isinstance(expected_type, tuple) else (expected_type,)
+    if not isinstance(value, expected) or (isinstance(value, bool) and bool not in expected):
+        names = " or ".join("null" if t is type(None) else t.__name__ for t in expected)
+        raise ValueError(
+            f"Invalid {data.get('type')} document {data.get('id')}: {field} must be {names}, got {type(value).__name__}"
         )
-    
-    def to_dict(self) -> dict:
-        """ Converts the DeploymentFileHashDocument to a dictionary.
+    return value
 
-        Returns:
-            dict: the dictionary representation of the document
-        """
-        return {
-            "id": self.file_hash,
-            "deployment_id": self.deployment_id,
-            "created_ms": self.created_ms,
-            "type": self.type,
-        }
-        
-@dataclass
+
+@dataclass(slots=True)
 class DeploymentMetadataDocument:
     """ A class for deployment metadata documents in Cosmos DB."""
     deployment_id: int  # this is the id in the Cosmos DB document
@@ -57,31 +50,42 @@ class DeploymentMetadataDocument:
     upload_in_progress: bool
     upload_user_id: Optional[str]
     last_update_ms: int
-    
+    counter_shards: int = 1  # number of hash_count shard documents, 1 keeps the single-document layout
+
     @property
     def type(self) -> str:
         """ Returns the type of the Cosmos document. """
         return CosmosDocumentType.DEPLOYMENT_METADATA.value
 
-    def from_dict(data: dict):
-        """ Creates a DeploymentMetadataDocument from a dictionary. 
-        
+    @staticmethod
+    def from_dict(data: dict) -> "DeploymentMetadataDocument":
+        """ Creates a DeploymentMetadataDocument from a dictionary.
+
         Args:
             data (dict): the dictionary to convert
-            
+
         Returns:
             DeploymentMetadataDocument: the created document
+
+        Raises:
+            ValueError: if the dictionary is not a valid deployment metadata document
         """
-        assert data["type"] == CosmosDocumentType.DEPLOYMENT_METADATA.value, "Invalid document type"
+        check_document_type(data, CosmosDocumentType.DEPLOYMENT_METADATA)
         return DeploymentMetadataDocument(
-            deployment_id=int(data["id"]),
-            project_id=data["project_id"],
-            hash_count=data["hash_count"],
-            upload_in_progress=data["upload_in_progress"],
-            upload_user_id=data["upload_user_id"],
-            last_update_ms=data["last_update_ms"]
+            deployment_id=int(_required(data, "id", str)),
+            project_id=_required(data, "project_id", int),
+            hash_count=_required(data, "hash_count", int),
+            upload_in_progress=_required(data, "upload_in_progress", bool),
+            upload_user_id=_required(data, "upload_user_id", (str, type(None))),
+            last_update_ms=_required(data, "last_update_ms", int),
+            counter_shards=_required(data, "counter_shards", int) if "counter_shards" in data else 1,
         )
 
+    @staticmethod
+    def from_dicts(items: Iterable[dict]) -> list["DeploymentMetadataDocument"]:
+        """ Creates many DeploymentMetadataDocuments, see from_dict. """
+        return [DeploymentMetadataDocument.from_dict(item) for item in items]
+
     def to_dict(self) -> dict:
         """ Converts the DeploymentMetadataDocument to a dictionary.
 
@@ -96,5 +100,70 @@ class DeploymentMetadataDocument:
             "upload_in_progress": self.upload_in_progress,
             "upload_user_id": self.upload_user_id,
             "last_update_ms": self.last_update_ms,
-            "type": self.type,
-        }
\ No newline at end of file
+            "counter_shards": self.counter_shards,
+            "type": CosmosDocumentType.DEPLOYMENT_METADATA.value,
+        }
+
+    @staticmethod
+    def to_dicts(documents: Iterable["DeploymentMetadataDocument"]) -> list[dict]:
+        """ Converts many DeploymentMetadataDocuments to dictionaries, see to_dict. """
+        return [document.to_dict() for document in documents]
+
+@dataclass(slots=True)
+class DeploymentCounterShardDocument:
+    """ A class for the hash_count shard documents of a deployment in Cosmos DB."""
+    deployment_id: int
+    shard: int
+    hash_count: int
+    last_update_ms: int
+
+    @property
+    def type(self) -> str:
+        """ Returns the type of the Cosmos document. """
+        return CosmosDocumentType.HASH_COUNT_SHARD.value
+
+    @staticmethod
+    def shard_id(deployment_id: int, shard: int) -> str:
+        """ Returns the Cosmos DB id of a shard document. """
+        return f"{deployment_id}-hash-count-{shard}"
+
+    @staticmethod
+    def from_dict(data: dict) -> "DeploymentCounterShardDocument":
+        """ Creates a DeploymentCounterShardDocument from a dictionary.
+
+        Args:
+            data (dict): the dictionary to convert
+
+        Returns:
+            DeploymentCounterShardDocument: the created document
+
+        Raises:
+            ValueError: if the dictionary is not a valid hash_count shard document
+        """
+        check_document_type(data, CosmosDocumentType.HASH_COUNT_SHARD)
+        return DeploymentCounterShardDocument(
+            deployment_id=_required(data, "deployment_id", int),
+            shard=_required(data, "shard", int),
+            hash_count=_required(data, "hash_count", int),
+            last_update_ms=_required(data, "last_update_ms", int)
+        )
+
+    @staticmethod
+    def from_dicts(items: Iterable[dict]) -> list["DeploymentCounterShardDocument"]:
+        """ Creates many DeploymentCounterShardDocuments, see from_dict. """
+        return [DeploymentCounterShardDocument.from_dict(item) for item in items]
+
+    def to_dict(self) -> dict:
+        """ Converts the DeploymentCounterShardDocument to a dictionary.
+
+        Returns:
+            dict: the dictionary representation of the document
+        """
+        return {
+            "id": self.shard_id(self.deployment_id, self.shard),
+            "deployment_id": self.deployment_id,
+            "shard": self.shard,
+            "hash_count": self.hash_count,
+            "last_update_ms": self.last_update_ms,
+            "type": CosmosDocumentType.HASH_COUNT_SHARD.value,
+        }
@@ -1,24 +1,402 @@
 # src/dal/deployment_cosmos_db_dal.py
 
-from typing import Optional
+import logging
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable, Iterator, Optional
 from uuid import UUID
 
 from datetime import datetime, timezone
 
-from shared.cosmos_db_dal import BaseCosmosDBDAL
-from shared.cosmos_documents import DeploymentFileHashDocument, DeploymentMetadataDocument
+from azure.cosmos import exceptions
 
+from shared.cosmos_db_dal import BaseCosmosDBDAL, decode_resume_token, encode_resume_token
+from shared.cosmos_documents import (
+    CosmosDocumentType,
+    DeploymentCounterShardDocument,
+    DeploymentMetadataDocument,
+)
+from shared.document_cache import DocumentCache
+from shared.instrumentation import Instrumentation, map_in_context
+from shared.rate_governor import RateGovernor
+from shared.seen_hash_filter import SeenHashFilter
 
-class DeploymentCosmosDBDAL(BaseCosmosDBDAL):
-    """A class for interacting with the Cosmos DB container for deployment metadata."""
+logger = logging.getLogger(__name__)
+
+# Cosmos DB limits a transactional batch to 100 operations
+MAX_BATCH_OPERATIONS = 100
+# Attempts at an ETag-conditioned read-modify-replace before giving up
+MAX_REPLACE_ATTEMPTS = 5
+# Upper bound on hash_count shards, leaving room in a batch for the hash creates
+MAX_COUNTER_SHARDS = 50
+# Candidate hashes per existence query, keeping the query text well under the Cosmos DB size limit
+EXISTENCE_QUERY_CHUNK_SIZE = 500
+# Deployments reconciled concurrently, and listed per page, by reconcile_hash_counts
+RECONCILE_CONCURRENCY = 16
+RECONCILE_PAGE_SIZE = 500
+# Partition ranges read at once by the bulk metadata reads
+BULK_READ_CONCURRENCY = 8
+# Ids fetched per page of a batched deployment delete, deleted in batches of MAX_BATCH_OPERATIONS
+DELETE_PAGE_SIZE = 1000
+# Batches of a page deleted at once
+DELETE_CONCURRENCY = 4
+# RU per second a batched deployment delete may use by default, a tenth of what one physical
+# partition serves, like a delete by partition key, so it leaves throughput to the ingestion
+DELETE_RU_PER_SECOND = 1000.0
+# How long a delete batch may wait for the RU budget of a paced deployment delete
+DELETE_MAX_WAIT_MS = 60000
+# The metadata fields returned by the project listing, enough to build a DeploymentMetadataDocument
+METADATA_PROJECTION = "id, type, project_id, hash_count, upload_in_progress, upload_user_id, last_update_ms, counter_shards"
+
+
+class FileHashStatus(Enum):
+    """The outcome of adding a file hash."""
+    ADDED = "added"
+    DUPLICATE = "duplicate"
+    FAILED = "failed"
+
+
+class FileHashResults(dict):
+    """The outcome of each file hash passed to add_file_hashes, keyed by file hash.
+
+    errors holds the exception behind each FAILED hash, e.g. the batch error with its
+    status code, so a throttled write can be told from one that will never succeed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors: dict[str, Exception] = {}
+
+
+@dataclass
+class HashCountReconciliation:
+    """The outcome of reconciling the hash_count of one deployment."""
+    deployment_id: int
+    recorded: Optional[int] = None  # hash_count of the metadata plus its shards, before reconciling
+    actual: Optional[int] = None  # number of file_hash documents
+    updated: bool = False
+    error: Optional[str] = None
+
+    @property
+    def drift(self) -> Optional[int]:
+        """ Returns how many hashes the recorded hash_count was missing, negative if it was too high. """
+        if self.recorded is None or self.actual is None:
+            return None
+        return self.actual - self.recorded
+
+
+@dataclass
+class DeploymentDeletion:
+    """ The progress of a cascading deployment delete. """
+    deployment_id: int
+    deleted: int = 0  # documents deleted by batches so far
+    pages: int = 0  # pages of ids deleted so far
+    partition_delete: bool = False  # deleted with a delete by partition key, which completes in the background
+    completed: bool = False
+
+
+class DeploymentDALMixin:
+    """Process-local state and helpers that don't touch Cosmos DB, shared by the
+    synchronous and asynchronous deployment DALs.
+    """
+    # Every document of a deployment carries its partition key in this field
+    partition_key_field = "deployment_id"
+
+    def _init_deployment_state(
+        self,
+        seen_hashes: Optional[SeenHashFilter],
+        metadata_cache: Optional[DocumentCache],
+        conditional_reads: bool,
+    ):
+        """ Initializes the caches used by the deployment DAL.
+
+        Args:
+            seen_hashes (SeenHashFilter): optional filter of hashes known to be stored
+            metadata_cache (DocumentCache): optional cache of metadata documents
+            conditional_reads (bool): revalidate expired cache entries with an If-None-Match read
+        """
+        self.seen_hashes = seen_hashes
+        self.metadata_cache = metadata_cache
+        self.conditional_reads = conditional_reads
+        # Shard counts never change after creation, so they are cached per deployment
+        self._counter_shards: dict[int, int] = {}
+
+    @staticmethod
+    def _metadata_increment_operation(item_id: str, increment: int, now_ms: int) -> tuple:
+        """Build the batch operation that atomically increments hash_count.
+
+        Args:
+            item_id (str): the id of the metadata or shard document
+            increment (int): the number of hashes added
+            now_ms (int): the update timestamp in milliseconds
+
+        Returns:
+            tuple: the patch batch operation
+        """
+        return ("patch", (item_id, [
+            {"op": "incr", "path": "/hash_count", "value": increment},
+            {"op": "set", "path": "/last_update_ms", "value": now_ms},
+        ]))
+    
+    @staticmethod
+    def _shard_increment_operations(
+        deployment_id: int, file_hashes: list[str], counter_shards: int, now_ms: int
+    ) -> list[tuple]:
+        """Build the patch operations counting the given hashes.
+
+        Unsharded deployments get a single patch on the metadata document; sharded ones
+        one patch per shard touched, the shard being picked from the file hash.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            file_hashes (list[str]): the file hashes being added
+            counter_shards (int): the number of hash_count shards of the deployment
+            now_ms (int): the update timestamp in milliseconds
+
+        Returns:
+            list[tuple]: the patch batch operations
+        """
+        if counter_shards == 1:
+            return [DeploymentDALMixin._metadata_increment_operation(str(deployment_id), len(file_hashes), now_ms)]
+        increments: dict[int, int] = {}
+        for file_hash in file_hashes:
+            shard = zlib.crc32(file_hash.encode()) % counter_shards
+            increments[shard] = increments.get(shard, 0) + 1
+        return [
+            DeploymentDALMixin._metadata_increment_operation(
+                DeploymentCounterShardDocument.shard_id(deployment_id, shard), increment, now_ms
+            )
+            for shard, increment in sorted(increments.items())
+        ]
+
+    @staticmethod
+    def _file_hash_batch_operations(deployment_id: int, file_hashes: list[str], counter_shards: int) -> list[tuple]:
+        """Build a transactional batch creating the given hashes and counting them.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            file_hashes (list[str]): the file hashes to create
+            counter_shards (int): the number of hash_count shards of the deployment
+
+        Returns:
+            list[tuple]: the hash creates followed by the hash_count patches
+        """
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        document_type = CosmosDocumentType.FILE_HASH.value
+        batch_operations = [
+            ('create', ({"id": file_hash, "deployment_id": deployment_id, "created_ms": now_ms, "type": document_type},))
+            for file_hash in file_hashes
+        ]
+        batch_operations.extend(
+            DeploymentDALMixin._shard_increment_operations(deployment_id, file_hashes, counter_shards, now_ms)
+        )
+        return batch_operations
+
+    def _filter_seen_hashes(
+        self, deployment_id: int, file_hashes: list[str]
+    ) -> tuple[FileHashResults, list[str]]:
+        """Set aside the hashes the seen-hash filter knows are stored.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            file_hashes (list[str]): the file hashes to add
+
+        Returns:
+            tuple[FileHashResults, list[str]]: the initial outcome of every hash,
+                and the distinct hashes that still have to be written
+        """
+        results = FileHashResults((file_hash, FileHashStatus.FAILED) for file_hash in file_hashes)
+        pending = []
+        for file_hash in results:
+            if self.seen_hashes and self.seen_hashes.contains(deployment_id, file_hash):
+                results[file_hash] = FileHashStatus.DUPLICATE
+            else:
+                pending.append(file_hash)
+        return results, pending
+
+    def _record_hash_batch_error(
+        self,
+        deployment_id: int,
+        chunk: list[str],
+        pending: list[str],
+        results: FileHashResults,
+        error: exceptions.CosmosBatchOperationError,
+    ) -> bool:
+        """Handle a failed hash batch.
+
+        If a create failed, that hash is dropped from pending (and marked as a
+        duplicate on 409) so the rest of the chunk can be retried. If the hash_count
+        patch failed, nothing more can be written and every pending hash fails with
+        the batch error.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            chunk (list[str]): the hashes of the failed batch
+            pending (list[str]): the hashes still to be written, updated in place
+            results (FileHashResults): the outcome of every hash, updated in place
+            error (CosmosBatchOperationError): the batch error
+
+        Returns:
+            bool: True if the remaining hashes should be retried
+
+        Raises:
+            ValueError: if the deployment metadata does not exist
+        """
+        if error.error_index is not None and error.error_index < len(chunk):
+            file_hash = chunk[error.error_index]
+            pending.remove(file_hash)
+            if error.status_code == 409:
+                results[file_hash] = FileHashStatus.DUPLICATE
+                self._remember_file_hash(deployment_id, file_hash)
+            else:
+                results.errors[file_hash] = error
+            return True
+        if error.status_code == 404:
+            raise ValueError(f"Deployment metadata does not exist for {deployment_id}.")
+        # The metadata update itself failed, nothing more can be written
+        logger.warning(
+            "Error updating deployment metadata for %s: %s", deployment_id, error.message,
+            extra={"deployment_id": deployment_id, "status_code": error.status_code},
+        )
+        for file_hash in pending:
+            results.errors[file_hash] = error
+        return False
+
+    @staticmethod
+    def _unchecked_conflict_hashes(
+        chunk: list[str], error: exceptions.CosmosBatchOperationError
+    ) -> list[str]:
+        """Get the other hashes of a batch that failed because one of its hashes exists.
+
+        A redelivered batch usually holds more stored hashes than the one that conflicted,
+        so they are looked up in one query rather than found one failed batch at a time.
+
+        Args:
+            chunk (list[str]): the hashes of the failed batch
+            error (CosmosBatchOperationError): the batch error
+
+        Returns:
+            list[str]: the hashes to check, empty unless a create conflicted
+        """
+        if error.status_code != 409 or error.error_index is None or error.error_index >= len(chunk):
+            return []
+        return chunk[:error.error_index] + chunk[error.error_index + 1:]
+
+    def _drop_stored_hashes(
+        self,
+        deployment_id: int,
+        pending: list[str],
+        results: FileHashResults,
+        existing: set[str],
+    ):
+        """Mark the hashes found to be stored as duplicates and stop writing them.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            pending (list[str]): the hashes still to be written, updated in place
+            results (FileHashResults): the outcome of every hash, updated in place
+            existing (set[str]): the pending hashes that are already stored
+        """
+        if not existing:
+            return
+        pending[:] = [file_hash for file_hash in pending if file_hash not in existing]
+        for file_hash in existing:
+            results[file_hash] = FileHashStatus.DUPLICATE
+            self._remember_file_hash(deployment_id, file_hash)
+
+    def _record_hash_batch_success(
+        self,
+        deployment_id: int,
+        chunk: list[str],
+        results: FileHashResults,
+        batch_operations: list,
+        batch_results: list,
+    ):
+        """Mark the hashes of a committed batch as added and refresh the caches.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            chunk (list[str]): the hashes of the batch
+            results (FileHashResults): the outcome of every hash, updated in place
+            batch_operations (list): the operations of the batch
+            batch_results (list): the per-operation results of the batch
+        """
+        for file_hash in chunk:
+            results[file_hash] = FileHashStatus.ADDED
+            self._remember_file_hash(deployment_id, file_hash)
+        self._cache_metadata_from_batch(deployment_id, batch_operations, batch_results)
+
+    def _remember_file_hash(self, deployment_id: int, file_hash: str):
+        """Record a stored hash in the seen-hash filter, if there is one."""
+        if self.seen_hashes:
+            self.seen_hashes.add(deployment_id, file_hash)
+
+    def _cache_metadata_item(self, deployment_id: int, data: Optional[dict]):
+        """Store a metadata document returned by Cosmos DB, or drop the cached one.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            data (dict): the document as returned by Cosmos DB, None if unknown or deleted
+        """
+        if not self.metadata_cache:
+            return
+        if data and data.get("_etag"):
+            self.metadata_cache.put(deployment_id, dict(data), data["_etag"])
+        else:
+            self.metadata_cache.invalidate(deployment_id)
+
+    def _cache_metadata_from_batch(self, deployment_id: int, batch_operations: list, batch_results: list):
+        """Refresh the cached metadata document from the response to a batch that patched it.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            batch_operations (list): the operations of the batch
+            batch_results (list): the per-operation results of the batch
+        """
+        if not self.metadata_cache:
+            return
+        item_id = str(deployment_id)
+        for operation, result in zip(batch_operations, batch_results):
+            if operation[0] == "patch" and operation[1][0] == item_id:
+                self._cache_metadata_item(deployment_id, result.get("resourceBody"))
+
+
+class DeploymentCosmosDBDAL(DeploymentDALMixin, BaseCosmosDBDAL):
+    """A class for interacting with the Cosmos DB container for deployment metadata.
+
+    A deployment's hash_count either lives on its metadata document or, for large
+    deployments created with counter_shards > 1, is spread over that many shard
+    documents in the same partition so concurrent writers don't contend for one item.
+    """
     
-    def __init__(self, container):
+    def __init__(
+        self,
+        container,
+        seen_hashes: Optional[SeenHashFilter] = None,
+        metadata_cache: Optional[DocumentCache] = None,
+        conditional_reads: bool = False,
+        instrumentation: Optional[Instrumentation] = None,
+        rate_governor: Optional[RateGovernor] = None,
+    ):
         """ Initializes the DeploymentCosmosDBDAL with the Cosmos DB container.
 
         Args:
             container (_type_): _description_
+            seen_hashes (SeenHashFilter): optional filter of hashes known to be stored,
+                used to skip duplicates without calling Cosmos DB
+            metadata_cache (DocumentCache): optional cache of metadata documents keyed by
+                deployment id, kept up to date by this DAL's own writes
+            conditional_reads (bool): revalidate expired cache entries with an
+                If-None-Match read instead of a full read
+            instrumentation (Instrumentation): optional collector of latencies and request
+                charges, which are attributed to the deployment id
+            rate_governor (RateGovernor): optional RU budget per deployment partition,
+                retrying throttled calls within the invocation
         """
-        super().__init__(container)
+        super().__init__(container, instrumentation, rate_governor)
+        self._init_deployment_state(seen_hashes, metadata_cache, conditional_reads)
     
     def get_deployment_metadata(
         self, deployment_id: int
@@ -31,80 +409,526 @@ class DeploymentCosmosDBDAL(BaseCosmosDBDAL):
         Returns:
             DeploymentMetadata: the metadata if found, None otherwise
         """
-        data = self.get_item(item_id=str(deployment_id), partition_key=deployment_id)
-        return DeploymentMetadataDocument.from_dict(data) if data else None
+        data = self._read_metadata_item(deployment_id)
+        if not data:
+            return None
+        metadata = DeploymentMetadataDocument.from_dict(data)
+        self._counter_shards[deployment_id] = metadata.counter_shards
+        if metadata.counter_shards > 1:
+            metadata.hash_count += sum(shard.hash_count for shard in self.get_counter_shards(deployment_id))
+        return metadata
+
+    def get_deployment_metadata_many(
+        self,
+        deployment_ids: list[int],
+        max_concurrency: int = BULK_READ_CONCURRENCY,
+    ) -> dict[int, DeploymentMetadataDocument]:
+        """Get the metadata of many deployments at once.
+
+        Fresh cached documents are served from the metadata cache, the rest are read with
+        a single read_items call instead of one point read per deployment. The shards of
+        sharded deployments are summed with cross-partition ARRAY_CONTAINS queries rather
+        than one query per deployment.
+
+        Args:
+            deployment_ids (list[int]): the ids of the deployments
+            max_concurrency (int): the maximum number of partition ranges read, or shard
+                queries run, at once
+
+        Returns:
+            dict[int, DeploymentMetadataDocument]: the metadata by deployment id, without
+                the deployments that do not exist
+        """
+        documents = {}
+        missing = []
+        for deployment_id in dict.fromkeys(deployment_ids):
+            entry = self.metadata_cache.get_entry(deployment_id) if self.metadata_cache else None
+            if entry is not None and not entry.expired:
+                documents[deployment_id] = dict(entry.value)
+            else:
+                missing.append(deployment_id)
+        items = self.read_many_items(
+            [(str(deployment_id), deployment_id) for deployment_id in missing], max_concurrency=max_concurrency
+        )
+        for item in items:
+            deployment_id = int(item["id"])
+            self._cache_metadata_item(deployment_id, item)
+            documents[deployment_id] = item
+        for deployment_id in missing:
+            if deployment_id not in documents:
+                self._cache_metadata_item(deployment_id, None)
+
+        metadata = {}
+        for deployment_id, data in documents.items():
+            metadata[deployment_id] = DeploymentMetadataDocument.from_dict(data)
+            self._counter_shards[deployment_id] = metadata[deployment_id].counter_shards
+        self._add_shard_counts(list(metadata.values()), max_concurrency)
+        return metadata
+
+    def iter_project_deployment_pages(
+        self,
+        project_id: int,
+        page_size: int = 100,
+        resume_token: Optional[str] = None,
+        max_concurrency: int = BULK_READ_CONCURRENCY,
+    ) -> Iterator[tuple[list[DeploymentMetadataDocument], Optional[str]]]:
+        """Stream the metadata of every deployment of a project page by page.
+
+        The deployments are found with a cross-partition query projected to the metadata
+        fields, so the system properties are not returned, and the shards of the sharded
+        deployments of each page are summed with a single query. The documents are not
+        cached, having no etag.
+
+        Args:
+            project_id (int): the id of the project
+            page_size (int): the maximum number of deployments per page
+            resume_token (str): the token returned with an earlier page, to resume after it
+            max_concurrency (int): the maximum number of shard queries run at once
+
+        Yields:
+            tuple[list[DeploymentMetadataDocument], str]: the metadata of a page and the
+                token to resume after it, None after the last page
+        """
+        pages = self.iter_item_pages_by_partition(
+            partition_key_value=None,
+            field_name=METADATA_PROJECTION,
+            additional_where="c.type = @type AND c.project_id = @project_id",
+            parameters=[
+                {"name": "@type", "value": CosmosDocumentType.DEPLOYMENT_METADATA.value},
+                {"name": "@project_id", "value": project_id},
+            ],
+            max_item_count=page_size,
+            continuation_token=resume_token,
+        )
+        for items, next_resume_token in pages:
+            metadata = DeploymentMetadataDocument.from_dicts(items)
+            for document in metadata:
+                self._counter_shards[document.deployment_id] = document.counter_shards
+            self._add_shard_counts(metadata, max_concurrency)
+            yield metadata, next_resume_token
+
+    def get_project_deployments(self, project_id: int, page_size: int = 100) -> list[DeploymentMetadataDocument]:
+        """Get the metadata of every deployment of a project, see iter_project_deployment_pages.
+
+        Args:
+            project_id (int): the id of the project
+            page_size (int): the number of deployments fetched per query page
+
+        Returns:
+            list[DeploymentMetadataDocument]: the metadata of the deployments
+        """
+        return [
+            document
+            for metadata, _ in self.iter_project_deployment_pages(project_id, page_size=page_size)
+            for document in metadata
+        ]
+
+    def _add_shard_counts(
+        self,
+        metadata: list[DeploymentMetadataDocument],
+        max_concurrency: int = BULK_READ_CONCURRENCY,
+        chunk_size: int = EXISTENCE_QUERY_CHUNK_SIZE,
+    ):
+        """Add the shard totals to the hash_count of the sharded deployments of a list.
+
+        Args:
+            metadata (list[DeploymentMetadataDocument]): the metadata documents, updated in place
+            max_concurrency (int): the maximum number of queries in flight
+            chunk_size (int): the number of deployments per query
+        """
+        sharded = {document.deployment_id: document for document in metadata if document.counter_shards > 1}
+        if not sharded:
+            return
+        deployment_ids = list(sharded)
+        chunks = [deployment_ids[i:i + chunk_size] for i in range(0, len(deployment_ids), chunk_size)]
+
+        def query_chunk(chunk: list[int]) -> list[dict]:
+            return self.query_item_by_partition(
+                partition_key_value=None,
+                field_name="deployment_id, hash_count",
+                additional_where="c.type = @type AND ARRAY_CONTAINS(@ids, c.deployment_id)",
+                parameters=[
+                    {"name": "@type", "value": CosmosDocumentType.HASH_COUNT_SHARD.value},
+                    {"name": "@ids", "value": chunk},
+                ],
+            )
+
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(chunks))) as executor:
+            for items in map_in_context(executor, query_chunk, chunks):
+                for item in items:
+                    sharded[int(item["deployment_id"])].hash_count += item["hash_count"]
 
     def add_deployment_metadata(
-        self, deployment_id: int, project_id: int
+        self, deployment_id: int, project_id: int, counter_shards: int = 1
     ) -> Optional[DeploymentMetadataDocument]:
         """Adds a new deployment item to the Cosmos DB container.
 
         Args:
             deployment_id (int): the id of the deployment item
             project_id (int): the id of the project
+            counter_shards (int): the number of hash_count shard documents, 1 keeps the
+                count on the metadata document
 
         Returns:
             DeploymentMetadata: the created item or None if the operation fails
         """
+        if not 1 <= counter_shards <= MAX_COUNTER_SHARDS:
+            raise ValueError(f"counter_shards must be between 1 and {MAX_COUNTER_SHARDS}.")
         if self.get_deployment_metadata(deployment_id):
             raise ValueError(
                 "Deployment metadata already exists."
             )
         
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
         metadata = DeploymentMetadataDocument(
             deployment_id=deployment_id,
             project_id=project_id,
             hash_count=0,
             upload_in_progress=False,
             upload_user_id=None,
-            last_update_ms=int(datetime.now(timezone.utc).timestamp() * 1000),
+            last_update_ms=now_ms,
+            counter_shards=counter_shards,
         )
-        item = self.add_item(metadata.to_dict())
-        if item is None:
+        if counter_shards == 1:
+            item = self.add_item(metadata.to_dict())
+            if item is None:
+                raise ValueError("Failed to add deployment metadata: ", metadata.to_dict())
+            self._cache_metadata_item(deployment_id, item)
+            return DeploymentMetadataDocument.from_dict(item)
+
+        # Create the metadata and its shards together
+        batch_operations = [('create', (metadata.to_dict(),))]
+        for shard in range(counter_shards):
+            shard_document = DeploymentCounterShardDocument(
+                deployment_id=deployment_id,
+                shard=shard,
+                hash_count=0,
+                last_update_ms=now_ms,
+            )
+            batch_operations.append(('create', (shard_document.to_dict(),)))
+        results = self.execute_batch_items(batch_operations, partition_key=deployment_id)
+        if not results:
             raise ValueError("Failed to add deployment metadata: ", metadata.to_dict())
-        return DeploymentMetadataDocument.from_dict(item)
-    
+        self._counter_shards[deployment_id] = counter_shards
+        self._cache_metadata_item(deployment_id, results[0].get("resourceBody"))
+        return metadata
+
+    def _read_metadata_item(self, deployment_id: int, use_cache: bool = True) -> Optional[dict]:
+        """Read the raw metadata document, going through the metadata cache if there is one.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            use_cache (bool): serve a fresh cached copy if there is one
+
+        Returns:
+            dict: the metadata document if found, None otherwise
+        """
+        if not self.metadata_cache:
+            return self.get_item(item_id=str(deployment_id), partition_key=deployment_id)
+        entry = self.metadata_cache.get_entry(deployment_id) if use_cache else None
+        if entry is not None and not entry.expired:
+            return dict(entry.value)
+        if entry is not None and entry.etag and self.conditional_reads:
+            modified, data = self.get_item_if_modified(str(deployment_id), deployment_id, entry.etag)
+            if not modified:
+                self.metadata_cache.revalidate(deployment_id)
+                return dict(entry.value)
+        else:
+            data = self.get_item(item_id=str(deployment_id), partition_key=deployment_id)
+        self._cache_metadata_item(deployment_id, data)
+        return data
+
+    def get_counter_shards(self, deployment_id: int) -> list[DeploymentCounterShardDocument]:
+        """Get the hash_count shard documents of a deployment.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+
+        Returns:
+            list[DeploymentCounterShardDocument]: the shards, empty if the deployment is not sharded
+        """
+        items = self.query_item_by_partition(
+            partition_key_value=deployment_id,
+            additional_where="c.type = @type",
+            parameters=[{"name": "@type", "value": CosmosDocumentType.HASH_COUNT_SHARD.value}],
+        )
+        return DeploymentCounterShardDocument.from_dicts(items)
+
+    def compact_counter_shards(self, deployment_id: int) -> int:
+        """Fold the shard counts back into the metadata document's hash_count.
+
+        Every shard is decremented by the count it held and the metadata incremented by
+        the total in one transactional batch, so increments landing meanwhile are kept.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+
+        Returns:
+            int: the number of hashes moved onto the metadata document
+
+        Raises:
+            ValueError: if the compaction batch fails
+        """
+        shards = [shard for shard in self.get_counter_shards(deployment_id) if shard.hash_count]
+        total = sum(shard.hash_count for shard in shards)
+        if not total:
+            return 0
+        now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+        batch_operations = [self._metadata_increment_operation(str(deployment_id), total, now_ms)]
+        for shard in shards:
+            batch_operations.append(self._metadata_increment_operation(
+                DeploymentCounterShardDocument.shard_id(deployment_id, shard.shard), -shard.hash_count, now_ms
+            ))
+        results = self.execute_batch_items(batch_operations, partition_key=deployment_id)
+        if not results:
+            raise ValueError(f"Failed to compact hash_count shards for {deployment_id}.")
+        self._cache_metadata_item(deployment_id, results[0].get("resourceBody"))
+        return total
+
+    def reconcile_hash_count(self, deployment_id: int, dry_run: bool = False) -> HashCountReconciliation:
+        """Recount the file hashes of a deployment and correct its hash_count if it drifted.
+
+        The metadata and shard documents are read before the file_hash documents are
+        counted server-side, and the rewrite is a transactional batch of replaces
+        conditioned on all their ETags. Any hash added meanwhile changes one of those
+        ETags, failing the batch, and the reconciliation starts over. The corrected
+        count is put on the metadata document and the shards reset to 0.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            dry_run (bool): only count, never rewrite
+
+        Returns:
+            HashCountReconciliation: the recorded and actual counts and whether hash_count was rewritten
+
+        Raises:
+            ValueError: if the deployment metadata does not exist, the rewrite fails, or
+                live ingestion kept changing the deployment for MAX_REPLACE_ATTEMPTS attempts
+        """
+        for _ in range(MAX_REPLACE_ATTEMPTS):
+            data = self.get_item(item_id=str(deployment_id), partition_key=deployment_id)
+            if not data:
+                raise ValueError(f"Deployment metadata does not exist for {deployment_id}.")
+            metadata = DeploymentMetadataDocument.from_dict(data)
+            shard_items = []
+            if metadata.counter_shards > 1:
+                shard_items = self.query_item_by_partition(
+                    partition_key_value=deployment_id,
+                    additional_where="c.type = @type",
+                    parameters=[{"name": "@type", "value": CosmosDocumentType.HASH_COUNT_SHARD.value}],
+                )
+            shards = DeploymentCounterShardDocument.from_dicts(shard_items)
+            recorded = metadata.hash_count + sum(shard.hash_count for shard in shards)
+            actual = self.count_items_by_partition(
+                deployment_id,
+                additional_where="c.type = @type",
+                parameters=[{"name": "@type", "value": CosmosDocumentType.FILE_HASH.value}],
+            )
+            if actual == recorded or dry_run:
+                return HashCountReconciliation(deployment_id, recorded, actual)
+
+            now_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+            metadata.hash_count = actual
+            metadata.last_update_ms = now_ms
+            batch_operations = [("replace", (str(deployment_id), metadata.to_dict()), {"if_match_etag": data["_etag"]})]
+            for shard, item in zip(shards, shard_items):
+                shard.hash_count = 0
+                shard.last_update_ms = now_ms
+                batch_operations.append(("replace", (item["id"], shard.to_dict()), {"if_match_etag": item["_etag"]}))
+            try:
+                results = self.execute_batch_items(batch_operations, partition_key=deployment_id, raise_on_error=True)
+            except exceptions.CosmosBatchOperationError as e:
+                if e.status_code == 412:
+                    continue
+                raise ValueError(f"Failed to reconcile hash_count for {deployment_id}: {e.message}")
+            self._cache_metadata_item(deployment_id, results[0].get("resourceBody"))
+            logger.info(
+                "Reconciled hash_count of deployment %s from %s to %s", deployment_id, recorded, actual,
+                extra={"deployment_id": deployment_id, "recorded": recorded, "actual": actual},
+            )
+            return HashCountReconciliation(deployment_id, recorded, actual, updated=True)
+        raise ValueError(f"Deployment {deployment_id} was modified concurrently, giving up reconciling after {MAX_REPLACE_ATTEMPTS} attempts.")
+
+    def reconcile_hash_counts(
+        self,
+        deployment_ids: Optional[list[int]] = None,
+        max_concurrency: int = RECONCILE_CONCURRENCY,
+        page_size: int = RECONCILE_PAGE_SIZE,
+        resume_token: Optional[str] = None,
+        dry_run: bool = False,
+    ) -> Iterator[tuple[list[HashCountReconciliation], Optional[str]]]:
+        """Reconcile the hash_count of many deployments, or of every deployment.
+
+        Deployments are taken a page at a time and the deployments of a page reconciled
+        concurrently, see reconcile_hash_count. A failure is reported in the result of
+        its deployment rather than stopping the run. Persisting the token yielded with
+        each page lets an interrupted run resume after the last completed page.
+
+        Args:
+            deployment_ids (list[int]): the deployments to reconcile, None for every
+                deployment with a metadata document
+            max_concurrency (int): the maximum number of deployments reconciled at once
+            page_size (int): the number of deployments per page
+            resume_token (str): the token yielded with an earlier page, to resume after it
+            dry_run (bool): only count, never rewrite
+
+        Yields:
+            tuple[list[HashCountReconciliation], str]: the results of a page and the token
+                to resume after it, None after the last page
+        """
+        if deployment_ids is None:
+            pages = self.iter_deployment_id_pages(page_size=page_size, resume_token=resume_token)
+        else:
+            start = int(decode_resume_token(resume_token)) if resume_token else 0
+            pages = (
+                (deployment_ids[offset:offset + page_size],
+                 encode_resume_token(str(offset + page_size)) if offset + page_size < len(deployment_ids) else None)
+                for offset in range(start, len(deployment_ids), page_size)
+            )
+
+        def reconcile(deployment_id: int) -> HashCountReconciliation:
+            try:
+                return self.reconcile_hash_count(deployment_id, dry_run=dry_run)
+            except Exception as e:
+                logger.warning(
+                    "Error reconciling hash_count of deployment %s: %s", deployment_id, e,
+                    extra={"deployment_id": deployment_id},
+                )
+                return HashCountReconciliation(deployment_id, error=str(e))
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            for page_deployment_ids, next_resume_token in pages:
+                yield list(map_in_context(executor, reconcile, page_deployment_ids)), next_resume_token
+
+    def iter_deployment_id_pages(
+        self, page_size: int = RECONCILE_PAGE_SIZE, resume_token: Optional[str] = None
+    ) -> Iterator[tuple[list[int], Optional[str]]]:
+        """Stream the ids of every deployment page by page, with a cross-partition query.
+
+        Args:
+            page_size (int): the maximum number of ids per page
+            resume_token (str): the token returned with an earlier page, to resume after it
+
+        Yields:
+            tuple[list[int], str]: the deployment ids of a page and the token to resume
+                after it, None after the last page
+        """
+        pages = self.iter_item_pages_by_partition(
+            partition_key_value=None,
+            field_name="deployment_id",
+            additional_where="c.type = @type",
+            parameters=[{"name": "@type", "value": CosmosDocumentType.DEPLOYMENT_METADATA.value}],
+            max_item_count=page_size,
+            continuation_token=resume_token,
+        )
+        for items, next_resume_token in pages:
+            yield [int(item["deployment_id"]) for item in items], next_resume_token
+
+    def _get_counter_shard_count(self, deployment_id: int) -> int:
+        """Get the number of hash_count shards of a deployment, reading the metadata once.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+
+        Returns:
+            int: the number of shards
+
+        Raises:
+            ValueError: if the deployment metadata does not exist
+        """
+        counter_shards = self._counter_shards.get(deployment_id)
+        if counter_shards is None:
+            data = self._read_metadata_item(deployment_id)
+            if not data:
+                raise ValueError(f"Deployment metadata does not exist for {deployment_id}.")
+            counter_shards = data.get("counter_shards", 1)
+            self._counter_shards[deployment_id] = counter_shards
+        return counter_shards
+
     def add_file_hash(
         self, deployment_id: int, file_hash: str
     ) -> Optional[bool]:
         """Add file hash to Cosmos DC.
 
+        The hash document is created and the metadata hash_count incremented with a
+        partial-document patch in the same transactional batch, so no read is needed
+        and concurrent increments are not lost. Adding a hash that is already stored
+        is a no-op that leaves hash_count unchanged.
+
         Args:
             deployment_id (int): the id of the deployment item
             file_hash (str): the file hash to add
 
         Returns:
-            bool: True if the operation was successful
+            bool: True if the hash was added, False if it was already stored
             
         Raises:
-            ValueError: if the deployment metadata does not exist or the operation fails
+            ValueError: if the deployment metadata does not exist
+            CosmosBatchOperationError: if the batch failed for another reason, e.g. throttling
         """
-        file_hash_document = DeploymentFileHashDocument(
-                file_hash=file_hash,
-                deployment_id=deployment_id,
-                created_ms=int(datetime.now(timezone.utc).timestamp() * 1000),
-            )
-        batch_operations = [
-            ('create', (file_hash_document.to_dict(),))
-        ]
-        # Update the deployment metadata
-        metadata = self.get_deployment_metadata(deployment_id)
-        if not metadata:
-            raise ValueError(f"Deployment metadata does not exist for {deployment_id}.")
-        metadata.hash_count +=  1
-        metadata.last_update_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
-        item_id = str(deployment_id)
-        item_body = metadata.to_dict()
-        batch_operations.append(
-            ("replace", (item_id, item_body))
-        )
+        if self.seen_hashes and self.seen_hashes.contains(deployment_id, file_hash):
+            return False
+        counter_shards = self._get_counter_shard_count(deployment_id)
+        batch_operations = self._file_hash_batch_operations(deployment_id, [file_hash], counter_shards)
         # Add the file hash document and update the metadata in a batch operation
-        results = self.execute_batch_items(batch_operations, partition_key=deployment_id)
-        if not results:
-            raise ValueError("Failed to add file hash: ", file_hash_document.to_dict())
-        # Return the updated metadata
+        try:
+            batch_results = self.execute_batch_items(batch_operations, partition_key=deployment_id, raise_on_error=True)
+        except exceptions.CosmosBatchOperationError as e:
+            if e.error_index == 0 and e.status_code == 409:
+                self._remember_file_hash(deployment_id, file_hash)
+                return False
+            if e.error_index == 1 and e.status_code == 404:
+                raise ValueError(f"Deployment metadata does not exist for {deployment_id}.")
+            # Raised as is, its status code telling a throttled or failed-over write from a bad one
+            raise
+        self._remember_file_hash(deployment_id, file_hash)
+        self._cache_metadata_from_batch(deployment_id, batch_operations, batch_results)
         return True
-    
+
+    def add_file_hashes(
+        self, deployment_id: int, file_hashes: list[str]
+    ) -> FileHashResults:
+        """Add many file hashes to Cosmos DB using as few transactional batches as possible.
+
+        Each batch holds the hash creates plus the patches incrementing hash_count by the
+        number of hashes created, one for the metadata document or one per shard touched.
+        If a create fails that hash is dropped and the rest of the batch is retried, so
+        one bad hash does not fail the others. Hashes that already exist are reported as
+        duplicates and not counted; when a create conflicts, the rest of its batch is
+        checked with one existence query so a redelivered batch is not retried hash by hash.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            file_hashes (list[str]): the file hashes to add
+
+        Returns:
+            FileHashResults: the outcome for each file hash, with the error behind each failed one
+
+        Raises:
+            ValueError: if the deployment metadata does not exist
+        """
+        results, pending = self._filter_seen_hashes(deployment_id, file_hashes)
+        if not pending:
+            return results
+        counter_shards = self._get_counter_shard_count(deployment_id)
+        while pending:
+            chunk = pending[:MAX_BATCH_OPERATIONS - counter_shards]
+            batch_operations = self._file_hash_batch_operations(deployment_id, chunk, counter_shards)
+            try:
+                batch_results = self.execute_batch_items(batch_operations, partition_key=deployment_id, raise_on_error=True)
+            except exceptions.CosmosBatchOperationError as e:
+                if not self._record_hash_batch_error(deployment_id, chunk, pending, results, e):
+                    break
+                unchecked = self._unchecked_conflict_hashes(chunk, e)
+                if unchecked:
+                    self._drop_stored_hashes(
+                        deployment_id, pending, results, self.get_existing_file_hashes(deployment_id, unchecked)
+                    )
+                continue
+            self._record_hash_batch_success(deployment_id, chunk, results, batch_operations, batch_results)
+            pending = pending[len(chunk):]
+        return results
+
     def set_upload_in_progress(
         self,
         deployment_id: int,
@@ -113,6 +937,10 @@ class DeploymentCosmosDBDAL(BaseCosmosDBDAL):
     ) -> Optional[DeploymentMetadataDocument]:
         """Set the upload in progress status for a deployment item in the Cosmos DB container.
 
+        The metadata is replaced only if its ETag is unchanged since it was read, and the
+        read-modify-replace is retried if another writer got there first. When an upload
+        finishes, the hash_count shards are compacted back into the metadata document.
+
         Args:
             deployment_id (int): the id of the deployment item
             upload_in_progress (bool): the upload in progress status
@@ -121,21 +949,34 @@ class DeploymentCosmosDBDAL(BaseCosmosDBDAL):
         Returns:
             DeploymentMetadata: the updated item if successful, None otherwise
         """
-        metadata = self.get_deployment_metadata(deployment_id)
-        if not metadata:
-            raise ValueError(f"Deployment metadata does not exist for {deployment_id}.")
-        
-        metadata.upload_in_progress = upload_in_progress
-        metadata.upload_user_id = str(user_id) if user_id else None
-        metadata.last_update_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
-        updated_metadata = self.update_item(str(deployment_id), metadata.to_dict())
-        if not updated_metadata:
-            raise ValueError("Failed to update deployment metadata: ", metadata.to_dict())
-        return DeploymentMetadataDocument.from_dict(updated_metadata)
+        for attempt in range(MAX_REPLACE_ATTEMPTS):
+            # A cached copy is safe for the first attempt since the replace is ETag-conditioned
+            data = self._read_metadata_item(deployment_id, use_cache=attempt == 0)
+            if not data:
+                raise ValueError(f"Deployment metadata does not exist for {deployment_id}.")
+            metadata = DeploymentMetadataDocument.from_dict(data)
+            metadata.upload_in_progress = upload_in_progress
+            metadata.upload_user_id = str(user_id) if user_id else None
+            metadata.last_update_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+            try:
+                updated_metadata = self.update_item(str(deployment_id), metadata.to_dict(), etag=data.get("_etag"))
+            except exceptions.CosmosAccessConditionFailedError:
+                continue
+            if not updated_metadata:
+                raise ValueError("Failed to update deployment metadata: ", metadata.to_dict())
+            self._cache_metadata_item(deployment_id, updated_metadata)
+            if not upload_in_progress and metadata.counter_shards > 1:
+                self.compact_counter_shards(deployment_id)
+                return self.get_deployment_metadata(deployment_id)
+            return DeploymentMetadataDocument.from_dict(updated_metadata)
+        raise ValueError(f"Deployment metadata for {deployment_id} was modified concurrently, giving up after {MAX_REPLACE_ATTEMPTS} attempts.")
 
     def delete_deployment_metadata(self, deployment_id: int):
         """Delete a deployment item from the Cosmos DB container.
 
+        Only the metadata document is deleted, see delete_deployment to delete the file
+        hashes and counter shards as well.
+
         Args:
             deployment_id (int): the id of the deployment item
 
@@ -143,6 +984,148 @@ class DeploymentCosmosDBDAL(BaseCosmosDBDAL):
             None
         """
         self.delete_item(item_id=str(deployment_id), partition_key=deployment_id)
+        self._counter_shards.pop(deployment_id, None)
+        self._cache_metadata_item(deployment_id, None)
+        if self.seen_hashes:
+            self.seen_hashes.forget(deployment_id)
+
+    def delete_deployment(
+        self,
+        deployment_id: int,
+        use_partition_delete: bool = True,
+        page_size: int = DELETE_PAGE_SIZE,
+        max_concurrency: int = DELETE_CONCURRENCY,
+        max_ru_per_second: Optional[float] = DELETE_RU_PER_SECOND,
+        progress: Optional[Callable[[DeploymentDeletion], None]] = None,
+    ) -> DeploymentDeletion:
+        """Delete a deployment with all its documents: file hashes, counter shards and metadata.
+
+        A delete by partition key is tried first. If it is disabled or not enabled on the
+        account, the ids are fetched a page at a time and deleted in transactional
+        batches, the batches of a page running concurrently. The metadata document is
+        deleted last, so a delete that stopped half way still lists the deployment and is
+        resumed by calling this again.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            use_partition_delete (bool): try a delete by partition key before deleting in batches
+            page_size (int): the number of ids fetched per page
+            max_concurrency (int): the maximum number of batches in flight
+            max_ru_per_second (float): the RU budget of the batched delete, so it leaves
+                throughput to the ingestion, None for no pacing; throttled batches are
+                retried either way
+            progress (Callable[[DeploymentDeletion], None]): called after every page
+
+        Returns:
+            DeploymentDeletion: the outcome of the delete
+
+        Raises:
+            RateLimitExceeded: if the deployment is still throttled after the retries of
+                the rate governor; calling again resumes the delete
+        """
+        deletion = DeploymentDeletion(deployment_id)
+        if use_partition_delete:
+            try:
+                self.delete_all_items_by_partition(deployment_id)
+                deletion.partition_delete = True
+            except (exceptions.CosmosHttpResponseError, AttributeError) as e:
+                if getattr(e, "status_code", None) == 429:
+                    raise
+                logger.info(
+                    "Delete by partition key unavailable for deployment %s, deleting in batches: %s", deployment_id, e,
+                    extra={"deployment_id": deployment_id},
+                )
+        if not deletion.partition_delete:
+            rate_governor = RateGovernor(max_ru_per_second, max_wait_ms=DELETE_MAX_WAIT_MS) if max_ru_per_second else None
+            self._delete_partition_in_batches(deletion, page_size, max_concurrency, rate_governor, progress)
+        self._counter_shards.pop(deployment_id, None)
+        self._cache_metadata_item(deployment_id, None)
+        if self.seen_hashes:
+            self.seen_hashes.forget(deployment_id)
+        deletion.completed = True
+        if progress:
+            progress(deletion)
+        logger.info(
+            "Deleted deployment %s (%s documents in batches, partition delete: %s)",
+            deployment_id, deletion.deleted, deletion.partition_delete,
+            extra={"deployment_id": deployment_id, "deleted": deletion.deleted, "partition_delete": deletion.partition_delete},
+        )
+        return deletion
+
+    def _delete_partition_in_batches(
+        self,
+        deletion: DeploymentDeletion,
+        page_size: int,
+        max_concurrency: int,
+        rate_governor: Optional[RateGovernor],
+        progress: Optional[Callable[[DeploymentDeletion], None]],
+    ):
+        """Delete the documents of a deployment page by page, the metadata document last.
+
+        Every page is queried from the start, as the documents of the previous pages are
+        gone, so no continuation token has to outlive the deletes.
+
+        Args:
+            deletion (DeploymentDeletion): the progress of the delete, updated in place
+            page_size (int): the number of ids fetched per page
+            max_concurrency (int): the maximum number of batches in flight
+            rate_governor (RateGovernor): the budget of the delete, None for the DAL's own
+            progress (Callable[[DeploymentDeletion], None]): called after every page
+        """
+        deployment_id = deletion.deployment_id
+        metadata_id = str(deployment_id)
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            while True:
+                items = self.query_item_by_partition(
+                    partition_key_value=deployment_id,
+                    field_name="id",
+                    take=page_size,
+                    additional_where="c.id != @id",
+                    parameters=[{"name": "@id", "value": metadata_id}],
+                )
+                if not items:
+                    break
+                item_ids = [item["id"] for item in items]
+                chunks = [item_ids[i:i + MAX_BATCH_OPERATIONS] for i in range(0, len(item_ids), MAX_BATCH_OPERATIONS)]
+                deletion.deleted += sum(map_in_context(
+                    executor,
+                    lambda chunk: self._delete_batch(deployment_id, chunk, rate_governor), chunks
+                ))
+                deletion.pages += 1
+                if progress:
+                    progress(deletion)
+        deletion.deleted += self._delete_batch(deployment_id, [metadata_id], rate_governor)
+
+    def _delete_batch(self, deployment_id: int, item_ids: list[str], rate_governor: Optional[RateGovernor]) -> int:
+        """Delete documents of a deployment in one transactional batch.
+
+        Documents already deleted, e.g. by an earlier attempt, are left out and the
+        batch retried.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            item_ids (list[str]): the ids of the documents, at most MAX_BATCH_OPERATIONS
+            rate_governor (RateGovernor): the budget of the delete, None for the DAL's own
+
+        Returns:
+            int: the number of documents deleted
+        """
+        while item_ids:
+            batch_operations = [("delete", (item_id,)) for item_id in item_ids]
+            try:
+                self._execute(
+                    "execute_item_batch", deployment_id,
+                    lambda response_hook: self.container.execute_item_batch(
+                        batch_operations=batch_operations, partition_key=deployment_id, response_hook=response_hook
+                    ),
+                    rate_governor=rate_governor,
+                )
+                return len(item_ids)
+            except exceptions.CosmosBatchOperationError as e:
+                if e.status_code != 404:
+                    raise
+                item_ids = item_ids[:e.error_index] + item_ids[e.error_index + 1:]
+        return 0
 
     def get_file_hashes(
         self, deployment_id: int, skip: int = 0, take: int = 100
@@ -155,13 +1138,118 @@ class DeploymentCosmosDBDAL(BaseCosmosDBDAL):
             take (int): the number of items to take
 
         Returns:
-            list[DeploymentFileHashDocument]: the file hashes if found, empty list otherwise
+            list[str]: the file hashes if found, empty list otherwise
         """
         file_hashes = self.query_item_by_partition(
             partition_key_value=deployment_id,
             field_name="id",  # the id is the file hash in the Cosmos DB document
-            additional_where="c.type = 'file_hash'",
+            additional_where="c.type = @type",
+            parameters=[{"name": "@type", "value": CosmosDocumentType.FILE_HASH.value}],
             skip=skip,
             take=take,
         )
         return [file_hashes["id"] for file_hashes in file_hashes] if file_hashes else []
+
+    def get_existing_file_hashes(
+        self,
+        deployment_id: int,
+        file_hashes: list[str],
+        chunk_size: int = EXISTENCE_QUERY_CHUNK_SIZE,
+        max_concurrency: int = 4,
+    ) -> set[str]:
+        """Find which of the candidate file hashes a deployment already has.
+
+        Hashes known to the seen-hash filter are answered locally; the rest are looked up
+        in chunks with a parameterised ARRAY_CONTAINS query on the id, scoped to the
+        deployment partition, the chunks running concurrently.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            file_hashes (list[str]): the candidate file hashes
+            chunk_size (int): the number of hashes per query
+            max_concurrency (int): the maximum number of queries in flight
+
+        Returns:
+            set[str]: the candidate hashes that are already stored
+        """
+        existing = set()
+        unknown = []
+        for file_hash in dict.fromkeys(file_hashes):
+            if self.seen_hashes and self.seen_hashes.contains(deployment_id, file_hash):
+                existing.add(file_hash)
+            else:
+                unknown.append(file_hash)
+        chunks = [unknown[i:i + chunk_size] for i in range(0, len(unknown), chunk_size)]
+        if not chunks:
+            return existing
+
+        def query_chunk(chunk: list[str]) -> list[dict]:
+            return self.query_item_by_partition(
+                partition_key_value=deployment_id,
+                field_name="id",
+                additional_where="c.type = @type AND ARRAY_CONTAINS(@ids, c.id)",
+                parameters=[
+                    {"name": "@type", "value": CosmosDocumentType.FILE_HASH.value},
+                    {"name": "@ids", "value": chunk},
+                ],
+            )
+
+        with ThreadPoolExecutor(max_workers=min(max_concurrency, len(chunks))) as executor:
+            for items in map_in_context(executor, query_chunk, chunks):
+                for item in items:
+                    existing.add(item["id"])
+                    self._remember_file_hash(deployment_id, item["id"])
+        return existing
+
+    def iter_file_hash_pages(
+        self,
+        deployment_id: int,
+        page_size: int = 1000,
+        resume_token: Optional[str] = None,
+        since_ms: Optional[int] = None,
+    ) -> Iterator[tuple[list[str], Optional[str]]]:
+        """Stream the file hashes of a deployment page by page.
+
+        Pages are fetched with Cosmos continuation tokens, so walking a large deployment
+        costs the same per page however deep into it the walk is.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            page_size (int): the maximum number of hashes per page
+            resume_token (str): the token returned with an earlier page, to resume after it
+            since_ms (int): if given, only the hashes created at or after this time
+
+        Yields:
+            tuple[list[str], str]: the hashes of a page and the token to resume after it,
+                None after the last page
+        """
+        additional_where = "c.type = @type"
+        parameters = [{"name": "@type", "value": CosmosDocumentType.FILE_HASH.value}]
+        if since_ms is not None:
+            additional_where += " AND c.created_ms >= @since_ms"
+            parameters.append({"name": "@since_ms", "value": since_ms})
+        pages = self.iter_item_pages_by_partition(
+            partition_key_value=deployment_id,
+            field_name="id",  # the id is the file hash in the Cosmos DB document
+            additional_where=additional_where,
+            parameters=parameters,
+            max_item_count=page_size,
+            continuation_token=resume_token,
+        )
+        for items, next_resume_token in pages:
+            yield [item["id"] for item in items], next_resume_token
+
+    def iter_file_hashes(
+        self, deployment_id: int, page_size: int = 1000
+    ) -> Iterator[str]:
+        """Stream every file hash of a deployment.
+
+        Args:
+            deployment_id (int): the id of the deployment item
+            page_size (int): the number of hashes fetched per round trip
+
+        Yields:
+            str: the file hashes
+        """
+        for file_hashes, _ in self.iter_file_hash_pages(deployment_id, page_size=page_size):
+            yield from file_hashes
@@ -0,0 +1,117 @@
+# shared/document_cache.py
+# A bounded, time-limited cache of Cosmos DB documents and their ETags.
+
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Hashable, Optional
+
+
+@dataclass
+class CacheEntry:
+    """ A cached document with the ETag it was read with. """
+    value: dict
+    etag: Optional[str]
+    expires_at: float
+
+    @property
+    def expired(self) -> bool:
+        """ Returns True once the entry has outlived its TTL. """
+        return time.monotonic() >= self.expires_at
+
+
+class DocumentCache:
+    """An LRU cache of documents that expire after ttl_seconds.
+
+    Expired entries are kept until evicted so their ETag can be used to revalidate
+    them with a conditional read.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl_seconds: float = 30.0):
+        """ Initializes the cache.
+
+        Args:
+            max_size (int): the maximum number of documents kept
+            ttl_seconds (float): how long a document is served without revalidation
+        """
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict[Hashable, CacheEntry] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.revalidations = 0
+
+    def get_entry(self, key: Hashable) -> Optional[CacheEntry]:
+        """ Get the entry for a key, counting a hit only if it is still fresh.
+
+        Args:
+            key (Hashable): the cache key
+
+        Returns:
+            CacheEntry: the entry, possibly expired, or None if the key is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            if entry is not None and not entry.expired:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def put(self, key: Hashable, value: dict, etag: Optional[str]):
+        """ Cache a document, evicting the least recently used one if the cache is full.
+
+        Args:
+            key (Hashable): the cache key
+            value (dict): the document
+            etag (str): the ETag of the document
+        """
+        with self._lock:
+            self._entries[key] = CacheEntry(value, etag, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def revalidate(self, key: Hashable):
+        """ Renew the TTL of an entry confirmed unchanged by a conditional read.
+
+        Args:
+            key (Hashable): the cache key
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.expires_at = time.monotonic() + self.ttl_seconds
+                self.revalidations += 1
+
+    def invalidate(self, key: Hashable):
+        """ Drop the entry for a key.
+
+        Args:
+            key (Hashable): the cache key
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def get_stats(self) -> dict:
+        """ Get the hit, miss, eviction and revalidation counters.
+
+        Returns:
+            dict: the cache statistics
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'revalidations': self.revalidations,
+                'size': len(self._entries),
+            }
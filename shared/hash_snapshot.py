@@ -0,0 +1,342 @@
+# shared/hash_snapshot.py
+# A compact, sorted, fixed-width binary snapshot of the file hashes of a deployment.
+
+import bisect
+import heapq
+import mmap
+import os
+import struct
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, Optional
+
+SNAPSHOT_MAGIC = b"AKHS"
+SNAPSHOT_VERSION = 1
+# magic, version, record width, base count, delta count, created_ms watermark
+SNAPSHOT_HEADER = struct.Struct("<4sHHQQQ")
+# Hashes created this long before the watermark are fetched again on update, covering
+# writes that were in flight, or stamped by a skewed clock, when the snapshot was taken
+DEFAULT_OVERLAP_MS = 60000
+# The delta segment is merged into the base once it holds more than 1/COMPACT_RATIO of it
+COMPACT_RATIO = 8
+
+
+@dataclass
+class SnapshotHeader:
+    """ The header of a hash snapshot file.
+
+    The header is followed by base_count sorted records, then delta_count sorted records
+    holding the hashes appended since the base was written. Records are the ASCII hashes
+    padded with NUL bytes to width, so byte order matches string order.
+    """
+    width: int
+    base_count: int
+    delta_count: int
+    created_ms: int  # hashes created before this time are in the snapshot
+
+    @property
+    def count(self) -> int:
+        """ Returns the number of hashes in the snapshot. """
+        return self.base_count + self.delta_count
+
+    def pack(self) -> bytes:
+        """ Returns the binary form of the header. """
+        return SNAPSHOT_HEADER.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, self.width, self.base_count, self.delta_count, self.created_ms
+        )
+
+    @staticmethod
+    def unpack(data: bytes) -> "SnapshotHeader":
+        """ Reads a header from the start of a snapshot file.
+
+        Args:
+            data (bytes): at least the first SNAPSHOT_HEADER.size bytes of the file
+
+        Returns:
+            SnapshotHeader: the header
+
+        Raises:
+            ValueError: if the data is not a snapshot header of a supported version
+        """
+        if len(data) < SNAPSHOT_HEADER.size:
+            raise ValueError("Truncated hash snapshot header")
+        magic, version, width, base_count, delta_count, created_ms = SNAPSHOT_HEADER.unpack_from(data)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            raise ValueError("Not a hash snapshot file, or an unsupported version")
+        return SnapshotHeader(width, base_count, delta_count, created_ms)
+
+
+class _Records:
+    """ A read-only sequence view of one sorted segment of a memory-mapped snapshot. """
+
+    def __init__(self, buffer, offset: int, width: int, count: int):
+        self.buffer = buffer
+        self.offset = offset
+        self.width = width
+        self.count = count
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, index: int) -> bytes:
+        start = self.offset + index * self.width
+        return self.buffer[start:start + self.width]
+
+    def iter_from(self, index: int) -> Iterator[bytes]:
+        for i in range(index, self.count):
+            yield self[i]
+
+
+class HashSnapshot:
+    """A memory-mapped hash snapshot answering membership and range queries by binary
+    search, without loading the hashes into Python objects.
+    """
+
+    def __init__(self, path: str):
+        """ Opens and maps a snapshot file.
+
+        Args:
+            path (str): the path of the snapshot file
+
+        Raises:
+            ValueError: if the file is not a valid snapshot
+        """
+        self.path = path
+        self._file = open(path, "rb")
+        try:
+            self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.header = SnapshotHeader.unpack(self._buffer[:SNAPSHOT_HEADER.size])
+            expected_size = SNAPSHOT_HEADER.size + self.header.count * self.header.width
+            if len(self._buffer) != expected_size:
+                raise ValueError(f"Hash snapshot is {len(self._buffer)} bytes, expected {expected_size}")
+        except Exception:
+            self.close()
+            raise
+        width = self.header.width
+        self._segments = [
+            _Records(self._buffer, SNAPSHOT_HEADER.size, width, self.header.base_count),
+            _Records(self._buffer, SNAPSHOT_HEADER.size + self.header.base_count * width, width, self.header.delta_count),
+        ]
+
+    @property
+    def created_ms(self) -> int:
+        """ Returns the watermark of the snapshot. """
+        return self.header.created_ms
+
+    def __len__(self) -> int:
+        return self.header.count
+
+    def __contains__(self, file_hash: str) -> bool:
+        return self.contains(file_hash)
+
+    def __iter__(self) -> Iterator[str]:
+        return self.range()
+
+    def __enter__(self) -> "HashSnapshot":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def contains(self, file_hash: str) -> bool:
+        """ Check whether a hash is in the snapshot.
+
+        Args:
+            file_hash (str): the file hash
+
+        Returns:
+            bool: True if the hash is in the snapshot
+        """
+        key = _encode_hash(file_hash, self.header.width)
+        if key is None:
+            return False
+        return any(_segment_contains(records, key) for records in self._segments)
+
+    def range(self, start: Optional[str] = None, stop: Optional[str] = None) -> Iterator[str]:
+        """ Iterate over the hashes h with start <= h < stop, in sorted order.
+
+        Args:
+            start (str): the inclusive lower bound, None for no lower bound
+            stop (str): the exclusive upper bound, None for no upper bound
+
+        Yields:
+            str: the hashes in the range
+        """
+        width = self.header.width
+        segments = []
+        for records in self._segments:
+            index = 0
+            if start is not None:
+                key, truncated = _range_key(start, width)
+                # every record is shorter than a truncated bound, so skip the records equal to its prefix
+                index = (bisect.bisect_right if truncated else bisect.bisect_left)(records, key)
+            segments.append(records.iter_from(index))
+        stop_key, stop_truncated = _range_key(stop, width) if stop is not None else (None, False)
+        for record in heapq.merge(*segments):
+            if stop_key is not None and (record > stop_key or (record == stop_key and not stop_truncated)):
+                return
+            yield record.rstrip(b"\0").decode("ascii")
+
+    def close(self):
+        """ Unmaps and closes the snapshot file. """
+        if getattr(self, "_buffer", None) is not None:
+            self._buffer.close()
+            self._buffer = None
+        self._file.close()
+
+
+def write_snapshot(
+    path: str, file_hashes: Iterable[str], created_ms: int, width: Optional[int] = None
+) -> SnapshotHeader:
+    """ Write a new snapshot holding the given hashes, replacing any existing file atomically.
+
+    Args:
+        path (str): the path of the snapshot file
+        file_hashes (Iterable[str]): the hashes, in any order and possibly repeated
+        created_ms (int): the watermark, hashes created before it must be included
+        width (int): the record width, by default the length of the longest hash
+
+    Returns:
+        SnapshotHeader: the header of the written snapshot
+    """
+    records = sorted({_to_ascii(file_hash) for file_hash in file_hashes})
+    width = max([width or 0] + [len(record) for record in records]) or 1
+    header = SnapshotHeader(width, len(records), 0, created_ms)
+    _write_file(path, header, [(record.ljust(width, b"\0") for record in records)])
+    return header
+
+
+def append_to_snapshot(
+    path: str, file_hashes: Iterable[str], created_ms: int, compact_ratio: int = COMPACT_RATIO
+) -> SnapshotHeader:
+    """ Add hashes to an existing snapshot and move its watermark forward.
+
+    The new hashes are merged into the small delta segment and the base records are
+    copied across byte for byte. The delta is folded into the base once it outgrows
+    1/compact_ratio of it, or when a new hash needs wider records.
+
+    Args:
+        path (str): the path of the snapshot file
+        file_hashes (Iterable[str]): the hashes to add, possibly already in the snapshot
+        created_ms (int): the new watermark
+        compact_ratio (int): how small the delta must stay relative to the base
+
+    Returns:
+        SnapshotHeader: the header of the updated snapshot
+    """
+    new_records = {_to_ascii(file_hash) for file_hash in file_hashes}
+    # The snapshot is read in full before the file is replaced, so it is never replaced while mapped
+    with HashSnapshot(path) as snapshot:
+        width = snapshot.header.width
+        if any(len(record) > width for record in new_records):
+            existing = list(snapshot)
+        else:
+            existing = None
+            base, delta = snapshot._segments
+            delta_records = {record.ljust(width, b"\0") for record in new_records}
+            delta_records = {record for record in delta_records if not _segment_contains(base, record)}
+            delta_records.update(delta.iter_from(0))
+            delta_records = sorted(delta_records)
+            if len(delta_records) * compact_ratio > len(base):
+                chunks = [list(heapq.merge(base.iter_from(0), delta_records))]
+                new_header = SnapshotHeader(width, len(chunks[0]), 0, created_ms)
+            else:
+                chunks = [[snapshot._buffer[SNAPSHOT_HEADER.size:SNAPSHOT_HEADER.size + len(base) * width]], delta_records]
+                new_header = SnapshotHeader(width, len(base), len(delta_records), created_ms)
+    if existing is not None:
+        return write_snapshot(path, existing + [record.decode("ascii") for record in new_records], created_ms)
+    _write_file(path, new_header, chunks)
+    return new_header
+
+
+def build_deployment_snapshot(dal, deployment_id: int, path: str, page_size: int = 1000) -> SnapshotHeader:
+    """ Write a snapshot of every file hash of a deployment.
+
+    Args:
+        dal (DeploymentCosmosDBDAL): the deployment DAL
+        deployment_id (int): the id of the deployment
+        path (str): the path of the snapshot file
+        page_size (int): the number of hashes fetched per round trip
+
+    Returns:
+        SnapshotHeader: the header of the written snapshot
+    """
+    created_ms = _now_ms()
+    return write_snapshot(path, dal.iter_file_hashes(deployment_id, page_size=page_size), created_ms)
+
+
+def update_deployment_snapshot(
+    dal, deployment_id: int, path: str, overlap_ms: int = DEFAULT_OVERLAP_MS, page_size: int = 1000
+) -> SnapshotHeader:
+    """ Bring a deployment snapshot up to date, fetching only the hashes created since its
+    watermark. The snapshot is built from scratch if the file does not exist yet.
+
+    Args:
+        dal (DeploymentCosmosDBDAL): the deployment DAL
+        deployment_id (int): the id of the deployment
+        path (str): the path of the snapshot file
+        overlap_ms (int): how far before the watermark to look again for late writes
+        page_size (int): the number of hashes fetched per round trip
+
+    Returns:
+        SnapshotHeader: the header of the updated snapshot
+    """
+    if not os.path.exists(path):
+        return build_deployment_snapshot(dal, deployment_id, path, page_size=page_size)
+    with open(path, "rb") as snapshot_file:
+        header = SnapshotHeader.unpack(snapshot_file.read(SNAPSHOT_HEADER.size))
+    created_ms = _now_ms()
+    file_hashes = [
+        file_hash
+        for file_hashes, _ in dal.iter_file_hash_pages(
+            deployment_id, page_size=page_size, since_ms=max(header.created_ms - overlap_ms, 0)
+        )
+        for file_hash in file_hashes
+    ]
+    return append_to_snapshot(path, file_hashes, created_ms)
+
+
+def _now_ms() -> int:
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+
+def _to_ascii(file_hash: str) -> bytes:
+    record = file_hash.encode("ascii")
+    if not record or b"\0" in record:
+        raise ValueError(f"Invalid file hash for a snapshot: {file_hash!r}")
+    return record
+
+
+def _encode_hash(file_hash: str, width: int) -> Optional[bytes]:
+    """ Pad a hash to the record width, or return None if it cannot be in the snapshot. """
+    try:
+        record = _to_ascii(file_hash)
+    except (UnicodeEncodeError, ValueError):
+        return None
+    if len(record) > width:
+        return None
+    return record.ljust(width, b"\0")
+
+
+def _range_key(bound: str, width: int) -> tuple[bytes, bool]:
+    """ Turn a range bound into a record-comparable key and whether it had to be truncated. """
+    key = bound.encode("ascii")
+    return key[:width].ljust(width, b"\0"), len(key) > width
+
+
+def _segment_contains(records: _Records, record: bytes) -> bool:
+    index = bisect.bisect_left(records, record)
+    return index < len(records) and records[index] == record
+
+
+def _write_file(path: str, header: SnapshotHeader, chunks: list[Iterable[bytes]]):
+    """ Write the header and records to a temporary file, then move it over path. """
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "wb") as snapshot_file:
+        snapshot_file.write(header.pack())
+        for chunk in chunks:
+            for data in chunk:
+                snapshot_file.write(data)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temp_path, path)
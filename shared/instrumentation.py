@@ -0,0 +1,294 @@
+# shared/instrumentation.py
+# In-process stage timings and Cosmos DB request charges, aggregated into histograms.
+
+import contextvars
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from concurrent.futures import Executor
+from typing import Any, Callable, Hashable, Iterable, Iterator, Mapping, Optional
+
+from azure.cosmos import exceptions
+
+REQUEST_CHARGE_HEADER = "x-ms-request-charge"
+RETRY_AFTER_HEADER = "x-ms-retry-after-ms"
+THROTTLE_RETRY_COUNT_HEADER = "x-ms-throttle-retry-count"
+THROTTLE_RETRY_WAIT_HEADER = "x-ms-throttle-retry-wait-time-ms"
+
+# The invocation the current thread or task is working for, see Instrumentation.invocation
+_current_invocation: contextvars.ContextVar[Optional["InvocationCharge"]] = contextvars.ContextVar(
+    "current_invocation", default=None
+)
+
+
+class Histogram:
+    """A histogram of the most recent max_samples observations.
+
+    Percentiles are computed over that sliding window, while count, sum and max cover
+    every observation since the last reset.
+    """
+
+    def __init__(self, max_samples: int = 1024):
+        """ Initializes an empty histogram.
+
+        Args:
+            max_samples (int): the number of recent observations kept for percentiles
+        """
+        self._samples: deque[float] = deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        """ Record an observation. """
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def summary(self) -> dict:
+        """ Get the count, mean, max and p50/p95/p99 of the histogram.
+
+        Returns:
+            dict: the histogram summary
+        """
+        samples = sorted(self._samples)
+
+        def percentile(p: float) -> float:
+            if not samples:
+                return 0.0
+            return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+        return {
+            'count': self.count,
+            'sum': round(self.total, 3),
+            'mean': round(self.total / self.count, 3) if self.count else 0.0,
+            'max': round(self.max, 3),
+            'p50': round(percentile(0.50), 3),
+            'p95': round(percentile(0.95), 3),
+            'p99': round(percentile(0.99), 3),
+        }
+
+
+class InvocationCharge:
+    """ The request charge accumulated while handling one invocation, possibly from several threads. """
+    __slots__ = ("events", "request_charge", "_lock")
+
+    def __init__(self, events: int):
+        self.events = events
+        self.request_charge = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, request_charge: float):
+        """ Add the charge of a response to the invocation. """
+        with self._lock:
+            self.request_charge += request_charge
+
+
+class Instrumentation:
+    """Collects stage timings, Cosmos DB operation latencies and request charges.
+
+    Histograms are named '<kind>.<name>.<unit>', e.g. 'stage.resolve.ms',
+    'cosmos.execute_item_batch.ms' or 'cosmos.execute_item_batch.ru'. Request charges
+    are also totalled per partition key, which is the deployment id for the deployments
+    container.
+    """
+
+    def __init__(self, max_samples: int = 1024, max_partitions: int = 1000):
+        """ Initializes the instrumentation.
+
+        Args:
+            max_samples (int): the number of recent observations kept per histogram
+            max_partitions (int): the number of partitions whose request charge is tracked,
+                the least recently charged are dropped first
+        """
+        self.max_samples = max_samples
+        self.max_partitions = max_partitions
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Drop every histogram, counter and per-partition total. """
+        with self._lock:
+            self._histograms: dict[str, Histogram] = {}
+            self._counters: dict[str, float] = {}
+            self._partitions: OrderedDict[Hashable, dict] = OrderedDict()
+
+    def observe(self, name: str, value: float):
+        """ Record an observation in the named histogram. """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram(self.max_samples)
+            histogram.observe(value)
+
+    def increment(self, name: str, value: float = 1):
+        """ Add to the named counter. """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """ Time a block into the 'stage.<name>.ms' histogram.
+
+        Args:
+            name (str): the stage name, e.g. 'parse', 'resolve' or 'write'
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(f"stage.{name}.ms", (time.perf_counter() - start) * 1000)
+
+    @contextmanager
+    def invocation(self, events: int) -> Iterator[InvocationCharge]:
+        """ Attribute the request charge of the Cosmos DB calls made in a block to an
+        invocation, recording its RU per event into 'invocation.ru_per_event' on exit.
+
+        asyncio tasks started in the block inherit the invocation.
+
+        Args:
+            events (int): the number of events handled by the invocation
+
+        Yields:
+            InvocationCharge: the accumulated request charge
+        """
+        charge = InvocationCharge(events)
+        token = _current_invocation.set(charge)
+        try:
+            yield charge
+        finally:
+            _current_invocation.reset(token)
+            self.observe("invocation.ru", charge.request_charge)
+            if events:
+                self.observe("invocation.ru_per_event", charge.request_charge / events)
+
+    def response_hook(
+        self, operation: str, partition_key: Optional[Hashable] = None
+    ) -> Callable[[Mapping[str, str], object], None]:
+        """ Build a Cosmos DB response_hook recording the charge of each response.
+
+        Args:
+            operation (str): the container operation, e.g. 'read_item'
+            partition_key (Hashable): the partition the operation targets, if any
+
+        Returns:
+            Callable: the hook, called by the SDK with the response headers and body
+        """
+        def hook(headers: Mapping[str, str], _result):
+            self.record_response_headers(operation, headers, partition_key)
+        return hook
+
+    @contextmanager
+    def cosmos_operation(
+        self, operation: str, partition_key: Optional[Hashable] = None
+    ) -> Iterator[Callable[[Mapping[str, str], object], None]]:
+        """ Time a Cosmos DB call into 'cosmos.<operation>.ms' and yield the response_hook
+        to pass to it. The headers of a failed call are recorded from the exception.
+
+        Args:
+            operation (str): the container operation, e.g. 'read_item'
+            partition_key (Hashable): the partition the operation targets, if any
+
+        Yields:
+            Callable: the response_hook for the call
+        """
+        start = time.perf_counter()
+        try:
+            yield self.response_hook(operation, partition_key)
+        # CosmosBatchOperationError is not a CosmosHttpResponseError
+        except (exceptions.CosmosHttpResponseError, exceptions.CosmosBatchOperationError) as e:
+            self.increment(f"cosmos.{operation}.status_{e.status_code}")
+            if e.status_code == 429:
+                self.increment("cosmos.throttled")
+            if e.headers:
+                self.record_response_headers(operation, e.headers, partition_key)
+            raise
+        finally:
+            self.observe(f"cosmos.{operation}.ms", (time.perf_counter() - start) * 1000)
+
+    def record_response_headers(
+        self, operation: str, headers: Mapping[str, str], partition_key: Optional[Hashable] = None
+    ):
+        """ Record the request charge, retry-after and SDK throttle retries of a response.
+
+        Args:
+            operation (str): the container operation
+            headers (Mapping[str, str]): the response headers
+            partition_key (Hashable): the partition the operation targeted, if any
+        """
+        request_charge = header_float(headers, REQUEST_CHARGE_HEADER)
+        retry_after_ms = header_float(headers, RETRY_AFTER_HEADER)
+        throttle_retries = header_float(headers, THROTTLE_RETRY_COUNT_HEADER)
+        if request_charge is not None:
+            self.observe(f"cosmos.{operation}.ru", request_charge)
+            self.increment("cosmos.request_charge", request_charge)
+            invocation = _current_invocation.get()
+            if invocation is not None:
+                invocation.add(request_charge)
+            if partition_key is not None:
+                self._charge_partition(partition_key, request_charge)
+        if retry_after_ms is not None:
+            self.observe("cosmos.retry_after.ms", retry_after_ms)
+        if throttle_retries:
+            self.increment("cosmos.throttle_retries", throttle_retries)
+            self.observe("cosmos.throttle_retry_wait.ms", header_float(headers, THROTTLE_RETRY_WAIT_HEADER) or 0.0)
+
+    def _charge_partition(self, partition_key: Hashable, request_charge: float):
+        with self._lock:
+            totals = self._partitions.get(partition_key)
+            if totals is None:
+                totals = self._partitions[partition_key] = {'request_charge': 0.0, 'operations': 0}
+                if len(self._partitions) > self.max_partitions:
+                    self._partitions.popitem(last=False)
+            else:
+                self._partitions.move_to_end(partition_key)
+            totals['request_charge'] += request_charge
+            totals['operations'] += 1
+
+    def snapshot(self) -> dict:
+        """ Get a JSON-serialisable copy of every histogram, counter and partition total.
+
+        Returns:
+            dict: the histograms summaries, the counters and the request charge per partition
+        """
+        with self._lock:
+            return {
+                'histograms': {name: histogram.summary() for name, histogram in sorted(self._histograms.items())},
+                'counters': {name: round(value, 3) for name, value in sorted(self._counters.items())},
+                'request_charge_by_partition': {
+                    str(partition_key): {
+                        'request_charge': round(totals['request_charge'], 3),
+                        'operations': totals['operations'],
+                    }
+                    for partition_key, totals in self._partitions.items()
+                },
+            }
+
+
+def header_float(headers: Mapping[str, str], name: str) -> Optional[float]:
+    """ Read a numeric response header, None if it is missing or malformed. """
+    value = headers.get(name) if headers else None
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def map_in_context(executor: Executor, fn: Callable[[Any], Any], items: Iterable) -> Iterator:
+    """ Like executor.map, but each call runs in a copy of the caller's context, so the
+    Cosmos DB calls made on the pool threads are charged to the caller's invocation.
+
+    Args:
+        executor (Executor): the pool running the calls
+        fn (Callable): the function called with each item
+        items (Iterable): the items
+
+    Returns:
+        Iterator: the results, in the order of the items
+    """
+    futures = [executor.submit(contextvars.copy_context().run, fn, item) for item in items]
+    return (future.result() for future in futures)
@@ -0,0 +1,236 @@
+# shared/micro_batching.py
+# Coalesces resolved file hash events per deployment into few, larger writes.
+
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Iterable, Optional
+
+from shared.instrumentation import Instrumentation
+
+
+@dataclass
+class CoalescedBatch:
+    """ The events drained from a HashCoalescer, ready to be written. """
+    file_hashes: dict[int, list[str]]  # the distinct hashes of each deployment, in arrival order
+    items: dict[int, list[Any]]  # the items added for each deployment, duplicates included
+    events: int  # the number of events merged into the batch, duplicates included
+    duplicates: int  # the events dropped because their hash was already in the batch
+    wait_ms: float  # how long the oldest event waited in the coalescer
+
+    @property
+    def hash_count(self) -> int:
+        """ Returns the number of distinct hashes to write. """
+        return sum(len(file_hashes) for file_hashes in self.file_hashes.values())
+
+
+class HashCoalescer:
+    """Merges resolved events per deployment until a size or time window is reached.
+
+    A hash repeated within the window is only written once, its items sharing the
+    outcome of that write, and each deployment gets one add_file_hashes call per flush,
+    so one hash_count increment per transactional batch instead of one per event. The
+    coalescer does not flush by itself: callers
+    check is_due() as events arrive and drain() the remaining events before they
+    acknowledge the delivery, so nothing is held past the end of an invocation.
+    """
+
+    def __init__(
+        self,
+        max_events: int = 500,
+        max_wait_ms: float = 1000.0,
+        instrumentation: Optional[Instrumentation] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        """ Initializes an empty coalescer.
+
+        Args:
+            max_events (int): the number of events after which the batch is due
+            max_wait_ms (float): how long the oldest event may wait before the batch is due
+            instrumentation (Instrumentation): optional instrumentation recording the size
+                of every drained batch
+            clock (Callable[[], float]): the monotonic clock, in seconds
+        """
+        self.max_events = max_events
+        self.max_wait_ms = max_wait_ms
+        self.instrumentation = instrumentation
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._file_hashes: dict[int, dict[str, None]] = {}
+        self._items: dict[int, list[Any]] = {}
+        self._events = 0
+        self._duplicates = 0
+        self._first_added: Optional[float] = None
+
+    def __len__(self) -> int:
+        return self._events
+
+    def add(self, deployment_id: int, file_hash: str, item: Any = None) -> bool:
+        """ Add a resolved event to the current batch.
+
+        Args:
+            deployment_id (int): the id of the deployment
+            file_hash (str): the file hash of the event
+            item (Any): what to hand back for the deployment when the batch is drained,
+                e.g. the event result
+
+        Returns:
+            bool: False if the hash is already in the batch and will not be written again
+        """
+        with self._lock:
+            if self._first_added is None:
+                self._first_added = self.clock()
+            self._events += 1
+            self._items.setdefault(deployment_id, []).append(item)
+            deployment_hashes = self._file_hashes.setdefault(deployment_id, {})
+            if file_hash in deployment_hashes:
+                self._duplicates += 1
+                return False
+            deployment_hashes[file_hash] = None
+            return True
+
+    def age_ms(self) -> float:
+        """ Returns how long the oldest event of the current batch has waited. """
+        first_added = self._first_added
+        return 0.0 if first_added is None else (self.clock() - first_added) * 1000
+
+    def is_due(self) -> bool:
+        """ Check whether the current batch reached its size or time window. """
+        return self._events >= self.max_events or (self._events > 0 and self.age_ms() >= self.max_wait_ms)
+
+    def drain(self) -> CoalescedBatch:
+        """ Take the current batch and start a new one.
+
+        Returns:
+            CoalescedBatch: the distinct hashes and the items of each deployment
+        """
+        with self._lock:
+            batch = CoalescedBatch(
+                file_hashes={deployment_id: list(hashes) for deployment_id, hashes in self._file_hashes.items()},
+                items=self._items,
+                events=self._events,
+                duplicates=self._duplicates,
+                wait_ms=self.age_ms(),
+            )
+            self._reset()
+        if self.instrumentation and batch.events:
+            self.instrumentation.observe("micro_batch.events", batch.events)
+            self.instrumentation.observe("micro_batch.hashes", batch.hash_count)
+            self.instrumentation.observe("micro_batch.deployments", len(batch.file_hashes))
+            self.instrumentation.observe("micro_batch.wait.ms", batch.wait_ms)
+            self.instrumentation.increment("micro_batch.duplicates", batch.duplicates)
+        return batch
+
+
+@dataclass
+class QueuedEvent:
+    """ A message of a LocalEventQueue, shaped like the func.EventHubEvent the trigger receives. """
+    body: bytes
+    sequence_number: int
+    enqueued_time: datetime
+    metadata: dict = field(default_factory=dict)
+
+    def get_body(self) -> bytes:
+        return self.body
+
+
+class LocalEventQueue:
+    """An in-process stand-in for the Event Hub feeding the micro-batching trigger.
+
+    receive_batch() waits for up to max_events messages or max_wait_s seconds, the way
+    the Event Hubs extension assembles a batch from maxEventBatchSize and maxWaitTime.
+    """
+
+    def __init__(self):
+        self._messages: deque[QueuedEvent] = deque()
+        self._condition = threading.Condition()
+        self._sequence_number = -1
+
+    @property
+    def depth(self) -> int:
+        """ Returns the number of messages waiting to be received. """
+        return len(self._messages)
+
+    def put(self, body: bytes | str):
+        """ Enqueue a message. """
+        self.put_many([body])
+
+    def put_many(self, bodies: Iterable[bytes | str]):
+        """ Enqueue many messages at once. """
+        with self._condition:
+            for body in bodies:
+                self._sequence_number += 1
+                self._messages.append(QueuedEvent(
+                    body=body.encode() if isinstance(body, str) else body,
+                    sequence_number=self._sequence_number,
+                    enqueued_time=datetime.now(timezone.utc),
+                ))
+            self._condition.notify_all()
+
+    def receive_batch(self, max_events: int, max_wait_s: float = 0.0) -> list[QueuedEvent]:
+        """ Receive up to max_events messages, waiting up to max_wait_s for the batch to fill.
+
+        Args:
+            max_events (int): the largest batch to receive
+            max_wait_s (float): how long to wait for more messages, 0 to take what is queued
+
+        Returns:
+            list[QueuedEvent]: the messages in enqueue order, empty if none arrived in time.
+                Each message's metadata holds the last enqueued sequence number, see queue_depth.
+        """
+        deadline = time.monotonic() + max_wait_s
+        with self._condition:
+            while len(self._messages) < max_events:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            batch = [self._messages.popleft() for _ in range(min(max_events, len(self._messages)))]
+            for message in batch:
+                message.metadata["LastEnqueuedSequenceNumber"] = self._sequence_number
+        return batch
+
+
+def queue_depth(messages: list[Any]) -> Optional[int]:
+    """ Get how many messages were still queued behind a delivered batch.
+
+    Uses the last enqueued sequence number of the partition, which the Event Hubs
+    extension only reports in the trigger metadata when it tracks it.
+
+    Args:
+        messages (list): the delivered func.EventHubEvent or QueuedEvent messages
+
+    Returns:
+        int: the number of messages behind the batch, None if it is not known
+    """
+    if not messages:
+        return None
+    last_delivered = max(message.sequence_number for message in messages)
+    metadata = getattr(messages[-1], "metadata", None) or {}
+    last_enqueued = metadata.get("LastEnqueuedSequenceNumber")
+    if last_enqueued is None:
+        runtime_information = (metadata.get("PartitionContext") or {}).get("RunTimeInformation") or {}
+        last_enqueued = runtime_information.get("LastSequenceNumber")
+    try:
+        return max(int(last_enqueued) - last_delivered, 0)
+    except (TypeError, ValueError):
+        return None
+
+
+def queue_lag_ms(message: Any, now: Optional[datetime] = None) -> Optional[float]:
+    """ Get how long a message waited between being enqueued and being delivered.
+
+    Returns:
+        float: the milliseconds since the message was enqueued, None if it is not known
+    """
+    enqueued_time = getattr(message, "enqueued_time", None)
+    if enqueued_time is None:
+        return None
+    if enqueued_time.tzinfo is None:
+        enqueued_time = enqueued_time.replace(tzinfo=timezone.utc)
+    return max(((now or datetime.now(timezone.utc)) - enqueued_time).total_seconds() * 1000, 0.0)
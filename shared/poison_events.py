@@ -0,0 +1,339 @@
+# shared/poison_events.py
+# Classifies failed events, dead-letters the permanent failures and buffers the transient ones for redrive.
+
+import glob
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from enum import Enum
+from typing import Callable, Iterable, Iterator, Optional
+
+from azure.core import exceptions as core_exceptions
+from azure.cosmos import exceptions as cosmos_exceptions
+
+from shared.instrumentation import Instrumentation
+from shared.rate_governor import RateLimitExceeded
+
+logger = logging.getLogger(__name__)
+
+# Status codes below 500 worth retrying: timeouts, throttling and gone/retry-with
+TRANSIENT_STATUS_CODES = frozenset({408, 410, 429, 449})
+
+
+class ConfigurationError(ValueError):
+    """ Raised when an app setting needed to process events is missing or invalid.
+
+    The events are fine and succeed once the setting is fixed, so the failure is
+    transient and they are redriven rather than dead-lettered.
+    """
+
+
+class FailureKind(Enum):
+    """ Whether retrying a failed event may succeed. """
+    TRANSIENT = "transient"
+    PERMANENT = "permanent"
+
+
+def classify_failure(error: BaseException) -> FailureKind:
+    """ Tell a failure worth retrying from one that fails the same way every time.
+
+    Throttling, timeouts, connection errors, 5xx responses and missing app settings
+    are transient. Other 4xx responses, e.g. a 404 blob or a 409 conflict, and invalid
+    event data (ValueError) are permanent. Unknown errors are treated as transient, the
+    redrive attempts bounding how often they are retried.
+
+    Args:
+        error (BaseException): the exception raised while processing the event
+
+    Returns:
+        FailureKind: the kind of failure
+    """
+    if isinstance(error, (RateLimitExceeded, ConfigurationError)):
+        return FailureKind.TRANSIENT
+    if isinstance(error, (
+        core_exceptions.ResourceNotFoundError,
+        core_exceptions.ResourceExistsError,
+        core_exceptions.ResourceModifiedError,
+        core_exceptions.ClientAuthenticationError,
+    )):
+        return FailureKind.PERMANENT
+    status_code = getattr(error, "status_code", None)
+    if isinstance(error, (core_exceptions.HttpResponseError, cosmos_exceptions.CosmosBatchOperationError)) and status_code:
+        if status_code in TRANSIENT_STATUS_CODES or status_code >= 500:
+            return FailureKind.TRANSIENT
+        return FailureKind.PERMANENT
+    if isinstance(error, (ValueError, TypeError, KeyError)):
+        return FailureKind.PERMANENT
+    return FailureKind.TRANSIENT
+
+
+@dataclass
+class FailedEvent:
+    """ An event that failed to be processed, with what is needed to replay and diagnose it. """
+    event: dict  # the event as delivered, in the Event Grid schema
+    source: str  # the function that failed to process it
+    kind: FailureKind
+    error: str
+    error_type: str
+    attempts: int = 1  # the number of times processing failed
+    first_failed_ms: int = 0
+    failed_ms: int = 0
+    next_attempt_ms: int = 0  # when the event is due for redrive
+    deployment_id: Optional[int] = None
+    file_hash: Optional[str] = None
+
+    @property
+    def event_id(self) -> Optional[str]:
+        """ Returns the id of the event, if it has one. """
+        return self.event.get("id") if isinstance(self.event, dict) else None
+
+    @staticmethod
+    def from_dict(data: dict) -> "FailedEvent":
+        """ Creates a FailedEvent from a record written by to_dict. """
+        return FailedEvent(**{**data, "kind": FailureKind(data["kind"])})
+
+    def to_dict(self) -> dict:
+        """ Converts the FailedEvent to a JSON-serialisable dictionary. """
+        return {**asdict(self), "kind": self.kind.value}
+
+
+class JsonLinesSpool:
+    """JSON records spooled to a directory, each append in a file of its own, drained
+    by renaming the files aside.
+
+    An append is written to a temporary file and renamed to its final name once
+    complete, and is never written to again, so the spool can be shared by the worker
+    processes and instances mounting the directory: no writer holds a file a drain
+    could take. drain() renames every complete file before reading it, and only
+    deletes the renamed files once the caller is done with the records. A drain that
+    never completed is picked up again after lease_seconds.
+    """
+
+    def __init__(self, path: str, lease_seconds: float = 600.0, clock: Callable[[], float] = time.time):
+        """ Initializes the spool, its files being created on the first append.
+
+        Args:
+            path (str): the name of the spool, e.g. "<dir>/redrive.jsonl", whose appends
+                are written to "<dir>/redrive.<time>-<pid>-<uuid>.jsonl"
+            lease_seconds (float): how long drained files are left to the drain that took them
+            clock (Callable[[], float]): the wall clock, in seconds
+        """
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.clock = clock
+        self._stem, self._extension = os.path.splitext(path)
+        self._lock = threading.Lock()
+
+    def _segment_path(self) -> str:
+        """ Returns a new file name for an append, sorting in the order of the appends. """
+        return f"{self._stem}.{int(self.clock() * 1_000_000):020d}-{os.getpid()}-{uuid.uuid4().hex}{self._extension}"
+
+    def append(self, records: Iterable[dict]) -> int:
+        """ Append records to the spool.
+
+        Returns:
+            int: the number of records appended
+        """
+        lines = [json.dumps(record, separators=(",", ":"), default=str) for record in records]
+        if not lines:
+            return 0
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        segment = self._segment_path()
+        with open(f"{segment}.tmp", "w", encoding="utf-8") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(f"{segment}.tmp", segment)
+        return len(lines)
+
+    def _claim(self) -> list[str]:
+        """ Rename the complete appends and any abandoned drain to files owned by this drain. """
+        claimed = []
+        now = self.clock()
+        # self.path holds records spooled to a single file by earlier versions
+        candidates = [self.path] + sorted(glob.glob(f"{glob.escape(self._stem)}.*{glob.escape(self._extension)}")) + [
+            path for path in glob.glob(f"{glob.escape(self.path)}.*.claimed")
+            if now - os.path.getmtime(path) > self.lease_seconds
+        ]
+        for path in candidates:
+            claim = f"{self.path}.{uuid.uuid4().hex}.claimed"
+            try:
+                os.replace(path, claim)
+            except FileNotFoundError:
+                continue  # nothing spooled, or another drain took it first
+            os.utime(claim, (now, now))
+            claimed.append(claim)
+        return claimed
+
+    @contextmanager
+    def drain(self) -> Iterator[list[dict]]:
+        """ Take every record spooled so far.
+
+        The records are removed from the spool when the block exits without raising,
+        the caller appending back the ones it did not handle. If the block raises they
+        are left to a later drain, once the lease has passed.
+
+        Yields:
+            list[dict]: the records, oldest first
+        """
+        with self._lock:
+            claimed = self._claim()
+        records = []
+        for path in claimed:
+            with open(path, encoding="utf-8") as file:
+                for line_number, line in enumerate(file, 1):
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logger.warning("Skipping invalid line %d of %s", line_number, path)
+        yield records
+        for path in claimed:
+            os.remove(path)
+
+
+class RedriveBuffer:
+    """Keeps failed events until they are redriven, or for good in a dead-letter file.
+
+    Permanent failures, and transient ones that ran out of attempts, are dead-lettered.
+    Transient failures wait in the redrive spool with an exponential backoff per event,
+    and are handed out in batches by due(). Both spools live in one directory, a local
+    stand-in for a blob container that may be shared by several workers.
+    """
+
+    def __init__(
+        self,
+        directory: str,
+        max_attempts: int = 5,
+        base_backoff_s: float = 30.0,
+        max_backoff_s: float = 3600.0,
+        lease_seconds: float = 600.0,
+        instrumentation: Optional[Instrumentation] = None,
+        clock: Callable[[], float] = time.time,
+        rng: Optional[random.Random] = None,
+    ):
+        """ Initializes the buffer.
+
+        Args:
+            directory (str): the directory of the redrive and dead-letter files
+            max_attempts (int): the failures after which a transient event is dead-lettered
+            base_backoff_s (float): the delay before the first redrive, doubled on each attempt
+            max_backoff_s (float): the upper bound of the delay
+            lease_seconds (float): how long a redrive has before its events are handed out again
+            instrumentation (Instrumentation): optional instrumentation counting the
+                buffered, dead-lettered and redriven events
+            clock (Callable[[], float]): the wall clock, in seconds
+            rng (random.Random): the source of the backoff jitter
+        """
+        self.max_attempts = max_attempts
+        self.base_backoff_s = base_backoff_s
+        self.max_backoff_s = max_backoff_s
+        self.instrumentation = instrumentation
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self.pending = JsonLinesSpool(os.path.join(directory, "redrive.jsonl"), lease_seconds, clock)
+        self.dead_letters = JsonLinesSpool(os.path.join(directory, "dead_letters.jsonl"), lease_seconds, clock)
+        self._lock = threading.Lock()
+        self._stats = {'buffered': 0, 'dead_lettered': 0, 'redriven': 0, 'replayed': 0}
+
+    def _increment(self, name: str, value: int):
+        if not value:
+            return
+        with self._lock:
+            self._stats[name] += value
+        if self.instrumentation:
+            self.instrumentation.increment(f"poison.{name}", value)
+
+    def backoff_s(self, attempts: int) -> float:
+        """ Returns the delay before the next redrive of an event that failed attempts times. """
+        delay_s = min(self.max_backoff_s, self.base_backoff_s * 2 ** (attempts - 1))
+        return delay_s / 2 + self.rng.uniform(0, delay_s / 2)
+
+    def record(self, failed_events: Iterable[FailedEvent]):
+        """ Buffer transient failures for redrive and dead-letter the rest.
+
+        Args:
+            failed_events (Iterable[FailedEvent]): the failed events
+        """
+        now = self.clock()
+        retry, dead = [], []
+        for failed_event in failed_events:
+            if failed_event.kind is FailureKind.PERMANENT or failed_event.attempts >= self.max_attempts:
+                dead.append(failed_event)
+            else:
+                failed_event.next_attempt_ms = int((now + self.backoff_s(failed_event.attempts)) * 1000)
+                retry.append(failed_event)
+        for failed_event in dead:
+            logger.warning(
+                "Dead-lettering event %s after %d attempts, %s failure: %s",
+                failed_event.event_id, failed_event.attempts, failed_event.kind.value, failed_event.error,
+                extra={'event_id': failed_event.event_id, 'deployment_id': failed_event.deployment_id,
+                       'source': failed_event.source, 'failure': failed_event.kind.value},
+            )
+        self._increment("buffered", self.pending.append(failed_event.to_dict() for failed_event in retry))
+        self._increment("dead_lettered", self.dead_letters.append(failed_event.to_dict() for failed_event in dead))
+
+    @contextmanager
+    def due(self, max_events: int) -> Iterator[list[FailedEvent]]:
+        """ Take up to max_events buffered events whose backoff has passed.
+
+        An event buffered more than once, e.g. because its batch was redelivered, is
+        handed out once. The events not taken are put back when the block exits. The
+        caller records the ones that fail again; if the block raises, all of them are
+        handed out again once the lease has passed.
+
+        Args:
+            max_events (int): the largest batch to take
+
+        Yields:
+            list[FailedEvent]: the events to redrive, oldest first
+        """
+        now_ms = int(self.clock() * 1000)
+        with self.pending.drain() as records:
+            failed_events = {}
+            for record in records:
+                failed_event = FailedEvent.from_dict(record)
+                key = failed_event.event_id or id(failed_event)
+                if key not in failed_events or failed_events[key].attempts < failed_event.attempts:
+                    failed_events[key] = failed_event
+            due, waiting = [], []
+            for failed_event in failed_events.values():
+                if failed_event.next_attempt_ms <= now_ms and len(due) < max_events:
+                    due.append(failed_event)
+                else:
+                    waiting.append(failed_event)
+            yield due
+            self.pending.append(failed_event.to_dict() for failed_event in waiting)
+        self._increment("redriven", len(due))
+
+    def replay_dead_letters(self) -> int:
+        """ Move every dead-lettered event back into the redrive buffer, due at once and
+        with its attempts reset, e.g. once the cause of a permanent failure is fixed.
+
+        Returns:
+            int: the number of events moved
+        """
+        with self.dead_letters.drain() as records:
+            failed_events = [FailedEvent.from_dict(record) for record in records]
+            for failed_event in failed_events:
+                failed_event.attempts = 0
+                failed_event.next_attempt_ms = 0
+            self.pending.append(failed_event.to_dict() for failed_event in failed_events)
+        self._increment("replayed", len(failed_events))
+        return len(failed_events)
+
+    def get_stats(self) -> dict:
+        """ Get the number of events this buffer has buffered, dead-lettered, redriven and
+        replayed. The files are shared with other workers and only read when drained, so
+        these are the counts of this process rather than what the files hold.
+
+        Returns:
+            dict: the counters
+        """
+        with self._lock:
+            return dict(self._stats)
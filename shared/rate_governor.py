@@ -0,0 +1,281 @@
+# shared/rate_governor.py
+# A client-side request unit budget per Cosmos DB partition, with 429-aware retries.
+
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, Mapping, Optional
+
+from shared.instrumentation import (
+    REQUEST_CHARGE_HEADER,
+    RETRY_AFTER_HEADER,
+    THROTTLE_RETRY_COUNT_HEADER,
+    header_float,
+)
+
+# Request charge assumed for an operation until one of its responses has been seen
+DEFAULT_ESTIMATE_RU = 5.0
+# Weight of the latest response in the running estimate of an operation's charge
+ESTIMATE_SMOOTHING = 0.2
+# Share of the configured rate given back to a partition on every unthrottled response
+RATE_RECOVERY = 0.05
+
+
+class RateLimitExceeded(ValueError):
+    """ Raised instead of calling Cosmos DB when a partition has no budget left for the
+    call within the allowed wait, or its throttle retries ran out. The work should be
+    deferred, e.g. by failing the invocation so it is redelivered later.
+    """
+
+    def __init__(self, message: str, partition_key: Optional[Hashable] = None, retry_after_ms: float = 0.0):
+        super().__init__(message)
+        self.partition_key = partition_key
+        self.retry_after_ms = retry_after_ms
+
+
+class TokenBucket:
+    """The RU budget of one partition.
+
+    A call reserves its estimated charge up front and the bucket may go into debt, the
+    caller waiting until the debt is refilled, so concurrent callers queue fairly. The
+    refill rate is halved on every throttle and recovers additively on success.
+    """
+    __slots__ = ("capacity", "max_rate", "rate", "tokens", "updated", "paused_until", "throttled", "shed")
+
+    def __init__(self, rate: float, capacity: float, now: float):
+        self.capacity = capacity
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = capacity
+        self.updated = now
+        self.paused_until = 0.0  # no call starts before this time, set from x-ms-retry-after-ms
+        self.throttled = 0
+        self.shed = 0
+
+    def refill(self, now: float):
+        """ Add the tokens accrued since the last update. """
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_s(self, now: float) -> float:
+        """ Returns how long until the bucket is out of debt and not paused. """
+        debt_s = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(debt_s, self.paused_until - now, 0.0)
+
+
+class Reservation:
+    """ The budget reserved for one call, settled against its actual request charge. """
+    __slots__ = ("partition_key", "operation", "estimate", "wait_s", "settled")
+
+    def __init__(self, partition_key: Optional[Hashable], operation: str, estimate: float, wait_s: float):
+        self.partition_key = partition_key
+        self.operation = operation
+        self.estimate = estimate
+        self.wait_s = wait_s  # how long the caller must wait before making the call
+        self.settled = False
+
+
+class RateGovernor:
+    """Keeps the Cosmos DB calls of each partition within an RU-per-second budget.
+
+    Buckets are created per partition key on first use, and the least recently used
+    are dropped beyond max_partitions. The charge of each operation is estimated from
+    the x-ms-request-charge of its earlier responses. All methods are thread-safe, the
+    waiting itself is left to the caller so it works for both the sync and async DALs.
+    """
+
+    def __init__(
+        self,
+        ru_per_second: float,
+        burst_seconds: float = 1.0,
+        max_wait_ms: float = 5000.0,
+        max_retries: int = 3,
+        base_backoff_ms: float = 50.0,
+        max_backoff_ms: float = 5000.0,
+        min_rate_ratio: float = 0.1,
+        max_partitions: int = 1000,
+        clock: Callable[[], float] = time.monotonic,
+        rng: Optional[random.Random] = None,
+    ):
+        """ Initializes the governor.
+
+        Args:
+            ru_per_second (float): the budget of each partition
+            burst_seconds (float): how many seconds of budget an idle partition can save up
+            max_wait_ms (float): the longest a call may wait for budget before it is shed
+            max_retries (int): the retries of a throttled call before it is shed
+            base_backoff_ms (float): the backoff of the first retry, doubled on each retry
+            max_backoff_ms (float): the upper bound of the backoff
+            min_rate_ratio (float): the share of ru_per_second throttles cannot reduce a partition below
+            max_partitions (int): the number of partitions with a bucket
+            clock (Callable[[], float]): the monotonic clock, in seconds
+            rng (random.Random): the source of the backoff jitter
+        """
+        if ru_per_second <= 0:
+            raise ValueError("ru_per_second must be positive")
+        self.ru_per_second = ru_per_second
+        self.capacity = ru_per_second * burst_seconds
+        self.max_wait_ms = max_wait_ms
+        self.max_retries = max_retries
+        self.base_backoff_ms = base_backoff_ms
+        self.max_backoff_ms = max_backoff_ms
+        self.min_rate = ru_per_second * min_rate_ratio
+        self.max_partitions = max_partitions
+        self.clock = clock
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+        self._buckets: OrderedDict[Hashable, TokenBucket] = OrderedDict()
+        self._estimates: dict[str, float] = {}
+        self._stats = {'calls': 0, 'waits': 0, 'wait_ms': 0.0, 'retries': 0, 'throttled': 0, 'shed': 0}
+
+    def _bucket(self, partition_key: Optional[Hashable], now: float) -> TokenBucket:
+        bucket = self._buckets.get(partition_key)
+        if bucket is None:
+            bucket = self._buckets[partition_key] = TokenBucket(self.ru_per_second, self.capacity, now)
+            if len(self._buckets) > self.max_partitions:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(partition_key)
+        bucket.refill(now)
+        return bucket
+
+    def reserve(self, partition_key: Optional[Hashable], operation: str) -> Reservation:
+        """ Reserve the estimated charge of a call against its partition's budget.
+
+        Args:
+            partition_key (Hashable): the partition the call targets, None for cross-partition calls
+            operation (str): the container operation, e.g. 'execute_item_batch'
+
+        Returns:
+            Reservation: the reservation, whose wait_s the caller must sleep before the call
+
+        Raises:
+            RateLimitExceeded: if the call would have to wait longer than max_wait_ms
+        """
+        with self._lock:
+            now = self.clock()
+            bucket = self._bucket(partition_key, now)
+            estimate = self._estimates.get(operation, DEFAULT_ESTIMATE_RU)
+            bucket.tokens -= estimate
+            wait_s = bucket.wait_s(now)
+            if wait_s * 1000 > self.max_wait_ms:
+                bucket.tokens += estimate
+                bucket.shed += 1
+                self._stats['shed'] += 1
+                raise RateLimitExceeded(
+                    f"RU budget of partition {partition_key} exhausted for {operation}",
+                    partition_key, wait_s * 1000,
+                )
+            self._stats['calls'] += 1
+            if wait_s:
+                self._stats['waits'] += 1
+                self._stats['wait_ms'] += wait_s * 1000
+            return Reservation(partition_key, operation, estimate, wait_s)
+
+    def settle(self, reservation: Reservation, headers: Optional[Mapping[str, str]]):
+        """ Charge a partition the actual request charge of a response.
+
+        The first response of a reservation replaces its estimate, later ones (the
+        further pages of a query) are charged on top.
+
+        Args:
+            reservation (Reservation): the reservation of the call
+            headers (Mapping[str, str]): the response headers
+        """
+        request_charge = header_float(headers, REQUEST_CHARGE_HEADER)
+        throttle_retries = header_float(headers, THROTTLE_RETRY_COUNT_HEADER)
+        with self._lock:
+            bucket = self._bucket(reservation.partition_key, self.clock())
+            charge = request_charge or 0.0
+            if not reservation.settled:
+                charge -= reservation.estimate
+                reservation.settled = True
+                if request_charge is not None:
+                    estimate = self._estimates.get(reservation.operation)
+                    self._estimates[reservation.operation] = request_charge if estimate is None else (
+                        estimate + ESTIMATE_SMOOTHING * (request_charge - estimate)
+                    )
+            bucket.tokens -= charge
+            if throttle_retries:
+                # The SDK was throttled before it got this response, back off all the same
+                bucket.rate = max(bucket.rate / 2, self.min_rate)
+            else:
+                bucket.rate = min(bucket.rate + bucket.max_rate * RATE_RECOVERY, bucket.max_rate)
+
+    def response_hook(self, reservation: Reservation) -> Callable[[Mapping[str, str], object], None]:
+        """ Build a Cosmos DB response_hook settling a reservation. """
+        def hook(headers: Mapping[str, str], _result):
+            self.settle(reservation, headers)
+        return hook
+
+    def throttled(self, reservation: Reservation, headers: Optional[Mapping[str, str]], attempt: int) -> float:
+        """ Record a 429 and get how long to back off before retrying the call.
+
+        The partition is paused for the x-ms-retry-after-ms of the response and its
+        refill rate halved. The backoff is the retry-after plus a full-jitter
+        exponential backoff, so retries from many workers spread out.
+
+        Args:
+            reservation (Reservation): the reservation of the throttled call
+            headers (Mapping[str, str]): the headers of the 429 response
+            attempt (int): the number of retries already made, 0 for the first throttle
+
+        Returns:
+            float: the seconds to wait before retrying, the call being reserved again after
+
+        Raises:
+            RateLimitExceeded: if the retries ran out or the backoff exceeds max_wait_ms
+        """
+        retry_after_ms = header_float(headers, RETRY_AFTER_HEADER) or 0.0
+        backoff_ms = retry_after_ms + self.rng.uniform(0, min(self.max_backoff_ms, self.base_backoff_ms * 2 ** attempt))
+        with self._lock:
+            now = self.clock()
+            bucket = self._bucket(reservation.partition_key, now)
+            if not reservation.settled:
+                # A throttled request is not charged
+                bucket.tokens += reservation.estimate
+                reservation.settled = True
+            bucket.rate = max(bucket.rate / 2, self.min_rate)
+            bucket.paused_until = max(bucket.paused_until, now + retry_after_ms / 1000)
+            bucket.throttled += 1
+            self._stats['throttled'] += 1
+            if attempt >= self.max_retries or backoff_ms > self.max_wait_ms:
+                bucket.shed += 1
+                self._stats['shed'] += 1
+                raise RateLimitExceeded(
+                    f"Partition {reservation.partition_key} still throttled after {attempt} retries of {reservation.operation}",
+                    reservation.partition_key, backoff_ms,
+                )
+            self._stats['retries'] += 1
+        return backoff_ms / 1000
+
+    def get_stats(self) -> dict:
+        """ Get the totals of the governor and the state of the partitions below their full budget.
+
+        Returns:
+            dict: the call, wait, retry, throttle and shed totals, the charge estimate of
+                each operation and, per constrained partition, its tokens, current refill
+                rate, remaining pause and throttle and shed counts
+        """
+        with self._lock:
+            now = self.clock()
+            constrained = {}
+            for partition_key, bucket in self._buckets.items():
+                bucket.refill(now)
+                if bucket.tokens < bucket.capacity or bucket.rate < bucket.max_rate or bucket.paused_until > now:
+                    constrained[str(partition_key)] = {
+                        'tokens': round(bucket.tokens, 3),
+                        'rate': round(bucket.rate, 3),
+                        'paused_ms': round(max(bucket.paused_until - now, 0.0) * 1000, 3),
+                        'throttled': bucket.throttled,
+                        'shed': bucket.shed,
+                    }
+            return {
+                'ru_per_second': self.ru_per_second,
+                'partitions': len(self._buckets),
+                **{name: round(value, 3) for name, value in self._stats.items()},
+                'estimates': {operation: round(estimate, 3) for operation, estimate in sorted(self._estimates.items())},
+                'constrained_partitions': constrained,
+            }
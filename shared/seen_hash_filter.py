@@ -0,0 +1,144 @@
+# shared/seen_hash_filter.py
+# A bounded in-process record of file hashes already stored, per deployment.
+
+import sys
+import threading
+from collections import OrderedDict
+
+# Memory of an OrderedDict slot and its link, per hash, measured on CPython 3.11
+ENTRY_OVERHEAD_BYTES = 90
+# Memory of an empty per-deployment OrderedDict and its slot in the outer one
+DEPLOYMENT_OVERHEAD_BYTES = sys.getsizeof(OrderedDict()) + ENTRY_OVERHEAD_BYTES
+
+
+class SeenHashFilter:
+    """An LRU set of file hashes known to exist in Cosmos DB, kept per deployment.
+
+    Each deployment holds at most max_hashes_per_deployment hashes, at most
+    max_deployments deployments are tracked and all of them fit in max_bytes; the least
+    recently used entries are evicted first. A hit means the hash is certainly stored,
+    a miss means nothing. The memory use is an estimate, kept up to date as hashes are
+    added and evicted.
+    """
+
+    def __init__(self, max_hashes_per_deployment: int = 10000, max_deployments: int = 100, max_bytes: int = 32 * 1024 * 1024):
+        """ Initializes the filter.
+
+        Args:
+            max_hashes_per_deployment (int): the number of hashes remembered per deployment
+            max_deployments (int): the number of deployments remembered
+            max_bytes (int): the approximate memory the remembered hashes may use
+        """
+        self.max_hashes_per_deployment = max_hashes_per_deployment
+        self.max_deployments = max_deployments
+        self.max_bytes = max_bytes
+        self._deployments: OrderedDict[int, OrderedDict[str, None]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._hash_count = 0
+        self._memory_bytes = sys.getsizeof(self._deployments)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def contains(self, deployment_id: int, file_hash: str, record: bool = True) -> bool:
+        """ Check whether a hash is known to be stored for a deployment.
+
+        Args:
+            deployment_id (int): the id of the deployment
+            file_hash (str): the file hash
+            record (bool): count the lookup in the hit rate and refresh the hash, False
+                for a peek ahead of the lookup that decides the write
+
+        Returns:
+            bool: True if the hash was seen before
+        """
+        with self._lock:
+            hashes = self._deployments.get(deployment_id)
+            if hashes is not None and file_hash in hashes:
+                if record:
+                    hashes.move_to_end(file_hash)
+                    self._deployments.move_to_end(deployment_id)
+                    self.hits += 1
+                return True
+            if record:
+                self.misses += 1
+            return False
+
+    def add(self, deployment_id: int, file_hash: str):
+        """ Record that a hash is stored for a deployment.
+
+        Args:
+            deployment_id (int): the id of the deployment
+            file_hash (str): the file hash
+        """
+        with self._lock:
+            hashes = self._deployments.get(deployment_id)
+            if hashes is None:
+                hashes = self._deployments[deployment_id] = OrderedDict()
+                self._memory_bytes += DEPLOYMENT_OVERHEAD_BYTES
+                if len(self._deployments) > self.max_deployments:
+                    self.evictions += self._evict_deployment(next(iter(self._deployments)))
+            else:
+                self._deployments.move_to_end(deployment_id)
+            if file_hash in hashes:
+                hashes.move_to_end(file_hash)
+                return
+            hashes[file_hash] = None
+            self._hash_count += 1
+            self._memory_bytes += sys.getsizeof(file_hash) + ENTRY_OVERHEAD_BYTES
+            if len(hashes) > self.max_hashes_per_deployment:
+                self._evict_hash(hashes)
+            # The oldest hashes of the least recently used deployments go first
+            while self._memory_bytes > self.max_bytes and self._hash_count > 1:
+                oldest_id, oldest = next(iter(self._deployments.items()))
+                if oldest:
+                    self._evict_hash(oldest)
+                if not oldest and oldest_id != deployment_id:
+                    self._evict_deployment(oldest_id)  # empty, its hashes counted as evicted
+
+    def _evict_hash(self, hashes: OrderedDict):
+        """ Evict the least recently used hash of a deployment, holding the lock. """
+        file_hash, _ = hashes.popitem(last=False)
+        self._hash_count -= 1
+        self._memory_bytes -= sys.getsizeof(file_hash) + ENTRY_OVERHEAD_BYTES
+        self.evictions += 1
+
+    def _evict_deployment(self, deployment_id: int) -> int:
+        """ Drop a deployment and its hashes, holding the lock.
+
+        Returns:
+            int: the number of hashes dropped
+        """
+        hashes = self._deployments.pop(deployment_id)
+        self._hash_count -= len(hashes)
+        self._memory_bytes -= DEPLOYMENT_OVERHEAD_BYTES + sum(sys.getsizeof(file_hash) + ENTRY_OVERHEAD_BYTES for file_hash in hashes)
+        return len(hashes)
+
+    def forget(self, deployment_id: int):
+        """ Drop every hash remembered for a deployment, e.g. once it is deleted.
+
+        Args:
+            deployment_id (int): the id of the deployment
+        """
+        with self._lock:
+            if deployment_id in self._deployments:
+                self._evict_deployment(deployment_id)
+
+    def get_stats(self) -> dict:
+        """ Get the hit rate, size and approximate memory use of the filter.
+
+        Returns:
+            dict: the filter statistics
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'deployments': len(self._deployments),
+                'hashes': self._hash_count,
+                'memory_bytes': self._memory_bytes,
+                'max_bytes': self.max_bytes,
+            }